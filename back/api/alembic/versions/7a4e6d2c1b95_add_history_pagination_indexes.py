@@ -0,0 +1,57 @@
+"""add history pagination indexes
+
+メッセージ・スレッドのキーセットページング用の複合索引を追加し、時刻の列をタイムゾーン付きにする。
+
+Revision ID: 7a4e6d2c1b95
+Revises: 3f1c2a9d8b10
+Create Date: 2026-10-18 10:20:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7a4e6d2c1b95"
+down_revision: Union[str, Sequence[str], None] = "3f1c2a9d8b10"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index("ix_messages_thread_id_timestamp", "messages", ["thread_id", "timestamp"], unique=False)
+    op.create_index("ix_threads_user_id_created_at", "threads", ["user_id", "created_at"], unique=False)
+
+    # SQLite は型を区別しないので、Postgres だけ timestamptz に変える（既存の値は UTC として扱う）
+    if op.get_context().dialect.name == "postgresql":
+        for table, column in (("messages", "timestamp"), ("threads", "created_at")):
+            op.alter_column(
+                table,
+                column,
+                type_=sa.DateTime(timezone=True),
+                existing_type=sa.DateTime(),
+                existing_nullable=False,
+                postgresql_using=f"\"{column}\" AT TIME ZONE 'UTC'",
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_context().dialect.name == "postgresql":
+        for table, column in (("messages", "timestamp"), ("threads", "created_at")):
+            op.alter_column(
+                table,
+                column,
+                type_=sa.DateTime(),
+                existing_type=sa.DateTime(timezone=True),
+                existing_nullable=False,
+                postgresql_using=f"\"{column}\" AT TIME ZONE 'UTC'",
+            )
+
+    op.drop_index("ix_threads_user_id_created_at", table_name="threads")
+    op.drop_index("ix_messages_thread_id_timestamp", table_name="messages")
@@ -1,18 +1,21 @@
 import asyncio
+import hashlib
 import os
 from time import time
+from typing import Optional
 
 import httpx
 import jwt
+from back.api.utils.logging import logger
+from back.api.utils.timing import span
+from back.api.utils.ttl_lru_cache import TTLLRUCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jwt import PyJWKClient
 from pydantic import BaseModel
 
-from back.api.utils.logging import logger
-
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 AUDIENCE = os.getenv("AUDIENCE")
 ISSUER = os.getenv("ISSUER")
 WELL_KNOWN = os.getenv("WELL_KNOWN")
@@ -21,79 +24,146 @@ WELL_KNOWN = os.getenv("WELL_KNOWN")
 class TokenClaims(BaseModel):
     claims: dict
 
+    @property
+    def user_id(self) -> Optional[str]:
+        # Entra ID ではテナント内で不変の oid を優先する
+        return self.claims.get("oid") or self.claims.get("sub")
+
 
 class JwksProvider:
-    def __init__(self, well_known_url: str, ttl: int = 60):
+    """JWKS の公開鍵を kid ごとに保持する
+
+    鍵は httpx の非同期クライアントで取得し、更新は同時に 1 回だけ行う（待っている他のリクエストはその結果を使う）。
+    未知の kid による更新は min_refresh_interval 秒に 1 回までに抑える。
+    """
+
+    def __init__(self, well_known_url: Optional[str], ttl: int = 3600, min_refresh_interval: float = 30.0):
         self.well_known_url = well_known_url
         self.ttl = ttl
-        self.jwks_client: PyJWKClient | None = None
+        self.min_refresh_interval = min_refresh_interval
+        self._keys: dict[str, jwt.PyJWK] = {}
+        self._jwks_uri: Optional[str] = None
         self._fetched_at: float = 0.0
-        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
 
-    async def _fetch_jwks_uri(self) -> str:
+    async def _fetch_jwks_uri(self, client: httpx.AsyncClient) -> str:
+        response = await client.get(self.well_known_url)
+        response.raise_for_status()
+        return response.json()["jwks_uri"]
+
+    async def _fetch_keys(self) -> None:
         async with httpx.AsyncClient(timeout=5) as client:
-            response = await client.get(self.well_known_url)
+            if self._jwks_uri is None:
+                self._jwks_uri = await self._fetch_jwks_uri(client)
+            response = await client.get(self._jwks_uri)
             response.raise_for_status()
-            return response.json()["jwks_uri"]
-
-    async def get_client(self) -> PyJWKClient:
-        current_time = time()
-        if self.jwks_client and (current_time - self._fetched_at) <= self.ttl:
-            return self.jwks_client
-
-        async with self._lock:
-            current_time = time()
-            if self.jwks_client and (current_time - self._fetched_at) <= self.ttl:
-                return self.jwks_client
-            jwks_uri = await self._fetch_jwks_uri()
-            self.jwks_client = PyJWKClient(jwks_uri)
-            self._fetched_at = current_time
-            return self.jwks_client
-
-    async def refresh_client(self) -> None:
-        async with self._lock:
-            jwks_uri = await self._fetch_jwks_uri()
-            self.jwks_client = PyJWKClient(jwks_uri)
-            self._fetched_at = time()
-            return self.jwks_client
-
-    async def get_signing_key_with_retry(self, token: str):
-        try:
-            client = await self.get_client()
-            clients = client.get_signing_key_from_jwt(token)
-            return clients
-        except Exception as e:
-            logger.error(f"First attempt failed. Exception: {type(e).__name__}: {e}")
+            jwks = response.json()
+
+        keys = {}
+        for jwk in jwks.get("keys", []):
             try:
-                # 鍵リストの更新を試みる
-                await self.refresh_client()
-            except httpx.HTTPError:
-                logger.error("Http Error has Occuered")
-                raise
-            await asyncio.sleep(0.5)
+                key = jwt.PyJWK(jwk)
+            except jwt.PyJWKError as e:
+                # 署名に使えない鍵（未対応のアルゴリズムなど）は読み飛ばす
+                logger.warning(f"JWKS の鍵を読み込めませんでした kid={jwk.get('kid')}: {e}")
+                continue
+            if key.key_id:
+                keys[key.key_id] = key
+        self._keys = keys
+        self._fetched_at = time()
+
+    async def refresh(self) -> None:
+        task = self._refresh_task
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_keys())
+            self._refresh_task = task
+            task.add_done_callback(self._clear_refresh_task)
+        # 待っているリクエストがキャンセルされても、更新自体は他のリクエストのために続ける
+        await asyncio.shield(task)
+
+    def _clear_refresh_task(self, task: asyncio.Task) -> None:
+        if self._refresh_task is task:
+            self._refresh_task = None
+
+    async def get_signing_key(self, token: str) -> jwt.PyJWK:
+        kid = jwt.get_unverified_header(token).get("kid")
+        if not kid:
+            raise jwt.InvalidTokenError("トークンに kid がありません")
+
+        elapsed = time() - self._fetched_at
+        expired = elapsed > self.ttl
+        unknown = kid not in self._keys and elapsed > self.min_refresh_interval
+        if expired or unknown:
             try:
-                # 新しいクライアントを取得
-                client = await self.get_client()
-                clients_retry = client.get_signing_key_from_jwt(token)
-                return clients_retry
-            except Exception as e_retry:
-                # 2回目の失敗も鍵が見つからない場合、サーバー側の問題として HTTPException を送出
-                logger.error(
-                    f"Second attempt failed. Exception: {type(e_retry).__name__}: {e_retry}"
-                )
-                raise  # get_token の例外処理でキャッチされる
+                await self.refresh()
+            except httpx.HTTPError:
+                # 期限切れでも取得済みの鍵があれば使い続ける
+                if kid not in self._keys:
+                    raise
+                logger.error("JWKS の更新に失敗したため、取得済みの鍵を使います")
+
+        key = self._keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"署名鍵が見つかりません kid={kid}")
+        return key
+
+
+class VerifiedTokenCache:
+    """検証済みトークンのクレームを、トークンの exp まで保持する
+
+    キーはトークンそのものではなく SHA-256 のハッシュにする。
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self._cache: TTLLRUCache[TokenClaims] = TTLLRUCache(max_entries=max_entries, sizeof=lambda _: 0)
+        self.stats = self._cache.stats
+
+    @classmethod
+    def from_env(cls) -> "VerifiedTokenCache":
+        return cls(max_entries=int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", "10000")))
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> Optional[TokenClaims]:
+        return self._cache.get(self._digest(token))
+
+    def set(self, token: str, claims: TokenClaims) -> None:
+        # TTLLRUCache は単調時計で期限を管理するので、exp までの残り秒数に変換する
+        remaining = claims.claims["exp"] - time()
+        if remaining > 0:
+            self._cache.set(self._digest(token), claims, ttl=remaining)
+
+    def stats_dict(self) -> dict[str, int]:
+        return {**self.stats.to_dict(), "entries": len(self._cache)}
 
 
 _jwks_provider = JwksProvider(WELL_KNOWN, ttl=3600)
+token_cache = VerifiedTokenCache.from_env()
 
 
 async def get_token(id_token: str = Depends(oauth2_scheme)) -> TokenClaims:
+    with span("get_token"):
+        return await _verify_token(id_token)
+
+
+async def get_optional_token(id_token: Optional[str] = Depends(optional_oauth2_scheme)) -> Optional[TokenClaims]:
+    """Authorization ヘッダがなければ None、あれば get_token と同じく検証する"""
     if not id_token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="認証トークンが提供されていません"
-        )
+        return None
+    return await get_token(id_token)
+
+
+async def _verify_token(id_token: str) -> TokenClaims:
+    if not id_token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="認証トークンが提供されていません")
+    # 検証済みのトークンは署名の検証を省く（有効期限はキャッシュの期限で担保する）
+    cached = token_cache.get(id_token)
+    if cached is not None:
+        return cached
     try:
-        signing_key = await _jwks_provider.get_signing_key_with_retry(id_token)
+        signing_key = await _jwks_provider.get_signing_key(id_token)
         options = {
             "verify_signature": True,
             "verify_exp": True,
@@ -109,25 +179,19 @@ async def get_token(id_token: str = Depends(oauth2_scheme)) -> TokenClaims:
             options=options,
         )
         logger.info("Auth Token Verified")
-        return TokenClaims(claims=claims)
+        token_claims = TokenClaims(claims=claims)
+        token_cache.set(id_token, token_claims)
+        return token_claims
 
     except jwt.ExpiredSignatureError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="トークンの有効期限が切れています"
-        )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="トークンの有効期限が切れています")
     except jwt.InvalidAudienceError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="無効なオーディエンス"
-        )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="無効なオーディエンス")
     except jwt.InvalidIssuerError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="無効な発行者")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="無効なトークン")
     except httpx.HTTPError:
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="認証サービスに接続できません"
-        )
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="認証サービスに接続できません")
     except Exception:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="トークンの検証に失敗しました"
-        )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="トークンの検証に失敗しました")
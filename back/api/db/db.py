@@ -1,6 +1,13 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from typing import AsyncIterator, Optional
+
+from back.api.models.models import Base
+from fastapi import Request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
 
 DB_USER = os.getenv("DB_USER", "user")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
@@ -8,6 +15,9 @@ DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "database")
 
+# ローカル環境で SQLite を使う場合は DATABASE_URL にこの URL を指定する
+LOCAL_DATABASE_URL = "sqlite+aiosqlite:///./chat.db"
+
 
 def get_db_config():
     return {
@@ -19,18 +29,122 @@ def get_db_config():
     }
 
 
-_db = get_db_config()
-DATABASE_URL = f"""
-    postgresql://{_db['DB_USER']}:{_db['DB_PASSWORD']}@{_db['DB_HOST']}:{_db['DB_PORT']}/{_db['DB_NAME']}
+def get_database_url() -> str:
+    """DATABASE_URL が指定されていればそれを、無ければ DB_* から組み立てた Postgres の URL を返す
+
+    SQLite は DATABASE_URL で明示した場合にだけ使う（DB_* の指定漏れで別の DB に書き込まないように）。
     """
+    url = os.getenv("DATABASE_URL")
+    if url:
+        return url
+    _db = get_db_config()
+    return (
+        f"postgresql+asyncpg://{_db['DB_USER']}:{_db['DB_PASSWORD']}"
+        f"@{_db['DB_HOST']}:{_db['DB_PORT']}/{_db['DB_NAME']}"
+    )
+
+
+class DatabaseConfig:
+    """非同期エンジンの接続プールとステートメントキャッシュの設定"""
+
+    def __init__(
+        self,
+        url: str = LOCAL_DATABASE_URL,
+        pool_size: int = 10,
+        max_overflow: int = 20,
+        pool_timeout: float = 30.0,
+        pool_recycle: int = 1800,
+        pool_pre_ping: bool = True,
+        statement_cache_size: int = 500,
+        create_all: Optional[bool] = None,
+        echo: bool = False,
+    ):
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        self.statement_cache_size = statement_cache_size
+        # 未指定の場合、SQLite ではテーブルを自動作成する（Postgres は Alembic でマイグレーションする）
+        self.create_all = self.is_sqlite if create_all is None else create_all
+        self.echo = echo
+
+    @property
+    def is_sqlite(self) -> bool:
+        return make_url(self.url).get_backend_name() == "sqlite"
+
+    @classmethod
+    def from_env(cls) -> "DatabaseConfig":
+        create_all = os.getenv("DB_CREATE_ALL")
+        return cls(
+            url=get_database_url(),
+            pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+            pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+            statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500")),
+            create_all=create_all.lower() == "true" if create_all else None,
+            echo=os.getenv("DB_ECHO", "false").lower() == "true",
+        )
+
+
+def create_db_engine(config: DatabaseConfig) -> AsyncEngine:
+    url = make_url(config.url)
+    # SQLAlchemy 側のコンパイル済み SQL のキャッシュ
+    kwargs: dict = {"echo": config.echo, "query_cache_size": config.statement_cache_size}
+
+    if config.is_sqlite and url.database in (None, "", ":memory:"):
+        # インメモリの SQLite は接続ごとに別のデータベースになるため、1 接続を共有する
+        kwargs.update(poolclass=StaticPool, connect_args={"check_same_thread": False})
+    else:
+        kwargs.update(
+            pool_size=config.pool_size,
+            max_overflow=config.max_overflow,
+            pool_timeout=config.pool_timeout,
+            pool_recycle=config.pool_recycle,
+            pool_pre_ping=config.pool_pre_ping,
+        )
+    if url.get_driver_name() == "asyncpg":
+        # asyncpg の接続ごとのプリペアドステートメントのキャッシュ
+        url = url.update_query_dict({"prepared_statement_cache_size": str(config.statement_cache_size)})
+
+    engine = create_async_engine(url, **kwargs)
+    if config.is_sqlite:
+        event.listen(engine.sync_engine, "connect", _configure_sqlite)
+    return engine
+
+
+def _configure_sqlite(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    # WAL にすると書き込み中も読み取りがブロックされない
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class Database:
+    """ライフスパンの間共有する非同期エンジンとセッションファクトリ"""
+
+    def __init__(self, config: Optional[DatabaseConfig] = None):
+        self.config = config or DatabaseConfig.from_env()
+        self.engine = create_db_engine(self.config)
+        self.session_factory = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    async def create_all(self) -> None:
+        async with self.engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+    async def startup(self) -> None:
+        if self.config.create_all:
+            await self.create_all()
 
-Engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=Engine)
+    async def aclose(self) -> None:
+        await self.engine.dispose()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_db(request: Request) -> AsyncIterator[AsyncSession]:
+    async with request.app.state.database.session_factory() as session:
+        yield session
@@ -3,6 +3,16 @@ import os
 from contextlib import asynccontextmanager
 from pathlib import Path
 
+from back.api.db.db import Database
+from back.api.middlewares.request_id_middleware import RequestIDMiddleware
+from back.api.middlewares.server_timing_middleware import ServerTimingMiddleware
+from back.api.routes.route import router
+from back.api.services.context_builder import TokenCounter
+from back.api.services.conversation_memory import ConversationMemory
+from back.api.services.message_writer import MessageWriter
+from back.api.services.rag_client_registry import RagClientRegistry
+from back.api.utils import exception_handler
+from back.api.utils.logging import logger
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
@@ -10,15 +20,6 @@ from fastapi.routing import APIRoute
 from starlette.exceptions import HTTPException
 from starlette.middleware.cors import CORSMiddleware
 
-from back.api.middlewares.request_id_middleware import RequestIDMiddleware
-from back.api.routes.route import router
-from back.api.utils.exception_handler import (
-    generic_exception_handler,
-    http_exception_handler,
-    validation_exception_handler,
-)
-from back.api.utils.logging import logger
-
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -39,7 +40,24 @@ async def lifespan(app: FastAPI):
                 e,
                 extra={"request_id": ""},
             )
+
+    # RagClient と DB のエンジンはリクエストごとに作らず、ライフスパンの間使い回す
+    app.state.database = Database()
+    await app.state.database.startup()
+    # メッセージはキューに溜めてバックグラウンドでまとめて書き込む
+    app.state.message_writer = MessageWriter.from_env(app.state.database.session_factory)
+    app.state.message_writer.start()
+    app.state.conversation_memory = ConversationMemory.from_env()
+    app.state.rag_client_registry = RagClientRegistry()
+    # tiktoken のエンコーディングはダウンロードを伴うことがあるので、リクエストの処理中ではなくここで読み込む
+    await TokenCounter.preload(app.state.rag_client_registry.allowed_deployments)
+    try:
         yield
+    finally:
+        await app.state.rag_client_registry.aclose()
+        # 残っているメッセージを書き込んでからエンジンを閉じる
+        await app.state.message_writer.aclose()
+        await app.state.database.aclose()
 
 
 def create_app() -> FastAPI:
@@ -53,10 +71,11 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["POST", "GET"],
         allow_headers=["*"],
-        expose_headers=["x-request-id"],
+        expose_headers=["x-request-id", "server-timing"],
     )
 
-    # ミドルウェアの追加
+    # ミドルウェアの追加（後に追加したものほど外側で動く）
+    application.add_middleware(ServerTimingMiddleware)
     application.add_middleware(RequestIDMiddleware)
     application.add_middleware(
         TrustedHostMiddleware,
@@ -77,11 +96,11 @@ def use_route_names_as_operation_ids(app: FastAPI) -> None:
 app = create_app()
 
 # 既定の HTTPException 処理のオーバーライド
-app.add_exception_handler(HTTPException, http_exception_handler)
+app.add_exception_handler(HTTPException, exception_handler.http_exception_handler)
 # リクエストバリデーションエラー(422) のハンドラ
-app.add_exception_handler(RequestValidationError, validation_exception_handler)
+app.add_exception_handler(RequestValidationError, exception_handler.validation_exception_handler)
 # 未処理例外のハンドラ（Exception を捕ることで 500 を一元化）
-app.add_exception_handler(Exception, generic_exception_handler)
+app.add_exception_handler(Exception, exception_handler.generic_exception_handler)
 
 
 use_route_names_as_operation_ids(app)
@@ -0,0 +1,33 @@
+import time
+
+from back.api.utils.timing import format_server_timing, start_request_timing
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# NOTE: contextvarが正しく機能するためにBaseHTTPMiddlewareではなくASGIミドルウェアを使用
+class ServerTimingMiddleware:
+    """span() で計測した段階ごとの処理時間を Server-Timing ヘッダで返す
+
+    ヘッダはレスポンスの開始時に送るため、ストリーミングの途中で終わる段階は含まれない（メトリクスには記録される）。
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        spans = start_request_timing()
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                entries = spans + [("total", time.perf_counter() - start)]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", format_server_timing(entries).encode("latin1")))
+                message["headers"] = headers
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,7 +1,7 @@
 from datetime import datetime, timezone
 from uuid import uuid4
 
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import DateTime, ForeignKey, Index, String
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -11,21 +11,27 @@ class Base(DeclarativeBase):
 
 class Message(Base):
     __tablename__ = "messages"
+    # スレッド内のメッセージを時刻順にページングするための索引
+    __table_args__ = (Index("ix_messages_thread_id_timestamp", "thread_id", "timestamp"),)
+
     id: Mapped[str] = mapped_column(primary_key=True, default=lambda: str(uuid4()))
     thread_id: Mapped[str] = mapped_column(ForeignKey("threads.id"))
     text: Mapped[str] = mapped_column()
     sender: Mapped[str] = mapped_column(String(10))
-    timestamp: Mapped[datetime] = mapped_column(default=lambda: datetime.now(tz=timezone.utc))
+    timestamp: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(tz=timezone.utc))
 
     thread: Mapped["Thread"] = relationship(back_populates="messages")
 
 
 class Thread(Base):
     __tablename__ = "threads"
+    # ユーザーのスレッドを新しい順にページングするための索引
+    __table_args__ = (Index("ix_threads_user_id_created_at", "user_id", "created_at"),)
+
     id: Mapped[str] = mapped_column(primary_key=True, default=lambda: str(uuid4()))
     user_id: Mapped[str] = mapped_column(index=True)
     title: Mapped[str] = mapped_column(String(255), default="新規チャット")
-    created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(tz=timezone.utc))
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(tz=timezone.utc))
 
     messages: Mapped[list["Message"]] = relationship(
         back_populates="thread",
@@ -1,11 +1,27 @@
-import os
+import math
+from contextlib import aclosing
+from functools import partial
+from typing import AsyncIterator, Literal, Optional, Union
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
-
-from back.api.auth.auth import get_token
-from back.api.schemas.chat_schema import RagChatRequest, RagChatResponse
-from back.api.services.rag_client import RagClient
+from back.api.auth.auth import TokenClaims, get_optional_token, get_token, token_cache
+from back.api.db.db import get_db
+from back.api.schemas import chat_schema
+from back.api.services import conversation_memory
+from back.api.services.answer_cache import normalize_query
+from back.api.services.async_rag_client import AsyncRagClient
+from back.api.services.chat_batch import default_batch_concurrency, run_batch
+from back.api.services.chat_repository import ChatRepository
+from back.api.services.message_writer import MessageWriter, get_message_writer
+from back.api.services.query_filters import SearchFilters
+from back.api.services.rag_client_registry import RagClientRegistry, UnknownDeploymentError, get_rag_client_registry
+from back.api.services.rate_limiter import RateLimitExceededError
+from back.api.utils.logging import logger
+from back.api.utils.metrics import CACHE_ENTRIES, CACHE_EVENTS, metrics
+from back.api.utils.sse import SSE_HEADERS, format_sse
+from back.api.utils.timing import span
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 router = APIRouter()
@@ -20,28 +36,385 @@ async def get_root(token=Depends(get_token)):
     )
 
 
-@router.post("/chat", response_model=RagChatResponse)
-async def chat(request: RagChatRequest):
+@router.get("/cache/stats")
+async def get_cache_stats(
+    token=Depends(get_token),
+    registry: RagClientRegistry = Depends(get_rag_client_registry),
+    memory: conversation_memory.ConversationMemory = Depends(conversation_memory.get_conversation_memory),
+):
+    answer_cache = registry.answer_cache
+    retrieval_cache = registry.retrieval_cache
+    return {
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+        "retrieval_cache": retrieval_cache.stats_dict() if retrieval_cache is not None else None,
+        "embedding_cache": registry.embedding_cache.stats_dict(),
+        "token_cache": token_cache.stats_dict(),
+        "conversation_memory": memory.stats_dict(),
+    }
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(
+    registry: RagClientRegistry = Depends(get_rag_client_registry),
+    memory: conversation_memory.ConversationMemory = Depends(conversation_memory.get_conversation_memory),
+):
+    """Prometheus 形式のメトリクス"""
+    # キャッシュはそれぞれ統計を持っているので、スクレイプ時に値を写す
+    cache_stats = {
+        "answer": registry.answer_cache.stats() if registry.answer_cache is not None else {},
+        "retrieval": registry.retrieval_cache.stats_dict() if registry.retrieval_cache is not None else {},
+        "embedding": registry.embedding_cache.stats_dict(),
+        "token": token_cache.stats_dict(),
+        "conversation": memory.stats_dict(),
+    }
+    for cache, stats in cache_stats.items():
+        for event, value in stats.items():
+            if event == "entries":
+                CACHE_ENTRIES.set(value, cache=cache)
+            elif isinstance(value, (int, float)):
+                CACHE_EVENTS.set_total(value, cache=cache, event=event)
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@router.post("/cache/invalidate")
+async def invalidate_cache(
+    index_name: Optional[str] = None,
+    index_version: Optional[str] = None,
+    token=Depends(get_token),
+    registry: RagClientRegistry = Depends(get_rag_client_registry),
+):
+    """インデックスの更新後に検索結果・応答のキャッシュを無効化する
+
+    index_version を指定した場合は、前回通知されたバージョンから変わったときだけ無効化する。
+    """
+    invalidated = True
+    if registry.retrieval_cache is not None:
+        if index_name is not None and index_version is not None:
+            invalidated = registry.retrieval_cache.set_index_version(index_name, index_version)
+        else:
+            registry.retrieval_cache.invalidate(index_name)
+    # 応答キャッシュは検索結果に依存するため、あわせて破棄する
+    if invalidated and registry.answer_cache is not None:
+        registry.answer_cache.clear()
+    return {"invalidated": invalidated}
+
+
+def _current_user_id(token: Optional[TokenClaims]) -> str:
+    if token is None or not token.user_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="ユーザーを特定できません")
+    return token.user_id
+
+
+@router.post("/threads", response_model=chat_schema.ChatThread)
+async def create_thread(
+    request: chat_schema.CreateThreadRequest,
+    token: TokenClaims = Depends(get_token),
+    db: AsyncSession = Depends(get_db),
+):
+    thread = await ChatRepository(db).create_thread(_current_user_id(token), request.title)
+    return chat_schema.ChatThread.model_validate(thread)
+
+
+@router.get("/threads", response_model=chat_schema.ThreadPage)
+async def list_threads(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    token: TokenClaims = Depends(get_token),
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        threads, next_cursor = await ChatRepository(db).list_threads(_current_user_id(token), limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return chat_schema.ThreadPage(
+        threads=[chat_schema.ChatThread.model_validate(thread) for thread in threads], next_cursor=next_cursor
+    )
+
+
+@router.get("/threads/{thread_id}", response_model=chat_schema.ChatThread)
+async def get_thread(
+    thread_id: str,
+    token: TokenClaims = Depends(get_token),
+    db: AsyncSession = Depends(get_db),
+):
+    """スレッドの情報（メッセージは /threads/{thread_id}/messages で取得する）"""
+    thread = await ChatRepository(db).get_thread(thread_id, _current_user_id(token))
+    if thread is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="スレッドが見つかりません")
+    return chat_schema.ChatThread.model_validate(thread)
+
+
+@router.get("/threads/{thread_id}/messages", response_model=chat_schema.MessagePage)
+async def list_messages(
+    thread_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    order: Literal["asc", "desc"] = "asc",
+    token: TokenClaims = Depends(get_token),
+    db: AsyncSession = Depends(get_db),
+):
+    repository = ChatRepository(db)
+    if await repository.get_thread(thread_id, _current_user_id(token)) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="スレッドが見つかりません")
+    try:
+        messages, next_cursor = await repository.list_messages(thread_id, limit, cursor, descending=order == "desc")
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return chat_schema.MessagePage(
+        messages=[chat_schema.ChatMessage.model_validate(message) for message in messages],
+        next_cursor=next_cursor,
+    )
+
+
+def _too_many_requests(error: RateLimitExceededError) -> HTTPException:
+    headers = {"Retry-After": str(math.ceil(error.retry_after))} if error.retry_after is not None else None
+    return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(error), headers=headers)
+
+
+def _get_client(registry: RagClientRegistry, deployment_name: str) -> AsyncRagClient:
+    try:
+        return registry.get_client(deployment_name=deployment_name)
+    except UnknownDeploymentError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _recent_messages_loader(
+    db: AsyncSession, message_writer: MessageWriter, thread_id: str
+) -> conversation_memory.MessageLoader:
+    async def load(limit: int) -> list[conversation_memory.StoredMessage]:
+        # DB を読む前に控えておく（読んでいる間に書き込まれた行が両方から漏れないように）
+        pending = message_writer.pending(thread_id)
+        messages, _ = await ChatRepository(db).list_messages(thread_id, limit=limit, descending=True)
+        stored = [(message.id, message.sender, message.text) for message in reversed(messages)]
+        written = {message_id for message_id, _, _ in stored}
+        # まだ書き込まれていないメッセージは DB のものより新しいので末尾に足す
+        stored.extend((row["id"], row["sender"], row["text"]) for row in pending if row["id"] not in written)
+        return stored[-limit:]
+
+    return load
+
+
+async def _thread_history(
+    thread_id: Optional[str],
+    token: Optional[TokenClaims],
+    db: AsyncSession,
+    message_writer: MessageWriter,
+    memory: conversation_memory.ConversationMemory,
+    model: str,
+) -> tuple[Optional[conversation_memory.ConversationState], Optional[list[dict]]]:
+    """スレッドの会話の状態と、プロンプトに渡す会話履歴（古いターンの要約 + 直近のターン）を返す"""
+    if thread_id is None:
+        return None, None
+    # 応答を生成する前に、保存先のスレッドが本人のものか確認する
+    thread = await ChatRepository(db).get_thread(thread_id, _current_user_id(token))
+    if thread is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="スレッドが見つかりません")
+    with span("load_history"):
+        conversation = await memory.get(thread_id, load=_recent_messages_loader(db, message_writer, thread_id))
+        return conversation, memory.history_messages(conversation, model)
+
+
+async def _save_turn(
+    thread_id: str,
+    conversation: conversation_memory.ConversationState,
+    query: str,
+    response: str,
+    message_writer: MessageWriter,
+    memory: conversation_memory.ConversationMemory,
+) -> None:
+    # 書き込みは待たずにキューに積むだけ（キューが一杯のときはここで待つ）
+    with span("save_messages"):
+        ids = await message_writer.enqueue(thread_id, [("user", query), ("bot", response)])
+    memory.append(conversation, query, response, ids[-1])
+
+
+def _search_filters(request: chat_schema.RagChatRequest) -> Optional[SearchFilters]:
+    if request.filters is None:
+        return None
+    return SearchFilters(request.filters.locations, request.filters.boost_locations) or None
+
+
+@router.post("/chat", response_model=chat_schema.RagChatResponse)
+async def chat(
+    request: chat_schema.RagChatRequest,
+    background_tasks: BackgroundTasks,
+    registry: RagClientRegistry = Depends(get_rag_client_registry),
+    token: Optional[TokenClaims] = Depends(get_optional_token),
+    db: AsyncSession = Depends(get_db),
+    message_writer: MessageWriter = Depends(get_message_writer),
+    memory: conversation_memory.ConversationMemory = Depends(conversation_memory.get_conversation_memory),
+):
+    rag_client = _get_client(registry, request.model)
+    conversation, history = await _thread_history(
+        request.thread_id, token, db, message_writer, memory, rag_client.deployment_name
+    )
     try:
-        rag_client = RagClient(
-            search_endpoint=os.getenv("SEARCH_ENDPOINT"),
-            search_api_key=os.getenv("SEARCH_API_KEY"),
-            search_index_name=os.getenv("SEARCH_INDEX_NAME"),
-            openai_endpoint=os.getenv("OPENAI_ENDPOINT"),
-            openai_api_key=os.getenv("OPENAI_API_KEY"),
-            deployment_name=request.model,
-            api_version=os.getenv("API_VERSION"),
+        query = request.query
+        results = await rag_client.get_response_with_rag(
+            query,
             top_k=request.top_k,
             search_mode=request.search_mode,
+            history=history,
+            filters=_search_filters(request),
         )
-        query = request.query
-        results = rag_client.get_response_with_rag(query)
+    except RateLimitExceededError as e:
+        raise _too_many_requests(e)
     except Exception as e:
         return {"error": str(e)}
 
-    return RagChatResponse(
-        query=results["query"],
-        response=results["response"],
-        documents=results["documents"],
-        search_mode=results["search_mode"],
+    if conversation is not None:
+        await _save_turn(request.thread_id, conversation, results["query"], results["response"], message_writer, memory)
+        # 要約の更新は応答を返した後に行う
+        summarize = partial(rag_client.summarize_history, max_tokens=memory.summary_max_tokens)
+        background_tasks.add_task(memory.compact, conversation, summarize, rag_client.deployment_name)
+
+    # エンコードの時間も計測できるよう、FastAPI に任せずにここで JSON にする
+    with span("encode_response"):
+        body = chat_schema.RagChatResponse(
+            query=results["query"],
+            response=results["response"],
+            documents=results["documents"],
+            search_mode=results["search_mode"],
+            usage=results.get("usage"),
+        ).model_dump_json()
+    return Response(content=body, media_type="application/json")
+
+
+def _batch_item(
+    index: int, item: chat_schema.RagChatRequest, outcome: Union[dict, Exception]
+) -> chat_schema.RagChatBatchItem:
+    if isinstance(outcome, Exception):
+        return chat_schema.RagChatBatchItem(index=index, error=str(outcome))
+    return chat_schema.RagChatBatchItem(
+        index=index,
+        result=chat_schema.RagChatResponse(
+            # 重複をまとめて処理した項目にも、それぞれの元のクエリを返す
+            query=item.query,
+            response=outcome["response"],
+            documents=outcome["documents"],
+            search_mode=outcome["search_mode"],
+            usage=outcome.get("usage"),
+        ),
     )
+
+
+@router.post("/chat/batch", response_model=chat_schema.RagChatBatchResponse)
+async def chat_batch(
+    request: chat_schema.RagChatBatchRequest,
+    registry: RagClientRegistry = Depends(get_rag_client_registry),
+):
+    """複数の問い合わせを並行に処理する
+
+    同じ問い合わせ（正規化したクエリ, search_mode, top_k, model, filters）は 1 回だけ処理する。
+    失敗した項目は error に理由を入れて返し、バッチ全体は失敗させない。
+    thread_id は指定できない（会話履歴を使わず、保存もしない）。
+    """
+
+    async def run(item: chat_schema.RagChatRequest) -> dict:
+        if item.thread_id is not None:
+            raise ValueError("バッチでは thread_id を指定できません")
+        rag_client = registry.get_client(deployment_name=item.model)
+        return await rag_client.get_response_with_rag(
+            item.query, top_k=item.top_k, search_mode=item.search_mode, filters=_search_filters(item)
+        )
+
+    def key(item: chat_schema.RagChatRequest) -> tuple:
+        filters = _search_filters(item)
+        return (
+            normalize_query(item.query),
+            str(item.search_mode),
+            item.top_k or 0,
+            item.model,
+            item.thread_id,
+            filters.cache_key() if filters else None,
+        )
+
+    outcomes = run_batch(request.items, run, key, request.concurrency or default_batch_concurrency())
+
+    if request.stream:
+
+        async def ndjson() -> AsyncIterator[str]:
+            async with aclosing(outcomes):
+                async for indices, outcome in outcomes:
+                    for index in indices:
+                        yield _batch_item(index, request.items[index], outcome).model_dump_json() + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson", headers=SSE_HEADERS)
+
+    results: list[Optional[chat_schema.RagChatBatchItem]] = [None] * len(request.items)
+    async with aclosing(outcomes):
+        async for indices, outcome in outcomes:
+            for index in indices:
+                results[index] = _batch_item(index, request.items[index], outcome)
+    with span("encode_response"):
+        body = chat_schema.RagChatBatchResponse(results=results).model_dump_json()
+    return Response(content=body, media_type="application/json")
+
+
+@router.post("/chat/stream")
+async def chat_stream(
+    request: chat_schema.RagChatRequest,
+    http_request: Request,
+    background_tasks: BackgroundTasks,
+    registry: RagClientRegistry = Depends(get_rag_client_registry),
+    token: Optional[TokenClaims] = Depends(get_optional_token),
+    db: AsyncSession = Depends(get_db),
+    message_writer: MessageWriter = Depends(get_message_writer),
+    memory: conversation_memory.ConversationMemory = Depends(conversation_memory.get_conversation_memory),
+):
+    """Server-Sent Events で応答を返す
+
+    `documents` イベントで検索結果を 1 度だけ送り、その後 `delta` イベントで応答の断片を順次送る。
+    最後に `done`（失敗時は `error`）イベントを送る。
+    thread_id を指定した場合は /chat と同じく会話履歴を使い、最後まで送れた応答だけをスレッドに保存する。
+    """
+
+    # 不正な model・スレッドはストリームを始める前に 400・404 で返す（DB もストリーム開始前にだけ使う）
+    rag_client = _get_client(registry, request.model)
+    conversation, history = await _thread_history(
+        request.thread_id, token, db, message_writer, memory, rag_client.deployment_name
+    )
+
+    async def event_stream() -> AsyncIterator[str]:
+        try:
+            documents = await rag_client.find_documents(
+                request.query,
+                top_k=request.top_k,
+                search_mode=request.search_mode,
+                filters=_search_filters(request),
+            )
+            context = rag_client.build_context(documents)
+            yield format_sse(
+                "documents",
+                {
+                    "query": request.query,
+                    "search_mode": request.search_mode,
+                    "documents": context.documents,
+                    "context_tokens": context.tokens,
+                },
+            )
+
+            deltas = rag_client.stream_response(
+                request.query, context, search_mode=request.search_mode, history=history
+            )
+            fragments = []
+            async with aclosing(deltas):
+                async for delta in deltas:
+                    if await http_request.is_disconnected():
+                        # aclosing を抜ける際に上流の completion もクローズされる
+                        logger.info("クライアントが切断したため応答のストリーミングを中断しました")
+                        return
+                    fragments.append(delta)
+                    yield format_sse("delta", {"content": delta})
+            if conversation is not None:
+                await _save_turn(
+                    request.thread_id, conversation, request.query, "".join(fragments), message_writer, memory
+                )
+                # 要約の更新はストリームを送り終えた後に行う
+                summarize = partial(rag_client.summarize_history, max_tokens=memory.summary_max_tokens)
+                background_tasks.add_task(memory.compact, conversation, summarize, rag_client.deployment_name)
+            yield format_sse("done", {})
+        except Exception as e:
+            yield format_sse("error", {"error": str(e)})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
@@ -10,13 +10,46 @@ class SearchMode(str, Enum):
     FULL = "full"
     HYBRID = "hybrid"
     SEMANTIC = "semantic"
+    # キーワード検索とベクトル検索を並行に実行し、アプリ側の RRF で統合する（セマンティックランカーを使わない）
+    FUSION = "fusion"
+
+
+class RagDocument(BaseModel):
+    content: Annotated[str, Field("", description="ドキュメントのチャンク本文")]
+    title: Annotated[str, Field("", description="ドキュメントのタイトル")]
+    score: Annotated[float, Field(0.0, description="検索スコア")]
+    locations: Annotated[list[str], Field(default_factory=list, description="チャンクに含まれる地名")]
+    parent_id: Annotated[Optional[str], Field(None, description="チャンクの親ドキュメントの識別子")]
+    chunk_id: Annotated[Optional[str], Field(None, description="チャンクの識別子")]
+    chunk_ids: Annotated[
+        Optional[list[str]],
+        Field(None, description="隣接チャンクをつなげた場合の元のチャンク識別子のリスト"),
+    ]
+
+
+class RagUsage(BaseModel):
+    context_tokens: Annotated[int, Field(0, description="プロンプトに含めたコンテキストのトークン数")]
+    prompt_tokens: Annotated[int, Field(0, description="プロンプト全体のトークン数")]
+    completion_tokens: Annotated[int, Field(0, description="生成された応答のトークン数")]
 
 
 class RagChatResponse(BaseModel):
     query: Annotated[str, Field(..., description="ユーザーからの問い合わせ内容")]
     response: Annotated[str, Field(..., description="RAGを経由した応答")]
-    documents: Annotated[list[str], Field(..., description="応答生成に使用されたドキュメントのリスト")]
+    documents: Annotated[list[RagDocument], Field(..., description="応答生成に使用されたドキュメントのリスト")]
     search_mode: Annotated[str, Field(..., description="サーチモード")]
+    usage: Annotated[Optional[RagUsage], Field(None, description="応答生成に使用したトークン数")]
+
+
+class RagSearchFilters(BaseModel):
+    locations: Annotated[
+        list[str],
+        Field(default_factory=list, max_length=50, description="いずれかの地名を含むチャンクに絞り込む"),
+    ]
+    boost_locations: Annotated[
+        list[str],
+        Field(default_factory=list, max_length=50, description="これらの地名を含むチャンクのスコアを上げる"),
+    ]
 
 
 class RagChatRequest(BaseModel):
@@ -24,6 +57,21 @@ class RagChatRequest(BaseModel):
     top_k: Annotated[Optional[int], Field(ge=1, le=50, description="取得するドキュメントの上位K件数")]
     search_mode: Annotated[Optional[SearchMode], Field(SearchMode.FULL, description="サーチモードの指定")]
     model: Annotated[str, Field("gpt-4o", description="使用する言語モデルの指定")]
+    filters: Annotated[
+        Optional[RagSearchFilters],
+        Field(None, description="検索の絞り込み・ブーストの条件（クエリに含まれる既知の地名は自動で加える）"),
+    ]
+    thread_id: Annotated[
+        Optional[str],
+        Field(
+            None,
+            description="指定した場合はこのチャットスレッドの会話履歴を踏まえて応答し、質問と応答を保存する（要認証）",
+        ),
+    ]
+
+
+class CreateThreadRequest(BaseModel):
+    title: Annotated[Optional[str], Field(None, max_length=255, description="チャットスレッドのタイトル")]
 
 
 class ChatMessage(BaseModel):
@@ -54,3 +102,38 @@ class ChatThread(BaseModel):
     # 属性からの読み取りを許可
     class Config:
         from_attributes = True
+
+
+class ThreadPage(BaseModel):
+    threads: Annotated[
+        list[ChatThread],
+        Field(..., description="チャットスレッドの一覧（新しい順、messages は含まない）"),
+    ]
+    next_cursor: Annotated[Optional[str], Field(None, description="次のページを取得するためのカーソル")]
+
+
+class MessagePage(BaseModel):
+    messages: Annotated[list[ChatMessage], Field(..., description="メッセージの一覧")]
+    next_cursor: Annotated[Optional[str], Field(None, description="次のページを取得するためのカーソル")]
+
+
+class RagChatBatchRequest(BaseModel):
+    items: Annotated[list[RagChatRequest], Field(..., min_length=1, max_length=100, description="問い合わせの一覧")]
+    concurrency: Annotated[
+        Optional[int],
+        Field(None, ge=1, le=32, description="同時に処理する件数の上限（省略時は CHAT_BATCH_CONCURRENCY）"),
+    ]
+    stream: Annotated[
+        bool,
+        Field(False, description="true の場合は終わった項目から 1 行ずつ NDJSON で返す（順不同、index で対応付ける）"),
+    ]
+
+
+class RagChatBatchItem(BaseModel):
+    index: Annotated[int, Field(..., description="items の中での位置")]
+    result: Annotated[Optional[RagChatResponse], Field(None, description="応答（失敗した場合は null）")]
+    error: Annotated[Optional[str], Field(None, description="失敗した場合のエラーメッセージ")]
+
+
+class RagChatBatchResponse(BaseModel):
+    results: Annotated[list[RagChatBatchItem], Field(..., description="items と同じ順序の結果")]
@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import unicodedata
+from typing import Awaitable, Callable, Hashable, Iterator, Optional, Protocol
+
+import numpy as np
+from back.api.utils.ttl_lru_cache import CacheStats, TTLLRUCache
+
+
+# (正規化済みクエリ, search_mode, top_k, deployment, index, リクエストで指定された検索条件)
+AnswerCacheKey = tuple[str, str, int, str, str, Hashable]
+
+
+def normalize_query(query: str) -> str:
+    # 全角・半角、大文字・小文字、空白、文末の句読点の違いを吸収する
+    text = unicodedata.normalize("NFKC", query).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?？。.!！ ")
+
+
+class CachedAnswer:
+    __slots__ = ("value", "embedding", "scope")
+
+    def __init__(self, value: dict, embedding: Optional[np.ndarray], scope: Hashable):
+        self.value = value
+        self.embedding = embedding
+        self.scope = scope
+
+
+def _sizeof_answer(entry: CachedAnswer) -> int:
+    size = len(json.dumps(entry.value, ensure_ascii=False, default=str).encode("utf-8"))
+    if entry.embedding is not None:
+        size += entry.embedding.nbytes
+    return size
+
+
+class AnswerCacheBackend(Protocol):
+    stats: CacheStats
+
+    def get(self, key: AnswerCacheKey) -> Optional[CachedAnswer]:
+        """キーのエントリを返す（無い・期限切れの場合は None）"""
+
+    def set(self, key: AnswerCacheKey, entry: CachedAnswer) -> None:
+        """エントリを保存する"""
+
+    def entries(self, scope: Hashable) -> Iterator[CachedAnswer]:
+        """類似検索の対象になる、同じ scope のエントリを返す"""
+
+    def clear(self) -> None:
+        """全エントリを削除する"""
+
+
+class InMemoryAnswerCacheBackend:
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self._cache: TTLLRUCache[CachedAnswer] = TTLLRUCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            ttl=ttl,
+            sizeof=_sizeof_answer,
+        )
+        self.stats = self._cache.stats
+
+    def get(self, key: AnswerCacheKey) -> Optional[CachedAnswer]:
+        return self._cache.get(key)
+
+    def set(self, key: AnswerCacheKey, entry: CachedAnswer) -> None:
+        self._cache.set(key, entry)
+
+    def entries(self, scope: Hashable) -> Iterator[CachedAnswer]:
+        return (entry for _, entry in self._cache.items() if entry.scope == scope)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+class AnswerCache:
+    """RAG の応答（検索結果 + 生成結果）をキャッシュする
+
+    similarity_threshold を指定すると、完全一致しない場合でもクエリの埋め込みのコサイン類似度が
+    閾値以上のエントリをヒットとして扱う。類似度の比較は search_mode・top_k・deployment・index・検索条件が同じ範囲に限る。
+    """
+
+    def __init__(self, backend: AnswerCacheBackend, similarity_threshold: Optional[float] = None):
+        self.backend = backend
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["AnswerCache"]:
+        if os.getenv("ANSWER_CACHE_ENABLED", "true").lower() != "true":
+            return None
+        max_bytes = os.getenv("ANSWER_CACHE_MAX_BYTES")
+        threshold = os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD")
+        backend = InMemoryAnswerCacheBackend(
+            max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024")),
+            max_bytes=int(max_bytes) if max_bytes else 64 * 1024 * 1024,
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "600")),
+        )
+        return cls(backend, similarity_threshold=float(threshold) if threshold else None)
+
+    @property
+    def similarity_enabled(self) -> bool:
+        return self.similarity_threshold is not None
+
+    @staticmethod
+    def make_key(
+        query: str,
+        search_mode: str,
+        top_k: Optional[int],
+        deployment_name: str,
+        index_name: str,
+        filters: Hashable = None,
+    ) -> AnswerCacheKey:
+        return (normalize_query(query), str(search_mode), top_k or 0, deployment_name, index_name, filters)
+
+    async def lookup(
+        self,
+        key: AnswerCacheKey,
+        embed: Optional[Callable[[], Awaitable[np.ndarray]]] = None,
+    ) -> tuple[Optional[dict], Optional[np.ndarray]]:
+        """キャッシュを引き、(応答, クエリの埋め込み) を返す
+
+        埋め込みは完全一致しなかった場合にのみ計算し、呼び出し側が set() でそのまま再利用できるように返す。
+        """
+        entry = self.backend.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry.value, entry.embedding
+
+        embedding = None
+        if self.similarity_enabled and embed is not None:
+            embedding = await embed()
+            entry = self._find_similar(key[1:], embedding)
+            if entry is not None:
+                self.similar_hits += 1
+                return entry.value, embedding
+
+        self.misses += 1
+        return None, embedding
+
+    def set(self, key: AnswerCacheKey, value: dict, embedding: Optional[np.ndarray] = None) -> None:
+        self.backend.set(key, CachedAnswer(value, embedding, key[1:]))
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "evictions": self.backend.stats.evictions,
+            "expirations": self.backend.stats.expirations,
+        }
+
+    def _find_similar(self, scope: Hashable, embedding: np.ndarray) -> Optional[CachedAnswer]:
+        candidates = [entry for entry in self.backend.entries(scope) if entry.embedding is not None]
+        if not candidates:
+            return None
+
+        matrix = np.stack([entry.embedding for entry in candidates])
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(embedding)
+        similarities = (matrix @ embedding) / np.maximum(norms, 1e-12)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            return candidates[best]
+        return None
@@ -0,0 +1,546 @@
+import asyncio
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+import httpx
+import numpy as np
+from back.api.services import rate_limiter, search_backend as search
+from back.api.services.answer_cache import AnswerCache, normalize_query
+from back.api.services.context_builder import BuiltContext
+from back.api.services.embedding_cache import EmbeddingCache
+from back.api.services.query_filters import QueryAnalyzer, SearchFilters
+from back.api.services.rag_client import FALLBACK_RESPONSE, BaseRagClient
+from back.api.services.rank_fusion import fuse_search_results
+from back.api.services.reranker import Reranker
+from back.api.services.retrieval_cache import RetrievalCache
+from back.api.services.single_flight import SingleFlight
+from back.api.utils.logging import logger
+from back.api.utils.metrics import LLM_TOKENS
+from back.api.utils.timing import span
+from openai import AsyncAzureOpenAI
+
+
+class AsyncRagClient(BaseRagClient):
+    """SearchBackend と AsyncAzureOpenAI を使う非同期版の RagClient
+
+    search_backend を省略すると Azure AI Search（azure.search.documents.aio）を使う。
+    その場合はイベントループ上で生成すること（aiohttp のセッションがループに紐づくため）。
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        answer_cache: Optional[AnswerCache] = None,
+        retrieval_cache: Optional[RetrievalCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_backend: Optional[search.SearchBackend] = None,
+        single_flight: Optional[SingleFlight] = None,
+        rate_limiters: Optional[rate_limiter.RateLimiters] = None,
+        reranker: Optional[Reranker] = None,
+        diversifier: Optional[Reranker] = None,
+        query_analyzer: Optional[QueryAnalyzer] = None,
+        **kwargs: Any,
+    ):
+        # 外から渡されたバックエンドは共有されている前提で、このクライアントではクローズしない
+        self.search_backend = search_backend
+        self._owns_search_backend = search_backend is None
+        self.answer_cache = answer_cache
+        self.retrieval_cache = retrieval_cache
+        self.embedding_cache = embedding_cache
+        self.single_flight = single_flight
+        self.rate_limiters = rate_limiters if rate_limiters is not None else rate_limiter.RateLimiters()
+        self.reranker = reranker
+        self.diversifier = diversifier
+        self.query_analyzer = query_analyzer
+        # fusion モードでキーワード検索・ベクトル検索それぞれから取る候補数と、RRF の重み・定数
+        self.fusion_candidates = int(os.getenv("FUSION_CANDIDATES", "20"))
+        self.fusion_weights = (
+            float(os.getenv("FUSION_KEYWORD_WEIGHT", "1.0")),
+            float(os.getenv("FUSION_VECTOR_WEIGHT", "1.0")),
+        )
+        self.fusion_rrf_k = int(os.getenv("FUSION_RRF_K", "60"))
+        super().__init__(*args, **kwargs)
+
+    def _required_settings(self) -> dict[str, Optional[str]]:
+        settings = super()._required_settings()
+        if self.search_backend is not None:
+            # Azure AI Search の接続情報は不要
+            for name in ("search_endpoint", "search_api_key", "search_index_name"):
+                settings.pop(name)
+        return settings
+
+    def _init_cients(self) -> None:
+        if self.search_backend is None:
+            self.search_backend = search.AzureSearchBackend(
+                endpoint=self.search_endpoint,
+                index_name=self.search_index_name,
+                api_key=self.search_api_key,
+                pool_config=self.pool_config,
+            )
+
+        self._http_client = httpx.AsyncClient(
+            limits=self.pool_config.httpx_limits(),
+            timeout=self.pool_config.timeout,
+        )
+        self.openai_client = AsyncAzureOpenAI(
+            azure_endpoint=self.openai_endpoint,
+            api_key=self.openai_api_key,
+            api_version=self.api_version,
+            http_client=self._http_client,
+            # リトライは RateLimiter と合わせて _call_openai で行う
+            max_retries=0,
+        )
+
+    async def aclose(self) -> None:
+        if self._owns_search_backend:
+            await self.search_backend.aclose()
+        await self.openai_client.close()
+        await self._http_client.aclose()
+
+    def _estimate_tokens(self, messages: list[dict]) -> int:
+        # メッセージごとのロールや区切りの分としておよそ 4 トークンを足す
+        counter = self.context_builder.token_counter
+        return sum(counter.count(message["content"], self.deployment_name) + 4 for message in messages)
+
+    async def _call_openai(self, deployment_name: str, tokens: int, create: Callable[[], Awaitable[Any]]) -> Any:
+        """デプロイメントのレート制限の枠を取ってから呼び出し、429・一時的なエラーはリトライする
+
+        create には with_raw_response の呼び出しを渡す。レスポンスヘッダーの残り枠をリミッターに反映してから中身を返す。
+        """
+        limiter = self.rate_limiters.openai(deployment_name)
+
+        async def call() -> Any:
+            raw = await create()
+            limiter.observe_headers(raw.headers)
+            return raw.parse()
+
+        response = await rate_limiter.call_with_retries(
+            limiter, self.rate_limiters.retry_policy, call, rate_limiter.classify_openai_error, tokens=tokens
+        )
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            limiter.settle(tokens, usage.total_tokens)
+        return response
+
+    async def _create_chat_completion(
+        self, messages: list[dict], max_tokens: int, tokens: Optional[int] = None, **kwargs: Any
+    ) -> Any:
+        # TPM はプロンプトと max_tokens の合計で数えられる
+        return await self._call_openai(
+            self.deployment_name,
+            tokens if tokens is not None else self._estimate_tokens(messages) + max_tokens,
+            lambda: self.openai_client.chat.completions.with_raw_response.create(
+                model=self.deployment_name, messages=messages, max_tokens=max_tokens, **kwargs
+            ),
+        )
+
+    async def embed_query(self, query: str) -> np.ndarray:
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get(self.embedding_deployment_name, query)
+            if cached is not None:
+                return cached
+
+        with span("embed_query"):
+            response = await self._call_openai(
+                self.embedding_deployment_name,
+                self.context_builder.token_counter.count(query, self.embedding_deployment_name),
+                lambda: self.openai_client.embeddings.with_raw_response.create(
+                    model=self.embedding_deployment_name, input=query
+                ),
+            )
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        if self.embedding_cache is not None:
+            self.embedding_cache.set(self.embedding_deployment_name, query, vector)
+        return vector
+
+    async def find_documents(
+        self,
+        query: str,
+        top_k: int = 3,
+        search_mode: str = "full",
+        vector: Optional[np.ndarray] = None,
+        filters: Optional[SearchFilters] = None,
+    ) -> list:
+        """filters にはリクエストで指定された条件を渡す。クエリから見つけた地名はここで加える"""
+        filters = self.query_analyzer.analyze(query, filters) if self.query_analyzer is not None else filters
+        cache_key = None
+        if self.retrieval_cache is not None:
+            cache_key = self.retrieval_cache.make_key(
+                self.search_index_name,
+                query,
+                search_mode,
+                top_k,
+                options={
+                    "select": self.select_fields,
+                    "highlight": self.return_highlights,
+                    **({"filters": filters.cache_key()} if filters else {}),
+                    **(self._fusion_options() if search_mode == search.FUSION_SEARCH_MODE else {}),
+                    **{name: value for stage in self._rank_stages() for name, value in stage.options().items()},
+                },
+            )
+            cached = self.retrieval_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        # 並べ直す場合は top_k より大きな候補を取得する
+        stages = self._rank_stages()
+        candidates = max([top_k or 0, *(stage.candidate_pool for stage in stages)]) if stages else top_k
+        needs_query_vector = any(stage.needs_query_vector for stage in stages)
+        if needs_query_vector or search_mode in (*search.VECTOR_SEARCH_MODES, search.FUSION_SEARCH_MODE):
+            # インデックスが独自の埋め込み（LocalSearchBackend の HashingEmbedder など）で作られている場合は、
+            # 渡されたベクトルや Azure OpenAI の埋め込みではなく同じ埋め込みを検索・並べ直しに使う
+            backend_vector = self.search_backend.embed_query(query)
+            if backend_vector is not None:
+                vector = backend_vector
+        pending_vector = None
+        try:
+            if needs_query_vector and vector is None and not self._embeds_for_search(search_mode):
+                # 検索のために埋め込みを計算しないモードでは、並べ直し用の埋め込みを検索と並行して計算する
+                pending_vector = asyncio.ensure_future(self.embed_query(query))
+            search_results, vector = await self._retrieve(query, candidates, search_mode, vector, filters)
+            if not search_results and filters is not None and filters.derived:
+                # クエリから推定した地名で絞り込みすぎた場合は、絞り込みを外して検索し直す
+                logger.info("絞り込み %s の検索結果が空のため、絞り込みを外して検索し直します", filters.locations)
+                search_results, vector = await self._retrieve(
+                    query, candidates, search_mode, vector, filters.without_filter()
+                )
+
+            # 検索結果の処理
+            documents = [self._to_document(result) for result in search_results]
+            if stages:
+                if needs_query_vector and vector is None:
+                    vector = await self._rerank_query_vector(query, pending_vector)
+                needs_vectors = any(stage.needs_vectors for stage in stages)
+                chunk_vectors = await self._chunk_vectors(documents) if needs_vectors else None
+                documents = self._rerank(stages, query, top_k, documents, chunk_vectors, vector)
+
+        except rate_limiter.RateLimitExceededError:
+            raise
+        except Exception as e:
+            logger.error(f"検索エラーの詳細: {str(e)}")
+            raise search.SearchError(f"ドキュメント検索中にエラーが発生しました: {e}") from e
+        finally:
+            if pending_vector is not None and not pending_vector.done():
+                pending_vector.cancel()
+
+        if cache_key is not None:
+            self.retrieval_cache.set(cache_key, documents)
+        return documents
+
+    async def _retrieve(
+        self,
+        query: str,
+        top_k: int,
+        search_mode: str,
+        vector: Optional[np.ndarray],
+        filters: Optional[SearchFilters],
+    ) -> tuple[list[dict], Optional[np.ndarray]]:
+        """検索結果と、検索のために計算したクエリの埋め込みを返す"""
+        if search_mode == search.FUSION_SEARCH_MODE:
+            with span("find_documents"):
+                return await self._fusion_search(query, top_k, vector, filters), vector
+
+        # ベクトル検索を伴うモードでは、同じクエリの埋め込みを 1 度だけ計算して使い回す
+        if vector is None and self._embeds_for_search(search_mode):
+            vector = await self.embed_query(query)
+        search_query = self._search_query(query, top_k, search_mode, vector=vector, filters=filters)
+        with span("find_documents"):
+            return await self._search(search_query), vector
+
+    def _embeds_for_search(self, search_mode: str) -> bool:
+        """client モードでクエリの埋め込みを検索のために計算するか"""
+        return self.uses_client_side_embedding and search_mode in ("hybrid", "semantic", search.FUSION_SEARCH_MODE)
+
+    def _rank_stages(self) -> list[Reranker]:
+        # 並べ直してから、その上位から MMR で選ぶ
+        return [stage for stage in (self.reranker, self.diversifier) if stage is not None]
+
+    async def _rerank_query_vector(
+        self, query: str, pending_vector: Optional["asyncio.Future[np.ndarray]"]
+    ) -> Optional[np.ndarray]:
+        try:
+            # client モードでは検索時に計算した埋め込みがキャッシュにある
+            return await pending_vector if pending_vector is not None else await self.embed_query(query)
+        except rate_limiter.RateLimitExceededError:
+            raise
+        except Exception as e:
+            logger.warning("並べ直し用の埋め込みを取得できませんでした %s", e)
+            return None
+
+    async def _chunk_vectors(self, documents: list[dict]) -> list[Optional[np.ndarray]]:
+        """並べ直しに使うチャンクのベクトルを chunk_id で引く
+
+        埋め込みキャッシュにあるものはそれを使い、無いものだけをまとめて検索バックエンドから取得してキャッシュする。
+        検索結果には text_vector を含めないので、候補すべてのベクトルを毎回ダウンロードすることはない。
+        """
+        chunk_ids = [doc.get("chunk_id") for doc in documents]
+        # インデックスが更新されると同じ chunk_id でもベクトルが変わるので、検索結果キャッシュの世代をキーに含める
+        generation = self.retrieval_cache.generation_tag(self.search_index_name) if self.retrieval_cache else ""
+        cache_model = f"{self.search_index_name}:{generation}:{search.VECTOR_FIELD}"
+        vectors: dict[str, np.ndarray] = {}
+        if self.embedding_cache is not None:
+            for chunk_id in filter(None, chunk_ids):
+                cached = self.embedding_cache.get(cache_model, chunk_id)
+                if cached is not None:
+                    vectors[chunk_id] = cached
+        missing = [chunk_id for chunk_id in dict.fromkeys(filter(None, chunk_ids)) if chunk_id not in vectors]
+        if missing:
+            try:
+                with span("fetch_chunk_vectors"):
+                    results = await rate_limiter.call_with_retries(
+                        self.rate_limiters.search(self.search_index_name or ""),
+                        self.rate_limiters.retry_policy,
+                        lambda: self.search_backend.lookup(missing, [search.VECTOR_FIELD]),
+                        rate_limiter.classify_azure_error,
+                    )
+            except rate_limiter.RateLimitExceededError:
+                raise
+            except Exception as e:
+                # ベクトルが揃わない場合、各段階はベクトルを使わずに並べ直す
+                logger.warning("並べ直し用のチャンクのベクトルを取得できませんでした %s", e)
+                results = []
+            for result in results:
+                if result.get(search.VECTOR_FIELD) is None:
+                    continue
+                vector = np.asarray(result[search.VECTOR_FIELD], dtype=np.float32)
+                vectors[result[search.CHUNK_ID_FIELD]] = vector
+                if self.embedding_cache is not None:
+                    self.embedding_cache.set(cache_model, result[search.CHUNK_ID_FIELD], vector)
+        return [vectors.get(chunk_id) if chunk_id else None for chunk_id in chunk_ids]
+
+    def _rerank(
+        self,
+        stages: list[Reranker],
+        query: str,
+        top_k: int,
+        documents: list[dict],
+        chunk_vectors: Optional[list[Optional[np.ndarray]]],
+        vector: Optional[np.ndarray],
+    ) -> list[dict]:
+        """候補を各段階で並べ直して top_k 件に絞る。途中の段階は次の段階の候補数だけ残す"""
+        # ドキュメントの順序が変わってもベクトルを引けるよう、並べ直しの間だけドキュメントに持たせる
+        chunk_vectors = chunk_vectors if chunk_vectors is not None else [None] * len(documents)
+        documents = [{**doc, search.VECTOR_FIELD: chunk_vector} for doc, chunk_vector in zip(documents, chunk_vectors)]
+        for i, stage in enumerate(stages):
+            keep = max(top_k or 0, stages[i + 1].candidate_pool) if i + 1 < len(stages) else top_k
+            vectors = [doc[search.VECTOR_FIELD] for doc in documents] if stage.needs_vectors else None
+            with span(stage.name):
+                documents = stage.rerank(query, documents, keep, query_vector=vector, vectors=vectors)
+        return [{key: value for key, value in doc.items() if key != search.VECTOR_FIELD} for doc in documents]
+
+    async def _search(self, search_query: search.SearchQuery) -> list[dict]:
+        return await rate_limiter.call_with_retries(
+            self.rate_limiters.search(self.search_index_name or ""),
+            self.rate_limiters.retry_policy,
+            lambda: self.search_backend.search(search_query),
+            rate_limiter.classify_azure_error,
+        )
+
+    async def _fusion_search(
+        self,
+        query: str,
+        top_k: int,
+        vector: Optional[np.ndarray],
+        filters: Optional[SearchFilters] = None,
+    ) -> list[dict]:
+        """キーワード検索とベクトル検索を並行に実行し、結果をこちらで RRF により統合する
+
+        セマンティックランカーを通さない分、semantic モードより速い。client モードでは埋め込みの計算を
+        キーワード検索と重ねるので、ベクトル側の待ち時間は 埋め込み + 検索 になる。
+        """
+        pool = max(top_k or 0, self.fusion_candidates)
+
+        async def vector_leg() -> list[dict]:
+            query_vector = vector
+            if query_vector is None and self.uses_client_side_embedding:
+                query_vector = await self.embed_query(query)
+            return await self._search(
+                self._search_query(query, pool, search.VECTOR_SEARCH_MODE, vector=query_vector, filters=filters)
+            )
+
+        keyword_results, vector_results = await asyncio.gather(
+            self._search(self._search_query(query, pool, search.KEYWORD_SEARCH_MODE, filters=filters)),
+            vector_leg(),
+        )
+        fused = fuse_search_results([keyword_results, vector_results], weights=self.fusion_weights, k=self.fusion_rrf_k)
+        return fused[:top_k] if top_k else fused
+
+    def _fusion_options(self) -> dict[str, Any]:
+        return {"fusion": [self.fusion_candidates, *self.fusion_weights, self.fusion_rrf_k]}
+
+    async def create_response(self, query: str, documents: list, search_mode: str = "full") -> str:
+        response, _ = await self.generate_answer(query, self.build_context(documents), search_mode=search_mode)
+        return response
+
+    async def generate_answer(
+        self,
+        query: str,
+        context: BuiltContext,
+        search_mode: str = "full",
+        history: Optional[list[dict]] = None,
+    ) -> tuple[str, dict]:
+        """組み立て済みのコンテキストから応答を生成し、(応答, トークン使用量) を返す"""
+        usage = {"context_tokens": context.tokens, "prompt_tokens": 0, "completion_tokens": 0}
+        try:
+            # FIXME: 必要ならResponse API形式に変更
+            with span("create_response"):
+                response = await self._create_chat_completion(
+                    self._build_messages(query, context.text, history),
+                    max_tokens=1024,
+                    temperature=self._temperature(search_mode),
+                )
+            if response.usage is not None:
+                usage["prompt_tokens"] = response.usage.prompt_tokens
+                usage["completion_tokens"] = response.usage.completion_tokens
+                self._record_usage(response.usage)
+            return response.choices[0].message.content, usage
+        except rate_limiter.RateLimitExceededError:
+            # 定型文で応答したことにせず、呼び出し側で 429 として扱えるようにする
+            raise
+        except Exception as e:
+            logger.error(f"応答生成中にエラーが発生しました: {e}")
+            return FALLBACK_RESPONSE, usage
+
+    async def summarize_history(self, summary: str, turns: list[tuple[str, str]], max_tokens: int = 500) -> str:
+        """これまでの要約に古いターンを畳み込んだ新しい要約を返す（失敗時は例外をそのまま投げる）"""
+        with span("summarize_history"):
+            response = await self._create_chat_completion(
+                self._build_summary_messages(summary, turns),
+                max_tokens=max_tokens,
+                temperature=0.2,
+            )
+        if response.usage is not None:
+            self._record_usage(response.usage)
+        return response.choices[0].message.content or ""
+
+    def _record_usage(self, usage: Any) -> None:
+        LLM_TOKENS.inc(usage.prompt_tokens, deployment=self.deployment_name, kind="prompt")
+        LLM_TOKENS.inc(usage.completion_tokens, deployment=self.deployment_name, kind="completion")
+
+    async def stream_response(
+        self,
+        query: str,
+        context: BuiltContext,
+        search_mode: str = "full",
+        history: Optional[list[dict]] = None,
+    ) -> AsyncIterator[str]:
+        """応答をトークンの断片ごとに返す
+
+        呼び出し側がジェネレーターを閉じる（クライアント切断・キャンセル）と、上流の completion も閉じる。
+        ストリームのレスポンスには usage が無いので、最後のチャンクの usage でレート制限の見積もりを精算する。
+        """
+        messages = self._build_messages(query, context.text, history)
+        prompt_tokens = self._estimate_tokens(messages)
+        max_tokens = 1024
+        stream = None
+        usage = None
+        fragments = 0
+        with span("create_response"):
+            try:
+                stream = await self._create_chat_completion(
+                    messages,
+                    max_tokens=max_tokens,
+                    tokens=prompt_tokens + max_tokens,
+                    temperature=self._temperature(search_mode),
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                async for chunk in stream:
+                    # include_usage を指定すると、最後に choices が空で usage だけを含むチャンクが届く
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                    # Azure はコンテンツフィルタの結果だけを含む choices が空のチャンクを返すことがある
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        fragments += 1
+                        yield delta
+            except rate_limiter.RateLimitExceededError:
+                raise
+            except Exception as e:
+                logger.error(f"応答のストリーミング中にエラーが発生しました: {e}")
+                if not fragments:
+                    yield FALLBACK_RESPONSE
+            finally:
+                if stream is not None:
+                    await stream.close()
+                    # usage が届く前に閉じた場合（切断・エラー）は、返した断片 1 つを 1 トークンとみなして精算する
+                    actual_tokens = usage.total_tokens if usage is not None else prompt_tokens + fragments
+                    self.rate_limiters.openai(self.deployment_name).settle(prompt_tokens + max_tokens, actual_tokens)
+                    if usage is not None:
+                        self._record_usage(usage)
+
+    async def get_response_with_rag(
+        self,
+        query: str,
+        top_k: int = 3,
+        search_mode: str = "full",
+        history: Optional[list[dict]] = None,
+        filters: Optional[SearchFilters] = None,
+    ) -> dict:
+        """history を渡した場合（会話の途中）は応答が履歴に依存するため、応答キャッシュも合流も使わない
+
+        同じ (正規化したクエリ, search_mode, top_k, deployment, index, filters) の処理が実行中であれば、
+        その結果を待って使う。
+        """
+        if self.single_flight is None or history:
+            return await self._get_response_with_rag(query, top_k, search_mode, history, filters)
+
+        key = (
+            normalize_query(query),
+            str(search_mode),
+            top_k or 0,
+            self.deployment_name,
+            self.search_index_name,
+            filters.cache_key() if filters else None,
+        )
+        result = await self.single_flight.do(
+            key, lambda: self._get_response_with_rag(query, top_k, search_mode, history, filters)
+        )
+        # 正規化前のクエリは呼び出し元ごとに違うことがある
+        return {**result, "query": query}
+
+    async def _get_response_with_rag(
+        self,
+        query: str,
+        top_k: int,
+        search_mode: str,
+        history: Optional[list[dict]],
+        filters: Optional[SearchFilters] = None,
+    ) -> dict:
+        cache_key = None
+        embedding = None
+        if self.answer_cache is not None and not history:
+            cache_key = self.answer_cache.make_key(
+                query,
+                search_mode,
+                top_k,
+                self.deployment_name,
+                self.search_index_name,
+                filters=filters.cache_key() if filters else None,
+            )
+            cached, embedding = await self.answer_cache.lookup(cache_key, embed=lambda: self.embed_query(query))
+            if cached is not None:
+                return {**cached, "query": query}
+
+        # service モードでは検索側のベクトライザーに任せる（類似キャッシュ用の埋め込みとは空間が違う場合がある）
+        vector = embedding if self.uses_client_side_embedding else None
+        documents = await self.find_documents(
+            query, top_k=top_k, search_mode=search_mode, vector=vector, filters=filters
+        )
+        with span("build_context"):
+            context = self.build_context(documents)
+        response, usage = await self.generate_answer(query, context, search_mode=search_mode, history=history)
+        result = {
+            "query": query,
+            "response": response,
+            # トークン予算・関連度で除外されたものを除き、実際にプロンプトに入れたドキュメントだけを返す
+            "documents": context.documents,
+            "search_mode": search_mode,
+            "usage": usage,
+        }
+        # 応答生成に失敗した場合の定型文はキャッシュしない
+        if cache_key is not None and response != FALLBACK_RESPONSE:
+            self.answer_cache.set(cache_key, result, embedding)
+        return result
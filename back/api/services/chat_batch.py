@@ -0,0 +1,46 @@
+import asyncio
+import os
+from typing import AsyncIterator, Awaitable, Callable, Hashable, TypeVar, Union
+
+
+T = TypeVar("T")
+
+# 成功時は get_response_with_rag の結果、失敗時はその例外
+BatchOutcome = Union[dict, Exception]
+
+
+def default_batch_concurrency() -> int:
+    return int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+
+
+async def run_batch(
+    items: list[T],
+    run: Callable[[T], Awaitable[dict]],
+    key: Callable[[T], Hashable],
+    concurrency: int,
+) -> AsyncIterator[tuple[list[int], BatchOutcome]]:
+    """バッチの各項目を最大 concurrency 件ずつ並行に実行し、終わった順に (入力の位置, 結果) を返す
+
+    key が同じ項目は 1 回だけ実行し、その位置をまとめて返す。
+    途中でジェネレーターが閉じられた（クライアントが切断した）場合は、残りの処理をキャンセルする。
+    """
+    groups: dict[Hashable, list[int]] = {}
+    for index, item in enumerate(items):
+        groups.setdefault(key(item), []).append(index)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_group(indices: list[int]) -> tuple[list[int], BatchOutcome]:
+        async with semaphore:
+            try:
+                return indices, await run(items[indices[0]])
+            except Exception as e:
+                return indices, e
+
+    tasks = [asyncio.ensure_future(run_group(indices)) for indices in groups.values()]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,104 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Optional
+
+from back.api.models.models import Message, Thread
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import noload
+
+
+def encode_cursor(timestamp: datetime, row_id: str) -> str:
+    payload = json.dumps([timestamp.isoformat(), row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    """不正なカーソルは ValueError にする"""
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(timestamp), str(row_id)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"不正なカーソルです: {cursor}") from e
+
+
+class ChatRepository:
+    """Thread / Message の永続化
+
+    コミットは呼び出し側に任せず、書き込みメソッドの中で行う。
+    一覧はオフセットではなく (時刻, id) のキーセットでページングする。
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def create_thread(self, user_id: str, title: Optional[str] = None) -> Thread:
+        # 作成直後のスレッドはメッセージが空と分かっているので、遅延ロードさせない
+        thread = Thread(user_id=user_id, messages=[])
+        if title:
+            thread.title = title
+        self.session.add(thread)
+        await self.session.commit()
+        return thread
+
+    async def get_thread(self, thread_id: str, user_id: str) -> Optional[Thread]:
+        """他のユーザーのスレッドは存在しないものとして扱う
+
+        メッセージは読み込まない（空のリストになる）。メッセージは list_messages でページングして取得する。
+        """
+        statement = (
+            select(Thread).where(Thread.id == thread_id, Thread.user_id == user_id).options(noload(Thread.messages))
+        )
+        return (await self.session.execute(statement)).scalar_one_or_none()
+
+    async def list_threads(
+        self, user_id: str, limit: int, cursor: Optional[str] = None
+    ) -> tuple[list[Thread], Optional[str]]:
+        """新しい順にスレッドを返す（メッセージは読み込まない）"""
+        statement = select(Thread).where(Thread.user_id == user_id).options(noload(Thread.messages))
+        if cursor is not None:
+            created_at, thread_id = decode_cursor(cursor)
+            statement = statement.where(tuple_(Thread.created_at, Thread.id) < tuple_(created_at, thread_id))
+        statement = statement.order_by(Thread.created_at.desc(), Thread.id.desc()).limit(limit + 1)
+        threads = list((await self.session.execute(statement)).scalars())
+        return self._page(threads, limit, lambda thread: encode_cursor(thread.created_at, thread.id))
+
+    async def list_messages(
+        self, thread_id: str, limit: int, cursor: Optional[str] = None, descending: bool = False
+    ) -> tuple[list[Message], Optional[str]]:
+        """スレッドのメッセージを時刻順（descending なら新しい順）に返す"""
+        statement = select(Message).where(Message.thread_id == thread_id)
+        key = tuple_(Message.timestamp, Message.id)
+        if cursor is not None:
+            timestamp, message_id = decode_cursor(cursor)
+            position = tuple_(timestamp, message_id)
+            statement = statement.where(key < position if descending else key > position)
+        if descending:
+            statement = statement.order_by(Message.timestamp.desc(), Message.id.desc())
+        else:
+            statement = statement.order_by(Message.timestamp, Message.id)
+        messages = list((await self.session.execute(statement.limit(limit + 1))).scalars())
+        return self._page(messages, limit, lambda message: encode_cursor(message.timestamp, message.id))
+
+    @staticmethod
+    def _page(rows: list, limit: int, cursor_of: Callable[[Any], str]) -> tuple[list, Optional[str]]:
+        # limit + 1 件取得して、次のページがあるかを判定する
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, cursor_of(rows[-1])
+
+    async def add_messages(self, thread_id: str, messages: list[tuple[str, str]]) -> list[Message]:
+        """(送信者, 本文) のリストを 1 トランザクションで追加する
+
+        (timestamp, id) の順が送信順になるよう、時刻を 1 マイクロ秒ずつずらす。
+        """
+        now = datetime.now(tz=timezone.utc)
+        rows = [
+            Message(thread_id=thread_id, sender=sender, text=text, timestamp=now + timedelta(microseconds=i))
+            for i, (sender, text) in enumerate(messages)
+        ]
+        self.session.add_all(rows)
+        await self.session.commit()
+        return rows
@@ -0,0 +1,92 @@
+import math
+import re
+from typing import Optional
+
+from back.api.services.text_splitter import PAGE_OVERLAP_LENGTH
+
+
+# インデックスプロジェクションの chunk_id は "{ハッシュ}_{parent_id}_pages_{ページ番号}" の形式
+_PAGE_NUMBER_PATTERN = re.compile(r"_pages_(\d+)$")
+
+
+def page_number(chunk_id: Optional[str]) -> Optional[int]:
+    if not chunk_id:
+        return None
+    match = _PAGE_NUMBER_PATTERN.search(chunk_id)
+    return int(match.group(1)) if match else None
+
+
+# 重複とみなす最短の長さ（max_overlap に対する割合）。数文字の一致は偶然の一致として扱う
+MIN_OVERLAP_RATIO = 0.5
+
+
+def overlap_length(
+    previous: str,
+    following: str,
+    max_overlap: int = PAGE_OVERLAP_LENGTH,
+    min_overlap_ratio: float = MIN_OVERLAP_RATIO,
+) -> int:
+    """previous の末尾と following の先頭で重複している文字数を返す
+
+    max_overlap * min_overlap_ratio 文字より短い一致は重複とみなさず 0 を返す。
+    """
+    # SplitSkill の重複は通常ちょうど max_overlap 文字なので、まずはその長さを確認する
+    if len(previous) >= max_overlap and previous.endswith(following[:max_overlap]):
+        return min(max_overlap, len(following))
+    min_overlap = max(1, math.ceil(max_overlap * min_overlap_ratio))
+    for length in range(min(max_overlap, len(previous), len(following)), min_overlap - 1, -1):
+        if previous.endswith(following[:length]):
+            return length
+    return 0
+
+
+def merge_adjacent_chunks(documents: list, max_overlap: int = PAGE_OVERLAP_LENGTH) -> list:
+    """同じ親ドキュメントの連続するチャンクを 1 つのパッセージにつなげ、重複部分を取り除く
+
+    ページ番号が連続していないチャンクや parent_id / chunk_id を持たないチャンクはそのまま残す。
+    結果はパッセージ内の最大スコアの降順に並べる。
+    """
+    groups: dict[str, list[tuple[int, dict]]] = {}
+    passages: list[dict] = []
+    for doc in documents:
+        number = page_number(doc.get("chunk_id"))
+        parent_id = doc.get("parent_id")
+        if parent_id is None or number is None:
+            passages.append(doc)
+            continue
+        groups.setdefault(parent_id, []).append((number, doc))
+
+    for chunks in groups.values():
+        chunks.sort(key=lambda pair: pair[0])
+        run = [chunks[0]]
+        for number, doc in chunks[1:]:
+            if number == run[-1][0] + 1:
+                run.append((number, doc))
+                continue
+            passages.append(_merge_run(run, max_overlap))
+            run = [(number, doc)]
+        passages.append(_merge_run(run, max_overlap))
+
+    return sorted(passages, key=lambda doc: doc.get("score") or 0.0, reverse=True)
+
+
+def _merge_run(run: list[tuple[int, dict]], max_overlap: int) -> dict:
+    if len(run) == 1:
+        return run[0][1]
+
+    first = run[0][1]
+    content = first.get("content", "")
+    locations = list(first.get("locations") or [])
+    for _, doc in run[1:]:
+        following = doc.get("content", "")
+        overlap = overlap_length(content, following, max_overlap)
+        content += following[overlap:]
+        locations.extend(location for location in doc.get("locations") or [] if location not in locations)
+
+    return {
+        **first,
+        "content": content,
+        "score": max(doc.get("score") or 0.0 for _, doc in run),
+        "locations": locations,
+        "chunk_ids": [doc.get("chunk_id") for _, doc in run],
+    }
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import threading
+from typing import Any, Iterable, Optional
+
+from back.api.utils.logging import logger
+
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken が無い環境では概算で数える
+    tiktoken = None
+
+
+# ドキュメント間の区切り
+CONTEXT_SEPARATOR = "\n---\n"
+
+
+class TokenCounter:
+    """デプロイメント（モデル）ごとのトークン数を数える
+
+    tiktoken が使えない場合（未インストール・エンコーディングを取得できない）は文字種から概算する。
+    エンコーディングの読み込みはファイルのダウンロードを伴うことがあるので、起動時に preload で読み込んでおく。
+    """
+
+    # モデル名 → エンコーディング（読み込めなかった場合は None）。読み込みは 1 度だけにするため全インスタンスで共有する
+    _encodings: dict[str, Any] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    async def preload(cls, models: Iterable[str]) -> None:
+        """イベントループを止めないよう、エンコーディングを別スレッドで読み込んでおく"""
+        for model in models:
+            await asyncio.to_thread(cls._encoding, model)
+
+    @classmethod
+    def _encoding(cls, model: str) -> Any:
+        if model in cls._encodings:
+            return cls._encodings[model]
+        with cls._lock:
+            if model not in cls._encodings:
+                cls._encodings[model] = cls._load_encoding(model)
+            return cls._encodings[model]
+
+    @staticmethod
+    def _load_encoding(model: str) -> Any:
+        if tiktoken is None:
+            return None
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Azure のデプロイメント名はモデル名と一致しないことがある
+                return tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            logger.warning("トークナイザーを読み込めないため、トークン数を概算します: %s", e)
+            return None
+
+    def count(self, text: str, model: str) -> int:
+        encoding = self._encoding(model)
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return self._estimate(text)
+
+    def truncate(self, text: str, max_tokens: int, model: str) -> str:
+        if max_tokens <= 0:
+            return ""
+        encoding = self._encoding(model)
+        if encoding is not None:
+            tokens = encoding.encode(text, disallowed_special=())
+            return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+        # 概算の場合は先頭から数えて上限に達した位置で切る
+        used = 0.0
+        for i, char in enumerate(text):
+            used += 0.25 if char.isascii() else 1.0
+            if used > max_tokens:
+                return text[:i]
+        return text
+
+    @staticmethod
+    def _estimate(text: str) -> int:
+        # 英数字はおよそ 4 文字で 1 トークン、日本語はおよそ 1 文字で 1 トークン
+        ascii_chars = sum(1 for char in text if char.isascii())
+        return int(ascii_chars / 4 + (len(text) - ascii_chars)) + 1
+
+
+class BuiltContext:
+    def __init__(self, text: str, documents: list, tokens: int, dropped: int):
+        self.text = text
+        self.documents = documents
+        self.tokens = tokens
+        self.dropped = dropped
+
+
+class ContextBuilder:
+    """検索結果からトークン予算内のコンテキストを組み立てる
+
+    スコアの高い順に予算が尽きるまで詰める。その前に、先頭のスコアに対する比率が min_score_ratio 未満の
+    ドキュメントと、直前のドキュメントからスコアが score_gap_ratio 以上落ち込んだ位置以降を関連度が低いとして除く。
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 6000,
+        min_score_ratio: float = 0.0,
+        score_gap_ratio: Optional[float] = None,
+        min_documents: int = 1,
+        token_counter: Optional[TokenCounter] = None,
+    ):
+        self.token_budget = token_budget
+        self.min_score_ratio = min_score_ratio
+        self.score_gap_ratio = score_gap_ratio
+        self.min_documents = max(1, min_documents)
+        self.token_counter = token_counter or TokenCounter()
+
+    @classmethod
+    def from_env(cls) -> "ContextBuilder":
+        gap = os.getenv("CONTEXT_SCORE_GAP_RATIO")
+        return cls(
+            token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000")),
+            min_score_ratio=float(os.getenv("CONTEXT_MIN_SCORE_RATIO", "0")),
+            score_gap_ratio=float(gap) if gap else None,
+            min_documents=int(os.getenv("CONTEXT_MIN_DOCUMENTS", "1")),
+        )
+
+    @staticmethod
+    def format_document(doc: dict) -> str:
+        return f"タイトル: {doc['title']}\n内容: {doc['content']}\nスコア: {doc['score']:.2f}\n"
+
+    def build(self, documents: list, model: str) -> BuiltContext:
+        ranked = sorted(documents, key=lambda doc: doc.get("score") or 0.0, reverse=True)
+        relevant = self._cut_low_relevance(ranked)
+
+        parts: list[str] = []
+        used: list = []
+        tokens = 0
+        separator_tokens = self.token_counter.count(CONTEXT_SEPARATOR, model)
+        for doc in relevant:
+            part = self.format_document(doc)
+            part_tokens = self.token_counter.count(part, model) + (separator_tokens if parts else 0)
+            if tokens + part_tokens > self.token_budget:
+                if not parts:
+                    # 1 件目が予算を超える場合は切り詰めてでも入れる
+                    part = self.token_counter.truncate(part, self.token_budget, model)
+                    parts.append(part)
+                    used.append(doc)
+                    tokens = self.token_counter.count(part, model)
+                break
+            parts.append(part)
+            used.append(doc)
+            tokens += part_tokens
+
+        return BuiltContext(
+            text=CONTEXT_SEPARATOR.join(parts),
+            documents=used,
+            tokens=tokens,
+            dropped=len(documents) - len(used),
+        )
+
+    def _cut_low_relevance(self, ranked: list) -> list:
+        if len(ranked) <= self.min_documents:
+            return ranked
+
+        top_score = ranked[0].get("score") or 0.0
+        min_documents = self.min_documents
+        kept = ranked[:min_documents]
+        for doc in ranked[min_documents:]:
+            score = doc.get("score") or 0.0
+            if top_score > 0 and score < top_score * self.min_score_ratio:
+                break
+            previous_score = kept[-1].get("score") or 0.0
+            if self.score_gap_ratio is not None and previous_score > 0:
+                if (previous_score - score) / previous_score >= self.score_gap_ratio:
+                    break
+            kept.append(doc)
+        return kept
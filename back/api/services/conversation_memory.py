@@ -0,0 +1,177 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Optional
+
+from back.api.services.context_builder import TokenCounter
+from back.api.utils.logging import logger
+from back.api.utils.ttl_lru_cache import TTLLRUCache
+from fastapi import Request
+
+
+# (質問, 応答)
+Turn = tuple[str, str]
+# (これまでの要約, 要約に畳み込む古いターン) から新しい要約を返す
+Summarizer = Callable[[str, list[Turn]], Awaitable[str]]
+# (メッセージの id, 送信者, 本文)
+StoredMessage = tuple[str, str, str]
+# 新しい順ではなく時刻順に、直近 limit 件のメッセージを返す（まだ DB に書き込まれていないものも含める）
+MessageLoader = Callable[[int], Awaitable[list[StoredMessage]]]
+
+SUMMARY_PREFIX = "これまでの会話の要約:\n"
+
+
+class ConversationState:
+    """スレッドごとの会話の状態（古いターンの要約と、直近のターンそのまま）"""
+
+    def __init__(self, summary: str = "", turns: Optional[list[Turn]] = None):
+        self.summary = summary
+        self.turns: list[Turn] = turns or []
+        # 要約と turns に取り込み済みの最後のメッセージ（ターンの応答）の id
+        self.last_message_id: Optional[str] = None
+        # 要約の更新はスレッドごとに 1 つずつ行う
+        self.lock = asyncio.Lock()
+
+
+class ConversationMemory:
+    """チャットスレッドの会話履歴を、一定のトークン数に収まる形でプロンプトに渡す
+
+    直近 recent_turns ターンはそのまま残し、それより古いターンは要約に畳み込む。
+    要約はスレッドごとにキャッシュし、あふれたターンの分だけ前回の要約に追記する形で更新する（毎回作り直さない）。
+    キャッシュはプロセスごとなので、毎回スレッドの最新のメッセージの id を読み、取り込み済みの id と違えば
+    （別のワーカーがターンを追加した場合など）直近 load_limit 件を読み込んで足りないターンを補う。
+    キャッシュに無いスレッド（再起動後など）は直近 load_limit 件から作り直す。要約はリクエストの中では行わず、
+    compact をバックグラウンドで呼んだときに畳み込む（それまでは history_messages が古いターンから捨てる）。
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 2000,
+        summary_max_tokens: int = 500,
+        recent_turns: int = 3,
+        load_limit: int = 40,
+        max_threads: int = 1024,
+        ttl: Optional[float] = 3600.0,
+        token_counter: Optional[TokenCounter] = None,
+    ):
+        self.token_budget = token_budget
+        self.summary_max_tokens = min(summary_max_tokens, token_budget)
+        self.recent_turns = recent_turns
+        self.load_limit = load_limit
+        self.token_counter = token_counter or TokenCounter()
+        self._states: TTLLRUCache[ConversationState] = TTLLRUCache(max_entries=max_threads, ttl=ttl)
+        self.stats = self._states.stats
+
+    @classmethod
+    def from_env(cls) -> "ConversationMemory":
+        return cls(
+            token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "2000")),
+            summary_max_tokens=int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "500")),
+            recent_turns=int(os.getenv("HISTORY_RECENT_TURNS", "3")),
+            load_limit=int(os.getenv("HISTORY_LOAD_LIMIT", "40")),
+            max_threads=int(os.getenv("HISTORY_CACHE_MAX_THREADS", "1024")),
+            ttl=float(os.getenv("HISTORY_CACHE_TTL_SECONDS", "3600")),
+        )
+
+    def stats_dict(self) -> dict[str, Any]:
+        return {**self.stats.to_dict(), "entries": len(self._states)}
+
+    async def get(self, thread_id: str, load: MessageLoader) -> ConversationState:
+        state = self._states.get(thread_id)
+        if state is not None:
+            latest = await load(1)
+            if state.last_message_id == (latest[-1][0] if latest else None):
+                return state
+
+        messages = await load(self.load_limit)
+        ids = [message_id for message_id, _, _ in messages]
+        if state is not None and state.last_message_id in ids:
+            # 取り込み済みのメッセージより後のターンだけを足す（要約はそのまま使う）
+            start = ids.index(state.last_message_id) + 1
+            messages = messages[start:]
+        else:
+            state = ConversationState()
+            self._states.set(thread_id, state)
+        turns, last_message_id = self._pair_turns(messages)
+        state.turns.extend(turns)
+        if last_message_id is not None:
+            state.last_message_id = last_message_id
+        return state
+
+    @staticmethod
+    def _pair_turns(messages: list[StoredMessage]) -> tuple[list[Turn], Optional[str]]:
+        """ターンと、ターンに含めた最後の応答の id を返す
+
+        応答の無い質問（応答生成前に保存されたもの・応答がまだ書き込まれていないものなど）は捨てる。
+        """
+        turns = []
+        last_message_id = None
+        for (_, sender, text), (next_id, next_sender, next_text) in zip(messages, messages[1:]):
+            if sender == "user" and next_sender == "bot":
+                turns.append((text, next_text))
+                last_message_id = next_id
+        return turns, last_message_id
+
+    def append(self, state: ConversationState, query: str, response: str, message_id: str) -> None:
+        """このプロセスで応答したターンを足す（message_id は保存した応答の id）"""
+        state.turns.append((query, response))
+        state.last_message_id = message_id
+
+    def history_messages(self, state: ConversationState, model: str) -> list[dict]:
+        """要約と直近のターンを token_budget に収まる範囲で chat completions の messages にする
+
+        要約がまだ追いついていない場合も、古いターンから捨てて上限を守る。
+        """
+        messages: list[dict] = []
+        remaining = self.token_budget
+        if state.summary:
+            content = SUMMARY_PREFIX + state.summary
+            messages.append({"role": "system", "content": content})
+            remaining -= self.token_counter.count(content, model)
+
+        recent: list[dict] = []
+        first_recent = max(len(state.turns) - self.recent_turns, 0)
+        for query, response in reversed(state.turns[first_recent:]):
+            tokens = self._turn_tokens((query, response), model)
+            if tokens > remaining:
+                break
+            recent[:0] = [{"role": "user", "content": query}, {"role": "assistant", "content": response}]
+            remaining -= tokens
+        return messages + recent
+
+    async def compact(self, state: ConversationState, summarize: Summarizer, model: str) -> None:
+        """直近のターン数・トークン数を超えた古いターンを要約に畳み込む"""
+        async with state.lock:
+            overflow = self._overflow(state, model)
+            if overflow == 0:
+                return
+            folded = state.turns[:overflow]
+            try:
+                summary = await summarize(state.summary, folded)
+            except Exception as e:
+                # ターンは残しておき、次の更新で改めて畳み込む（その間も history_messages が上限を守る）
+                logger.error("会話履歴の要約に失敗しました %s", e)
+                return
+            state.summary = self.token_counter.truncate(summary.strip(), self.summary_max_tokens, model)
+            # 要約している間に追加されたターンは末尾にあるので、先頭から畳み込んだ分だけ消す
+            del state.turns[:overflow]
+
+    def _overflow(self, state: ConversationState, model: str) -> int:
+        # 新しい方から数えて、そのまま残せるターン数を求める
+        remaining = self.token_budget - self.summary_max_tokens
+        kept = 0
+        for turn in reversed(state.turns):
+            if kept >= self.recent_turns:
+                break
+            tokens = self._turn_tokens(turn, model)
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            kept += 1
+        return len(state.turns) - kept
+
+    def _turn_tokens(self, turn: Turn, model: str) -> int:
+        return sum(self.token_counter.count(text, model) for text in turn)
+
+
+def get_conversation_memory(request: Request) -> ConversationMemory:
+    return request.app.state.conversation_memory
@@ -0,0 +1,73 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from back.api.utils.logging import logger
+from back.api.utils.ttl_lru_cache import TTLLRUCache
+
+
+class EmbeddingCache:
+    """クエリ埋め込みの LRU キャッシュ
+
+    disk_dir を指定すると float32 の .npy としてディスクにも保存し、プロセス再起動後も再利用する。
+    """
+
+    def __init__(self, max_entries: int = 4096, disk_dir: Optional[Path] = None):
+        self._cache: TTLLRUCache[np.ndarray] = TTLLRUCache(max_entries=max_entries, sizeof=lambda v: v.nbytes)
+        self.stats = self._cache.stats
+        self.disk_dir = disk_dir
+        self.disk_hits = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingCache":
+        disk_dir = os.getenv("EMBEDDING_CACHE_DIR")
+        return cls(
+            max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "4096")),
+            disk_dir=Path(disk_dir) if disk_dir else None,
+        )
+
+    @staticmethod
+    def _digest(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        key = self._digest(model, text)
+        vector = self._cache.get(key)
+        if vector is not None or self.disk_dir is None:
+            return vector
+
+        path = self.disk_dir / f"{key}.npy"
+        if not path.exists():
+            return None
+        try:
+            vector = np.load(path)
+        except (OSError, ValueError) as e:
+            logger.error("埋め込みキャッシュの読み込みに失敗しました %s: %s", path, e)
+            return None
+        self.disk_hits += 1
+        self._cache.set(key, vector)
+        return vector
+
+    def set(self, model: str, text: str, vector: np.ndarray) -> None:
+        key = self._digest(model, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        self._cache.set(key, vector)
+        if self.disk_dir is None:
+            return
+
+        # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.disk_dir, suffix=".npy", delete=False) as f:
+                np.save(f, vector)
+            os.replace(f.name, self.disk_dir / f"{key}.npy")
+        except OSError as e:
+            logger.error("埋め込みキャッシュの書き込みに失敗しました: %s", e)
+
+    def stats_dict(self) -> dict[str, int]:
+        return {**self.stats.to_dict(), "disk_hits": self.disk_hits, "entries": len(self._cache)}
@@ -0,0 +1,386 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Protocol
+
+import aiohttp
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.core.rest import HttpRequest
+from azure.search.documents.aio import SearchClient
+from back.api.services import rate_limiter
+from back.api.services.text_splitter import chunk_file
+from back.api.utils.logging import logger
+from openai import AsyncAzureOpenAI
+
+
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準の json でシリアライズする
+    orjson = None
+
+
+DEFAULT_PATTERNS = ("*.txt", "*.md")
+SEARCH_API_VERSION = "2024-07-01"
+
+
+def iter_source_files(source_dir: Path, patterns: Iterable[str] = DEFAULT_PATTERNS) -> Iterator[Path]:
+    """ディレクトリを走査しながら、見つけた順にファイルを返す（全件を集めてから並べ替えない）"""
+    seen = set()
+    for pattern in patterns:
+        for path in source_dir.rglob(pattern):
+            if path.is_file() and path not in seen:
+                seen.add(path)
+                yield path
+
+
+class EmbeddingClient(Protocol):
+    """テキストのリストをまとめて埋め込む"""
+
+    model: str
+
+    async def embed(self, texts: list[str], tokens: int) -> np.ndarray:
+        """(件数, 次元数) の float32 行列を返す"""
+        ...
+
+    async def aclose(self) -> None:
+        """接続を閉じる"""
+
+
+class DocumentSink(Protocol):
+    """ドキュメントをまとめてインデックスに登録し、失敗したドキュメントのキーを返す"""
+
+    async def upload(self, documents: list[dict]) -> list[str]:
+        """登録に失敗したドキュメントのキーを返す"""
+
+    async def aclose(self) -> None:
+        """接続を閉じる"""
+
+
+class AzureOpenAIEmbeddingClient:
+    """Azure OpenAI の embeddings API。レート制限の枠を取ってから送り、429・一時的なエラーはリトライする"""
+
+    def __init__(
+        self,
+        client: AsyncAzureOpenAI,
+        model: str,
+        limiter: rate_limiter.RateLimiter,
+        retry_policy: Optional[rate_limiter.RetryPolicy] = None,
+    ):
+        self.client = client
+        self.model = model
+        self.limiter = limiter
+        self.retry_policy = retry_policy or rate_limiter.RetryPolicy()
+
+    @classmethod
+    def from_env(cls, rate_limiters: rate_limiter.RateLimiters) -> "AzureOpenAIEmbeddingClient":
+        """API と同じ環境変数（OPENAI_ENDPOINT・OPENAI_API_KEY・API_VERSION・EMBEDDING_DEPLOYMENT_NAME）を使う"""
+        model = os.getenv("EMBEDDING_DEPLOYMENT_NAME", "text-embedding-ada-002")
+        client = AsyncAzureOpenAI(
+            azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
+            api_key=os.getenv("OPENAI_API_KEY"),
+            api_version=os.getenv("API_VERSION"),
+            # リトライは RateLimiter と合わせて call_with_retries で行う
+            max_retries=0,
+        )
+        return cls(client, model, rate_limiters.openai(model), rate_limiters.retry_policy)
+
+    async def embed(self, texts: list[str], tokens: int) -> np.ndarray:
+        async def call() -> np.ndarray:
+            raw = await self.client.embeddings.with_raw_response.create(model=self.model, input=texts)
+            self.limiter.observe_headers(raw.headers)
+            response = raw.parse()
+            data = sorted(response.data, key=lambda item: item.index)
+            return np.asarray([item.embedding for item in data], dtype=np.float32)
+
+        return await rate_limiter.call_with_retries(
+            self.limiter, self.retry_policy, call, rate_limiter.classify_openai_error, tokens=tokens
+        )
+
+    async def aclose(self) -> None:
+        await self.client.close()
+
+
+class AzureSearchSink:
+    """Azure AI Search へのバルク登録（mergeOrUpload）
+
+    SDK の merge_or_upload_documents はベクトルの要素ごとに Python でシリアライズするため、1536 次元 × 数百件の
+    バッチでは数秒イベントループを止める。ここでは本文を自前で組み立てて send_request で送り、認証・ログなどは
+    SearchClient のパイプラインをそのまま使う。ベクトルは float32 の配列のまま orjson でシリアライズする。
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        index_name: str,
+        api_key: str,
+        limiter: rate_limiter.RateLimiter,
+        retry_policy: Optional[rate_limiter.RetryPolicy] = None,
+        timeout: float = 120.0,
+    ):
+        self.index_name = index_name
+        self.limiter = limiter
+        self.retry_policy = retry_policy or rate_limiter.RetryPolicy()
+        self._session = aiohttp.ClientSession()
+        self.search_client = SearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(api_key),
+            api_version=SEARCH_API_VERSION,
+            transport=AioHttpTransport(session=self._session, session_owner=False, read_timeout=timeout),
+            # リトライは RateLimiter と合わせて call_with_retries で行う
+            retry_total=0,
+        )
+
+    @classmethod
+    def from_env(cls, rate_limiters: rate_limiter.RateLimiters) -> "AzureSearchSink":
+        """API と同じ環境変数（SEARCH_ENDPOINT・SEARCH_API_KEY・SEARCH_INDEX_NAME）を使う"""
+        index_name = os.getenv("SEARCH_INDEX_NAME") or os.getenv("INDEX_NAME") or ""
+        return cls(
+            os.getenv("SEARCH_ENDPOINT"),
+            index_name,
+            os.getenv("SEARCH_API_KEY"),
+            rate_limiters.search(index_name),
+            rate_limiters.retry_policy,
+        )
+
+    async def upload(self, documents: list[dict]) -> list[str]:
+        body = _dumps({"value": [{"@search.action": "mergeOrUpload", **document} for document in documents]})
+
+        async def call() -> list[dict]:
+            request = HttpRequest(
+                "POST",
+                f"/indexes('{self.index_name}')/docs/search.index",
+                params={"api-version": SEARCH_API_VERSION},
+                headers={"Content-Type": "application/json", "Accept": "application/json;odata.metadata=none"},
+                content=body,
+            )
+            response = await self.search_client.send_request(request)
+            # 一部のドキュメントだけが失敗した場合は 207 で、結果にドキュメントごとの status が入る
+            response.raise_for_status()
+            return response.json()["value"]
+
+        results = await rate_limiter.call_with_retries(
+            self.limiter, self.retry_policy, call, rate_limiter.classify_azure_error
+        )
+        return [result["key"] for result in results if not result["status"]]
+
+    async def aclose(self) -> None:
+        await self.search_client.close()
+        await self._session.close()
+
+
+def _dumps(payload: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, ensure_ascii=False, default=_to_list).encode("utf-8")
+
+
+def _to_list(value: object) -> list:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} は JSON に変換できません")
+
+
+class IngestionStats:
+    """取り込みの件数と経過時間（failed は埋め込み・登録に失敗したチャンク数）"""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.documents = 0
+        self.chunks = 0
+        self.embedded = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.failed_documents = 0
+        self.embed_requests = 0
+        self.upload_requests = 0
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def as_dict(self) -> dict:
+        elapsed = max(self.elapsed, 1e-9)
+        return {
+            "documents": self.documents,
+            "chunks": self.chunks,
+            "embedded": self.embedded,
+            "uploaded": self.uploaded,
+            "failed": self.failed,
+            "failed_documents": self.failed_documents,
+            "embed_requests": self.embed_requests,
+            "upload_requests": self.upload_requests,
+            "seconds": round(elapsed, 3),
+            "documents_per_second": round(self.documents / elapsed, 2),
+            "chunks_per_second": round(self.chunks / elapsed, 2),
+        }
+
+
+class IngestionPipeline:
+    """ローカルのファイルを分割・埋め込み・登録するパイプライン
+
+    ファイルの読み込みと分割はプロセスプールで行い、終わったものから埋め込みに回す。埋め込みは
+    embed_batch_size 件（または embed_batch_tokens トークン）ずつ最大 embed_concurrency 並列で送り、
+    登録は upload_batch_size 件たまるごとに最大 upload_concurrency 並列で送る。段階の間は上限付きのキューで
+    つなぐので、下流が遅い場合は上流が待ち、メモリに載るチャンク数は一定に収まる。
+    """
+
+    def __init__(
+        self,
+        embedder: EmbeddingClient,
+        sink: DocumentSink,
+        processes: Optional[int] = None,
+        embed_batch_size: int = 128,
+        embed_batch_tokens: int = 100_000,
+        embed_concurrency: int = 4,
+        upload_batch_size: int = 250,
+        upload_concurrency: int = 2,
+    ):
+        self.embedder = embedder
+        self.sink = sink
+        self.processes = processes
+        self.embed_batch_size = embed_batch_size
+        self.embed_batch_tokens = embed_batch_tokens
+        self.embed_concurrency = embed_concurrency
+        self.upload_batch_size = upload_batch_size
+        self.upload_concurrency = upload_concurrency
+
+    async def run(self, paths: Iterable[Path], source_dir: Path) -> IngestionStats:
+        stats = IngestionStats()
+        chunks: asyncio.Queue[Optional[dict]] = asyncio.Queue(maxsize=self.embed_batch_size * self.embed_concurrency)
+        embedded: asyncio.Queue[Optional[dict]] = asyncio.Queue(
+            maxsize=self.upload_batch_size * (self.upload_concurrency + 1)
+        )
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            async with asyncio.TaskGroup() as group:
+                group.create_task(self._produce(paths, source_dir, executor, chunks, stats))
+                group.create_task(self._embed(chunks, embedded, stats))
+                group.create_task(self._upload(embedded, stats))
+        stats.finished = time.perf_counter()
+        return stats
+
+    async def _produce(
+        self,
+        paths: Iterable[Path],
+        source_dir: Path,
+        executor: ProcessPoolExecutor,
+        chunks: asyncio.Queue,
+        stats: IngestionStats,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        # 分割待ちのファイルをプロセス数の数倍に抑え、巨大なディレクトリでもタスクを積み上げない
+        max_pending = 4 * (self.processes or os.cpu_count() or 1)
+        pending: dict[asyncio.Future, Path] = {}
+        paths = iter(paths)
+        while True:
+            for path in paths:
+                future = loop.run_in_executor(executor, chunk_file, path, source_dir, self.embedder.model)
+                pending[future] = path
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    file_chunks = future.result()
+                except Exception as e:
+                    logger.error("%s を分割できませんでした %s", path, e)
+                    stats.failed_documents += 1
+                    continue
+                stats.documents += 1
+                stats.chunks += len(file_chunks)
+                for chunk in file_chunks:
+                    await chunks.put(chunk)
+        await chunks.put(None)
+
+    async def _embed(self, chunks: asyncio.Queue, embedded: asyncio.Queue, stats: IngestionStats) -> None:
+        semaphore = asyncio.Semaphore(self.embed_concurrency)
+        tasks: set[asyncio.Task] = set()
+
+        async def send(batch: list[dict]) -> None:
+            try:
+                await self._embed_batch(batch, embedded, stats)
+            finally:
+                semaphore.release()
+
+        batch: list[dict] = []
+        tokens = 0
+        while True:
+            chunk = await chunks.get()
+            if chunk is not None and (
+                len(batch) < self.embed_batch_size and tokens + chunk["_tokens"] <= self.embed_batch_tokens
+            ):
+                batch.append(chunk)
+                tokens += chunk["_tokens"]
+                continue
+            if batch:
+                # 同時に送るバッチ数が上限に達している間は、次のバッチを作らずに待つ
+                await semaphore.acquire()
+                task = asyncio.create_task(send(batch))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if chunk is None:
+                break
+            batch, tokens = [chunk], chunk["_tokens"]
+
+        await asyncio.gather(*tasks)
+        await embedded.put(None)
+
+    async def _embed_batch(self, batch: list[dict], embedded: asyncio.Queue, stats: IngestionStats) -> None:
+        tokens = sum(chunk.pop("_tokens") for chunk in batch)
+        stats.embed_requests += 1
+        try:
+            vectors = await self.embedder.embed([chunk["chunk"] for chunk in batch], tokens)
+        except Exception as e:
+            logger.error("%s 件のチャンクの埋め込みに失敗しました %s", len(batch), e)
+            stats.failed += len(batch)
+            return
+        stats.embedded += len(batch)
+        for chunk, vector in zip(batch, vectors):
+            await embedded.put({**chunk, "text_vector": vector})
+
+    async def _upload(self, embedded: asyncio.Queue, stats: IngestionStats) -> None:
+        semaphore = asyncio.Semaphore(self.upload_concurrency)
+        tasks: set[asyncio.Task] = set()
+
+        async def send(documents: list[dict]) -> None:
+            try:
+                await self._upload_batch(documents, stats)
+            finally:
+                semaphore.release()
+
+        buffer: list[dict] = []
+        while True:
+            document = await embedded.get()
+            if document is not None:
+                buffer.append(document)
+            if buffer and (document is None or len(buffer) >= self.upload_batch_size):
+                await semaphore.acquire()
+                task = asyncio.create_task(send(buffer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                buffer = []
+            if document is None:
+                break
+        await asyncio.gather(*tasks)
+
+    async def _upload_batch(self, documents: list[dict], stats: IngestionStats) -> None:
+        stats.upload_requests += 1
+        try:
+            failed = await self.sink.upload(documents)
+        except Exception as e:
+            logger.error("%s 件のドキュメントの登録に失敗しました %s", len(documents), e)
+            stats.failed += len(documents)
+            return
+        if failed:
+            logger.warning("%s 件のドキュメントを登録できませんでした 例: %s", len(failed), failed[:5])
+        stats.failed += len(failed)
+        stats.uploaded += len(documents) - len(failed)
@@ -0,0 +1,334 @@
+import asyncio
+import json
+import math
+import re
+import unicodedata
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Sequence
+
+import numpy as np
+from back.api.services.rank_fusion import reciprocal_rank_fusion
+from back.api.services.search_backend import CHUNK_ID_FIELD, VECTOR_FIELD, VECTOR_SEARCH_MODE, SearchQuery
+from back.api.services.text_splitter import chunk_file
+from back.api.utils.logging import logger
+
+
+# テキストのリストを (件数, 次元数) の float32 行列に変換する関数
+Embedder = Callable[[list[str]], np.ndarray]
+
+# ひらがな・カタカナ・漢字の連続、またはそれ以外の単語
+_TOKEN_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u9fff]+|[^\W_]+")
+_CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u9fff]")
+
+CHUNKS_FILE = "chunks.jsonl"
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.json"
+
+
+def tokenize(text: str) -> list[str]:
+    """英数字は単語単位、日本語は文字 bigram に分割する"""
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).lower()):
+        word = match.group()
+        if _CJK_PATTERN.match(word) and len(word) > 1:
+            tokens.extend(first + second for first, second in zip(word, word[1:]))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+class HashingEmbedder:
+    """トークンのハッシュで次元を決める決定的な埋め込み（ネットワーク不要）"""
+
+    name = "hashing"
+
+    def __init__(self, dimensions: int = 1536):
+        self.dimensions = dimensions
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.array([zlib.crc32(token.encode("utf-8")) for token in tokenize(text)], dtype=np.int64)
+            if hashes.size == 0:
+                continue
+            signs = np.where(hashes & 1, 1.0, -1.0).astype(np.float32)
+            np.add.at(vectors[row], (hashes >> 1) % self.dimensions, signs)
+        return _normalize_rows(vectors)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def _count_term(text: str, term: str, pattern: Optional[re.Pattern]) -> int:
+    count = text.count(term)
+    if count and pattern is not None:
+        # 部分文字列として含む場合だけ、単語として数え直す
+        count = len(pattern.findall(text))
+    return count
+
+
+def bm25_scores(query: str, texts: Sequence[str], k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+    """少数の文書（並べ直しの候補など）に対する BM25 スコア
+
+    文書をトークンに分割せず、クエリの語ごとに正規化した本文での出現回数を数える（C 実装の検索で済むので、
+    長いチャンクでも速い）。文書長は文字数で近似する。
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms or not texts:
+        return np.zeros(len(texts), dtype=np.float32)
+
+    patterns = [
+        # 日本語の bigram は部分文字列、英数字の語は単語境界で数える
+        None if _CJK_PATTERN.match(term) else re.compile(rf"\b{re.escape(term)}\b")
+        for term in terms
+    ]
+    normalized = [unicodedata.normalize("NFKC", text).lower() for text in texts]
+    counts = np.array(
+        [[_count_term(text, term, pattern) for term, pattern in zip(terms, patterns)] for text in normalized],
+        dtype=np.float32,
+    )
+    lengths = np.array([len(text) for text in normalized], dtype=np.float32)
+
+    document_frequency = (counts > 0).sum(axis=0)
+    idf = np.log(1 + (len(texts) - document_frequency + 0.5) / (document_frequency + 0.5))
+    length_norm = k1 * (1 - b + b * lengths / max(float(lengths.mean()), 1e-12))
+    return (idf * counts * (k1 + 1) / (counts + length_norm[:, None])).sum(axis=1).astype(np.float32)
+
+
+class BM25Index:
+    """Okapi BM25 の転置インデックス"""
+
+    def __init__(self, texts: Iterable[str], k1: float = 1.5, b: float = 0.75):
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        lengths = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(doc_id)
+                tfs.append(count)
+
+        self.doc_count = len(lengths)
+        self._lengths = np.asarray(lengths, dtype=np.float32)
+        average_length = float(self._lengths.mean()) if self.doc_count else 0.0
+        # 文書長による正規化項は文書ごとに事前計算しておく
+        self._length_norm = k1 * (1 - b + b * self._lengths / max(average_length, 1e-12))
+        self._k1 = k1
+        self._postings = {
+            term: (np.asarray(ids, dtype=np.int64), np.asarray(tfs, dtype=np.float32))
+            for term, (ids, tfs) in postings.items()
+        }
+        self._idf = {
+            term: math.log(1 + (self.doc_count - len(ids) + 0.5) / (len(ids) + 0.5))
+            for term, (ids, _) in self._postings.items()
+        }
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs = posting
+            scores[ids] += self._idf[term] * tfs * (self._k1 + 1) / (tfs + self._length_norm[ids])
+        return scores
+
+    def top_k(self, query: str, k: int, mask: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        """mask を指定した場合は True の文書だけから選ぶ"""
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0.0
+        ids = _top_k(scores, k)
+        ids = ids[scores[ids] > 0]
+        return ids, scores[ids]
+
+
+class LocalSearchBackend:
+    """プロセス内で完結する検索バックエンド
+
+    チャンクのベクトルはメモリマップした float32 行列に保持し、コサイン類似度の総当たりで上位を求める。
+    full / keyword モードは BM25、vector モードはベクトル検索のみ、hybrid / semantic モードは両者を RRF で統合する。
+    filters の locations による絞り込みには対応するが、タグによるブーストは行わない。
+    """
+
+    def __init__(
+        self,
+        chunks: list[dict],
+        vectors: np.ndarray,
+        embedder: Optional[Embedder] = None,
+        candidate_pool: int = 50,
+    ):
+        if len(chunks) != vectors.shape[0]:
+            raise ValueError("チャンク数とベクトル数が一致しません。")
+        self.chunks = chunks
+        self.vectors = vectors
+        self.embedder = embedder
+        self.candidate_pool = candidate_pool
+        self.bm25 = BM25Index(chunk.get("chunk", "") for chunk in chunks)
+        self._chunk_ids = {
+            chunk[CHUNK_ID_FIELD]: doc_id for doc_id, chunk in enumerate(chunks) if CHUNK_ID_FIELD in chunk
+        }
+        # 地名 -> その地名を含むチャンクの番号
+        location_ids: dict[str, list[int]] = {}
+        for doc_id, chunk in enumerate(chunks):
+            for location in chunk.get("locations") or []:
+                location_ids.setdefault(location, []).append(doc_id)
+        self._location_ids = {location: np.asarray(ids, dtype=np.int64) for location, ids in location_ids.items()}
+
+    @classmethod
+    def load(cls, index_dir: Path, embedder: Optional[Embedder] = None) -> "LocalSearchBackend":
+        meta = json.loads((index_dir / META_FILE).read_text(encoding="utf-8"))
+        with (index_dir / CHUNKS_FILE).open(encoding="utf-8") as f:
+            chunks = [json.loads(line) for line in f if line.strip()]
+        vectors = np.load(index_dir / VECTORS_FILE, mmap_mode="r")
+        if embedder is None and meta.get("embedder") == HashingEmbedder.name:
+            embedder = HashingEmbedder(dimensions=vectors.shape[1])
+        return cls(chunks, vectors, embedder=embedder)
+
+    async def search(self, query: SearchQuery) -> list[dict]:
+        # 行列演算は GIL を解放するので、イベントループを止めないようスレッドで実行する
+        return await asyncio.to_thread(self._search, query)
+
+    async def lookup(self, chunk_ids: Sequence[str], fields: Sequence[str]) -> list[dict]:
+        results = []
+        for chunk_id in chunk_ids:
+            doc_id = self._chunk_ids.get(chunk_id)
+            if doc_id is None:
+                continue
+            chunk = self.chunks[doc_id]
+            result = {field: chunk[field] for field in (CHUNK_ID_FIELD, *fields) if field in chunk}
+            if VECTOR_FIELD in fields:
+                # ベクトルは行列の行をそのまま返す（コピーしない）
+                result[VECTOR_FIELD] = self.vectors[doc_id]
+            results.append(result)
+        return results
+
+    async def aclose(self) -> None:
+        return None
+
+    def embed_query(self, text: str) -> Optional[np.ndarray]:
+        if self.embedder is None:
+            return None
+        return np.asarray(self.embedder([text])[0], dtype=np.float32)
+
+    def _search(self, query: SearchQuery) -> list[dict]:
+        # Azure AI Search と同じく top 未指定時は 50 件
+        top_k = query.top_k or 50
+        pool = max(top_k, self.candidate_pool)
+        mask = self._filter_mask(query)
+        vector = self._query_vector(query) if query.needs_vector else None
+        if query.search_mode == VECTOR_SEARCH_MODE and vector is not None:
+            similarities = self._similarities(vector)
+            vector_ids = self._masked_top_k(similarities, top_k, mask)
+            return self._to_results(vector_ids, similarities[vector_ids], query.select)
+
+        keyword_ids, keyword_scores = self.bm25.top_k(query.text, pool, mask)
+        if vector is None:
+            return self._to_results(keyword_ids[:top_k], keyword_scores[:top_k], query.select)
+
+        vector_ids = self._masked_top_k(self._similarities(vector), pool, mask)
+        fused = reciprocal_rank_fusion([keyword_ids.tolist(), vector_ids.tolist()])[:top_k]
+        return self._to_results([doc_id for doc_id, _ in fused], [score for _, score in fused], query.select)
+
+    def _filter_mask(self, query: SearchQuery) -> Optional[np.ndarray]:
+        if query.filters is None or not query.filters.locations:
+            return None
+        mask = np.zeros(len(self.chunks), dtype=bool)
+        for location in query.filters.locations:
+            ids = self._location_ids.get(location)
+            if ids is not None:
+                mask[ids] = True
+        return mask
+
+    @staticmethod
+    def _masked_top_k(similarities: np.ndarray, k: int, mask: Optional[np.ndarray]) -> np.ndarray:
+        if mask is None:
+            return _top_k(similarities, k)
+        allowed = np.flatnonzero(mask)
+        return allowed[_top_k(similarities[allowed], k)]
+
+    def _query_vector(self, query: SearchQuery) -> Optional[np.ndarray]:
+        if query.vector is not None:
+            return query.vector
+        if self.embedder is None:
+            logger.warning("埋め込みモデルが設定されていないため、キーワード検索のみを行います")
+            return None
+        return self.embedder([query.text])[0]
+
+    def vector_top_k(self, vector: np.ndarray, k: int) -> np.ndarray:
+        return _top_k(self._similarities(vector), k)
+
+    def _similarities(self, vector: np.ndarray) -> np.ndarray:
+        query = np.asarray(vector, dtype=np.float32)
+        return self.vectors @ (query / max(float(np.linalg.norm(query)), 1e-12))
+
+    def _to_results(
+        self,
+        ids: Iterable[int],
+        scores: Iterable[float],
+        select: Optional[Sequence[str]] = None,
+    ) -> list[dict]:
+        # ハイライトは生成せず、常にチャンク全文を返す
+        results = []
+        for i, score in zip(ids, scores):
+            chunk = self.chunks[int(i)]
+            if select is not None:
+                chunk = {field: chunk[field] for field in select if field in chunk}
+            if select is None or VECTOR_FIELD in select:
+                # ベクトルはチャンクではなく行列に持っている
+                chunk = {**chunk, VECTOR_FIELD: self.vectors[int(i)]}
+            results.append({**chunk, "@search.score": float(score)})
+        return results
+
+
+def build_local_index(
+    source_dir: Path,
+    index_dir: Path,
+    embedder: Optional[Embedder] = None,
+    patterns: tuple[str, ...] = ("*.txt", "*.md"),
+    batch_size: int = 64,
+) -> int:
+    """テキストファイルのディレクトリから LocalSearchBackend 用のインデックスを作成し、チャンク数を返す"""
+    embedder = embedder or HashingEmbedder()
+    paths = sorted({path for pattern in patterns for path in source_dir.rglob(pattern)})
+
+    chunks = [chunk for path in paths for chunk in chunk_file(path, source_dir)]
+
+    index_dir.mkdir(parents=True, exist_ok=True)
+    with (index_dir / CHUNKS_FILE).open("w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+
+    # 全件をメモリに載せずにバッチごとにメモリマップへ書き込む
+    vectors = None
+    for start in range(0, len(chunks), batch_size):
+        end = start + batch_size
+        batch = embedder([chunk["chunk"] for chunk in chunks[start:end]])
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(
+                index_dir / VECTORS_FILE, mode="w+", dtype=np.float32, shape=(len(chunks), batch.shape[1])
+            )
+        vectors[start:end] = _normalize_rows(np.asarray(batch, dtype=np.float32))
+    if vectors is None:
+        dimensions = getattr(embedder, "dimensions", 0)
+        np.save(index_dir / VECTORS_FILE, np.zeros((0, dimensions), dtype=np.float32))
+    else:
+        vectors.flush()
+        del vectors
+
+    meta = {"embedder": getattr(embedder, "name", "custom"), "documents": len(paths), "chunks": len(chunks)}
+    (index_dir / META_FILE).write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    return len(chunks)
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from uuid import uuid4
+
+from back.api.models.models import Message
+from back.api.utils.logging import logger
+from back.api.utils.metrics import MESSAGE_FLUSH_DURATION, MESSAGE_QUEUE_DEPTH, MESSAGE_ROWS
+from fastapi import Request
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+
+class MessageWriter:
+    """チャットのメッセージをキューに溜め、バックグラウンドでまとめて INSERT する
+
+    batch_size 件溜まるか、最初の 1 件から flush_interval 秒経つと書き込む。
+    キューが max_queue_size 件で埋まっている間は enqueue が待つ（バックプレッシャー）。
+    書き込みが終わるまでの行は pending で参照できる（会話履歴の読み込みで DB にまだ無いターンを補う）。
+    aclose ではキューに残っているメッセージをすべて書き込んでから終了する。
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        batch_size: int = 200,
+        flush_interval: float = 0.5,
+        max_queue_size: int = 10000,
+        max_retries: int = 3,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=max_queue_size)
+        # thread_id ごとの、キューに積んでからまだ書き込みが終わっていない行（送信順）
+        self._pending: dict[str, list[dict]] = {}
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, session_factory: async_sessionmaker[AsyncSession]) -> "MessageWriter":
+        return cls(
+            session_factory,
+            batch_size=int(os.getenv("MESSAGE_WRITER_BATCH_SIZE", "200")),
+            flush_interval=float(os.getenv("MESSAGE_WRITER_FLUSH_INTERVAL", "0.5")),
+            max_queue_size=int(os.getenv("MESSAGE_WRITER_MAX_QUEUE_SIZE", "10000")),
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, thread_id: str, messages: list[tuple[str, str]]) -> list[str]:
+        """(送信者, 本文) のリストを書き込み待ちにし、各行の id を返す
+
+        送信時刻は書き込み時ではなくこの時点の時刻にする。同じターンの行は (timestamp, id) の順が
+        送信順になるよう、1 マイクロ秒ずつずらす。
+        """
+        if self._stopping.is_set():
+            raise RuntimeError("MessageWriter は終了しています")
+        now = datetime.now(tz=timezone.utc)
+        ids = []
+        for i, (sender, text) in enumerate(messages):
+            timestamp = now + timedelta(microseconds=i)
+            row = {"id": str(uuid4()), "thread_id": thread_id, "sender": sender, "text": text, "timestamp": timestamp}
+            self._pending.setdefault(thread_id, []).append(row)
+            await self._queue.put(row)
+            ids.append(row["id"])
+        MESSAGE_QUEUE_DEPTH.set(self._queue.qsize())
+        return ids
+
+    def pending(self, thread_id: str) -> list[dict]:
+        """thread_id の行のうち、まだ書き込みが終わっていないものを送信順に返す"""
+        return list(self._pending.get(thread_id, ()))
+
+    async def aclose(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            await self._task
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+            elif self._stopping.is_set():
+                return
+
+    async def _next_batch(self) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        batch: list[dict] = []
+        deadline = 0.0
+        while len(batch) < self.batch_size:
+            if self._stopping.is_set():
+                # 終了時は待たずに残りを取り出す
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            timeout = self.flush_interval if not batch else deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if batch:
+                    break
+                continue
+            if not batch:
+                deadline = loop.time() + self.flush_interval
+            batch.append(row)
+        MESSAGE_QUEUE_DEPTH.set(self._queue.qsize())
+        return batch
+
+    async def _flush(self, batch: list[dict]) -> None:
+        try:
+            await self._write(batch)
+        finally:
+            # 書き込めた行も破棄した行も pending から外す
+            self._release(batch)
+
+    async def _write(self, batch: list[dict]) -> None:
+        for attempt in range(1, self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                async with self.session_factory() as session:
+                    await session.execute(insert(Message), batch)
+                    await session.commit()
+            except Exception as e:
+                logger.error("メッセージの書き込みに失敗しました（%d/%d 回目） %s", attempt, self.max_retries, e)
+                if attempt < self.max_retries:
+                    await asyncio.sleep(0.1 * 2**attempt)
+                continue
+            MESSAGE_FLUSH_DURATION.observe(time.perf_counter() - start)
+            MESSAGE_ROWS.inc(len(batch), result="written")
+            return
+        logger.error("%d 件のメッセージを書き込めずに破棄しました", len(batch))
+        MESSAGE_ROWS.inc(len(batch), result="dropped")
+
+    def _release(self, batch: list[dict]) -> None:
+        for row in batch:
+            rows = self._pending.get(row["thread_id"])
+            if rows is None:
+                continue
+            rows.remove(row)
+            if not rows:
+                del self._pending[row["thread_id"]]
+
+
+def get_message_writer(request: Request) -> MessageWriter:
+    return request.app.state.message_writer
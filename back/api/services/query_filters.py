@@ -0,0 +1,130 @@
+import os
+import re
+import unicodedata
+from pathlib import Path
+from typing import Iterable, Optional, Sequence
+
+from back.api.utils.logging import logger
+
+
+# インデックスのスコアリングプロファイル（create_search_index.py）と、その TagScoringFunction のパラメーター名
+SCORING_PROFILE = "my-scoring-profile"
+TAGS_PARAMETER = "tags"
+
+QUERY_LOCATION_MODES = ("filter", "boost", "off")
+
+
+def _odata_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _tag_value(value: str) -> str:
+    # スコアリングパラメーターはカンマ区切りなので、空白・カンマを含む値は引用符で囲む
+    if re.search(r"[\s,']", value):
+        return "'" + value.replace("'", "''") + "'"
+    return value
+
+
+class SearchFilters:
+    """検索の絞り込み（OData の filter）とスコアリングのブースト（タグ）の条件
+
+    locations のいずれかを含むチャンクに絞り込み、boost_locations を含むチャンクのスコアを上げる。
+    derived が True の絞り込みはクエリから推定したもので、結果が空の場合は絞り込みを外して検索し直す。
+    """
+
+    def __init__(
+        self,
+        locations: Sequence[str] = (),
+        boost_locations: Sequence[str] = (),
+        derived: bool = False,
+    ):
+        self.locations = tuple(dict.fromkeys(locations))
+        self.boost_locations = tuple(dict.fromkeys(boost_locations))
+        self.derived = derived
+
+    def __bool__(self) -> bool:
+        return bool(self.locations or self.boost_locations)
+
+    def __repr__(self) -> str:
+        return f"SearchFilters(locations={self.locations}, boost_locations={self.boost_locations})"
+
+    def cache_key(self) -> tuple:
+        return (self.locations, self.boost_locations)
+
+    def without_filter(self) -> "SearchFilters":
+        return SearchFilters(boost_locations=self.boost_locations)
+
+    def odata_filter(self) -> Optional[str]:
+        if not self.locations:
+            return None
+        conditions = " or ".join(f"l eq {_odata_string(location)}" for location in self.locations)
+        return f"locations/any(l: {conditions})"
+
+    def scoring_parameters(self) -> list[str]:
+        if not self.boost_locations:
+            return []
+        return [f"{TAGS_PARAMETER}-" + ",".join(_tag_value(location) for location in self.boost_locations)]
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+class QueryAnalyzer:
+    """クエリに含まれる既知の地名を見つけ、絞り込み・ブーストの条件にする
+
+    地名の一覧（インデックスの locations の値）は QUERY_LOCATIONS_FILE に 1 行 1 件で渡す。
+    mode が "filter" の場合は見つけた地名で絞り込んだうえでブーストし、"boost" の場合はブーストだけを行う。
+    リクエストで絞り込みが指定されている場合、クエリから見つけた地名はブーストにだけ使う。
+    """
+
+    def __init__(self, locations: Iterable[str], mode: str = "filter"):
+        if mode not in QUERY_LOCATION_MODES:
+            raise ValueError(f"未対応の QUERY_LOCATION_MODE です: {mode}")
+        self.mode = mode
+        # 正規化した表記 -> インデックスでの表記
+        self._locations: dict[str, str] = {}
+        for location in locations:
+            location = location.strip()
+            if location:
+                self._locations.setdefault(_normalize(location), location)
+        self._pattern = self._compile(self._locations) if self._locations and mode != "off" else None
+
+    @classmethod
+    def from_env(cls) -> "QueryAnalyzer":
+        path = os.getenv("QUERY_LOCATIONS_FILE")
+        locations = Path(path).read_text(encoding="utf-8").splitlines() if path else []
+        analyzer = cls(locations, mode=os.getenv("QUERY_LOCATION_MODE", "filter"))
+        if locations:
+            logger.info("クエリ解析用の地名を %s 件読み込みました", len(analyzer._locations))
+        return analyzer
+
+    @staticmethod
+    def _compile(locations: dict[str, str]) -> re.Pattern:
+        alternatives = []
+        # 長い地名を優先して、部分一致する短い地名を拾わないようにする
+        for name in sorted(locations, key=len, reverse=True):
+            escaped = re.escape(name)
+            if name.isascii():
+                # 英字の地名は単語の一部に一致しないようにする
+                escaped = rf"(?<![a-z0-9]){escaped}(?![a-z0-9])"
+            alternatives.append(escaped)
+        return re.compile("|".join(alternatives))
+
+    def extract_locations(self, query: str) -> list[str]:
+        if self._pattern is None:
+            return []
+        found = (self._locations[match.group()] for match in self._pattern.finditer(_normalize(query)))
+        return list(dict.fromkeys(found))
+
+    def analyze(self, query: str, filters: Optional[SearchFilters] = None) -> Optional[SearchFilters]:
+        """リクエストの条件にクエリから見つけた地名を加えた条件（どちらも無ければ None）"""
+        found = self.extract_locations(query)
+        if not found:
+            return filters if filters else None
+        if filters is not None and filters.locations:
+            return SearchFilters(filters.locations, [*filters.boost_locations, *found])
+        boost_locations = [*(filters.boost_locations if filters is not None else ()), *found]
+        if self.mode == "filter":
+            return SearchFilters(found, boost_locations, derived=True)
+        return SearchFilters(boost_locations=boost_locations)
@@ -1,12 +1,67 @@
+import abc
 import os
-from azure.search.documents import SearchClient
-from openai import AzureOpenAI
-from azure.search.documents.models import VectorizableTextQuery
+from typing import Any, Optional
+
+import httpx
+import numpy as np
+import requests
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.search.documents import SearchClient
+from back.api.services import search_backend
+from back.api.services.chunk_merger import merge_adjacent_chunks
+from back.api.services.context_builder import BuiltContext, ContextBuilder
+from back.api.services.query_filters import SearchFilters
 from back.api.utils.logging import logger
+from openai import AzureOpenAI
+from requests.adapters import HTTPAdapter
+
+
+SYSTEM_MESSAGE = """
+            あなたは有能なアシスタントです。以下のコンテキスト情報を使用して、ユーザーの質問に回答してください。
+            """
+SUMMARY_SYSTEM_MESSAGE = """
+            あなたは会話の記録係です。これまでの要約と新しいやり取りを、後続の質問に答えるために必要な事実・固有名詞・
+            ユーザーの関心を残して、簡潔な日本語の要約 1 つにまとめてください。要約だけを出力してください。
+            """
+FALLBACK_RESPONSE = "申し訳ありませんが、現在質問に答えることができません。後でもう一度お試しください。"
+
+
+class RagClientPoolConfig:
+    """SearchClient / AzureOpenAI が使う HTTP コネクションプールの設定"""
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 60.0,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls) -> "RagClientPoolConfig":
+        return cls(
+            max_connections=int(os.getenv("RAG_POOL_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("RAG_POOL_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("RAG_POOL_KEEPALIVE_EXPIRY", "30")),
+            timeout=float(os.getenv("RAG_POOL_TIMEOUT", "60")),
+        )
+
+    def httpx_limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
 
+class BaseRagClient(abc.ABC):
+    """同期版・非同期版の RagClient で共有する設定と、I/O を伴わない処理"""
 
-class RagClient:
     def __init__(
         self,
         search_endpoint: str,
@@ -16,8 +71,7 @@ class RagClient:
         openai_api_key: str,
         deployment_name: str,
         api_version: str,
-        top_k: int = 3,
-        search_mode: str = "default",
+        pool_config: Optional[RagClientPoolConfig] = None,
     ):
 
         self.search_endpoint = search_endpoint or os.getenv("AZURE_SEARCH_ENDPOINT")
@@ -27,140 +81,205 @@ class RagClient:
         self.openai_api_key = openai_api_key or os.getenv("AZURE_OPENAI_KEY")
         self.deployment_name = deployment_name or os.getenv("DEPLOYMENT_NAME")
         self.api_version = api_version or os.getenv("API_VERSION")
-        self.top_k = top_k
-        self.search_mode = search_mode
+        self.pool_config = pool_config or RagClientPoolConfig()
         self.content_field = os.getenv("CONTENT_FIELD", "chunk")
         self.title_field = os.getenv("TITLE_FIELD", "title")
+        self.embedding_deployment_name = os.getenv("EMBEDDING_DEPLOYMENT_NAME", "text-embedding-ada-002")
+        # "client" の場合はクエリの埋め込みを自前で計算し、Azure Search 側のベクトライザーを経由しない
+        self.query_embedding_mode = os.getenv("QUERY_EMBEDDING_MODE", "service")
+        self.context_builder = ContextBuilder.from_env()
+        self.merge_adjacent_chunks = os.getenv("MERGE_ADJACENT_CHUNKS", "true").lower() == "true"
+        # 取得するフィールド（"*" で全フィールド）。text_vector など使わない大きなフィールドは取得しない
+        select_fields = os.getenv("SEARCH_SELECT_FIELDS", ",".join(search_backend.DEFAULT_SELECT_FIELDS))
+        self.select_fields = (
+            None if select_fields.strip() == "*" else [f.strip() for f in select_fields.split(",") if f.strip()]
+        )
+        # "true" の場合はチャンク全文の代わりにハイライトされた抜粋をコンテキストに使う
+        self.return_highlights = os.getenv("SEARCH_RETURN_HIGHLIGHTS", "false").lower() == "true"
         try:
+            self._validate_settings()
             self._init_cients()
         except Exception:
             logger.error("RagClientの初期化に失敗しました。")
             raise
 
-    def _init_cients(self) -> None:
-        if not all(
-            [
-                self.search_endpoint,
-                self.search_api_key,
-                self.search_index_name,
-                self.openai_endpoint,
-                self.openai_api_key,
-                self.deployment_name,
-                self.api_version,
-            ]
-        ):
+    def _required_settings(self) -> dict[str, Optional[str]]:
+        return {
+            "search_endpoint": self.search_endpoint,
+            "search_api_key": self.search_api_key,
+            "search_index_name": self.search_index_name,
+            "openai_endpoint": self.openai_endpoint,
+            "openai_api_key": self.openai_api_key,
+            "deployment_name": self.deployment_name,
+            "api_version": self.api_version,
+        }
+
+    def _validate_settings(self) -> None:
+        if not all(self._required_settings().values()):
             logger.error("クライアントの初期化に必要な環境変数が不足しています。")
             raise ValueError("クライアントの初期化に必要な環境変数が不足しています。")
 
+    @abc.abstractmethod
+    def _init_cients(self) -> None:
+        """検索・OpenAI のクライアントを作る（同期版・非同期版で実装する）"""
+
+    @property
+    def uses_client_side_embedding(self) -> bool:
+        return self.query_embedding_mode == "client"
+
+    def _build_search_kwargs(
+        self,
+        query: str,
+        top_k: int,
+        search_mode: str,
+        vector: Optional[np.ndarray] = None,
+    ) -> dict[str, Any]:
+        return search_backend.build_azure_search_kwargs(self._search_query(query, top_k, search_mode, vector=vector))
+
+    def _search_query(
+        self,
+        query: str,
+        top_k: int,
+        search_mode: str,
+        vector: Optional[np.ndarray] = None,
+        filters: Optional[SearchFilters] = None,
+    ) -> search_backend.SearchQuery:
+        return search_backend.SearchQuery(
+            query,
+            top_k,
+            search_mode,
+            vector=vector,
+            select=self.select_fields,
+            highlight=self.return_highlights,
+            filters=filters,
+        )
+
+    def _to_document(self, result: dict) -> dict:
+        # ハイライトがある場合は抜粋をつなげて本文の代わりにする。抜粋が無い結果は取り直した本文を使う
+        highlights = (result.get("@search.highlights") or {}).get("chunk") or []
+        content = " … ".join(highlights) if highlights else result.get("chunk") or ""
+        return {
+            "content": content,
+            "title": result.get("title", ""),
+            "score": result.get("@search.score", 0.0),
+            "locations": result.get("locations") or [],
+            "parent_id": result.get("parent_id"),
+            "chunk_id": result.get("chunk_id"),
+        }
+
+    def build_context(self, documents: list) -> BuiltContext:
+        # 重複を含む隣接チャンクをつなげてから予算内に詰める
+        if self.merge_adjacent_chunks:
+            documents = merge_adjacent_chunks(documents)
+        return self.context_builder.build(documents, self.deployment_name)
+
+    def _build_messages(self, query: str, context: str, history: Optional[list[dict]] = None) -> list[dict]:
+        """history には ConversationMemory.history_messages の結果（要約と直近のやり取り）を渡す"""
+        return [
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            *(history or []),
+            {"role": "user", "content": f"コンテキスト情報:\n{context}\n\n質問: {query}"},
+        ]
+
+    @staticmethod
+    def _build_summary_messages(summary: str, turns: list[tuple[str, str]]) -> list[dict]:
+        lines = [f"これまでの要約:\n{summary or '（なし）'}", "新しいやり取り:"]
+        for query, response in turns:
+            lines.append(f"ユーザー: {query}\nアシスタント: {response}")
+        return [
+            {"role": "system", "content": SUMMARY_SYSTEM_MESSAGE},
+            {"role": "user", "content": "\n\n".join(lines)},
+        ]
+
+    def _temperature(self, search_mode: str) -> float:
+        return 0.3 if search_mode in ("hybrid", "semantic", search_backend.FUSION_SEARCH_MODE) else 0.7
+
+
+class RagClient(BaseRagClient):
+    def _init_cients(self) -> None:
+        # リクエストごとに TLS ハンドシェイクが発生しないよう、プール済みのセッションを使い回す
+        self._search_session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_config.max_keepalive_connections,
+            pool_maxsize=self.pool_config.max_connections,
+        )
+        self._search_session.mount("https://", adapter)
+        self._search_session.mount("http://", adapter)
         self.search_client = SearchClient(
             endpoint=self.search_endpoint,
             index_name=self.search_index_name,
             credential=AzureKeyCredential(self.search_api_key),
+            transport=RequestsTransport(
+                session=self._search_session,
+                session_owner=False,
+                read_timeout=self.pool_config.timeout,
+            ),
         )
 
+        self._http_client = httpx.Client(
+            limits=self.pool_config.httpx_limits(),
+            timeout=self.pool_config.timeout,
+        )
         self.openai_client = AzureOpenAI(
             azure_endpoint=self.openai_endpoint,
             api_key=self.openai_api_key,
             api_version=self.api_version,
+            http_client=self._http_client,
         )
 
-    def find_documents(self, query: str, top_k: int = 3) -> list:
-        try:
-            # ベクトルクエリの設定
-            vector_query = VectorizableTextQuery(
-                text=query, k_nearest_neighbors=50, fields="text_vector"
-            )
+    def close(self) -> None:
+        self.search_client.close()
+        self._search_session.close()
+        self.openai_client.close()
+        self._http_client.close()
 
-            # 検索モードに基づいて検索を実行
-            search_results = None  # 初期化
-            if (
-                self.search_mode == "semantic"
-            ):  # セマンティック検索+ハイブリット検索 + スコアリング
-                search_results = self.search_client.search(
-                    search_text=query,
-                    query_type="semantic",
-                    scoring_profile="my-scoring-profile",
-                    semantic_configuration_name="my-semantic-config",
-                    scoring_parameters=["tags-ocean, 'sea surface', seas, surface"],
-                    vector_queries=[vector_query],
-                    select="*",
-                    top=top_k,
-                )
-            elif self.search_mode == "hybrid":  # ハイブリット検索
-                search_results = self.search_client.search(
-                    search_text=query,
-                    vector_queries=[vector_query],
-                    select="*",
-                    top=top_k,
-                )
-            else:  # デフォルトのフルテキスト検索
-                search_results = self.search_client.search(
-                    search_text="*",
-                    select="*",
-                    top=top_k,
-                )
+    def find_documents(self, query: str, top_k: int = 3, search_mode: str = "full") -> list:
+        try:
+            search_results = self.search_client.search(**self._build_search_kwargs(query, top_k, search_mode))
 
             # 検索結果がNoneの場合のチェック
             if search_results is None:
                 logger.error("検索結果が取得できませんでした")
                 return []
 
+            results = [dict(result) for result in search_results]
+            missing_ids = search_backend.missing_content_ids(results) if self.return_highlights else []
+            if missing_ids:
+                lookup_kwargs = search_backend.build_lookup_kwargs(missing_ids, [search_backend.CONTENT_FIELD])
+                search_backend.merge_content(results, list(self.search_client.search(**lookup_kwargs)))
+
             # 検索結果の処理
-            documents = []
-            for result in search_results:
-                doc = {
-                    "content": result.get("chunk", ""),
-                    "title": result.get("title", ""),
-                    "score": result.get("@search.score", 0.0),
-                    "locations": result.get("locations", []),
-                }
-                documents.append(doc)
-
-            return documents
+            return [self._to_document(result) for result in results]
 
         except Exception as e:
             logger.error(f"検索エラーの詳細: {str(e)}")
             raise Exception(f"ドキュメント検索中にエラーが発生しました: {e}")
 
-    def create_response(self, query: str, documents: list) -> str:
-        try:
-            context = self._generate_context_from_documents(documents)
-            system_message = """
-            あなたは有能なアシスタントです。以下のコンテキスト情報を使用して、ユーザーの質問に回答してください。
-            """
-            messages = [
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": f"コンテキスト情報:\n{context}\n\n質問: {query}"},
-            ]
+    def create_response(self, query: str, documents: list, search_mode: str = "full") -> str:
+        return self.generate_answer(query, self.build_context(documents), search_mode=search_mode)
 
+    def generate_answer(self, query: str, context: BuiltContext, search_mode: str = "full") -> str:
+        try:
             # FIXME: 必要ならResponse API形式に変更
             response = self.openai_client.chat.completions.create(
                 model=self.deployment_name,
-                messages=messages,
-                temperature=(
-                    0.3 if self.search_mode == "hybrid" or self.search_mode == "semantic" else 0.7
-                ),
+                messages=self._build_messages(query, context.text),
+                temperature=self._temperature(search_mode),
                 max_tokens=1024,
             )
             return response.choices[0].message.content
         except Exception as e:
             logger.error(f"応答生成中にエラーが発生しました: {e}")
-            return "申し訳ありませんが、現在質問に答えることができません。後でもう一度お試しください。"
-
-    def _generate_context_from_documents(self, documents: list) -> str:
-        context_parts = []
-        for doc in documents:
-            context_parts.append(
-                f"タイトル: {doc['title']}\n内容: {doc['content']}\nスコア: {doc['score']:.2f}\n"
-            )
-        return "\n---\n".join(context_parts)
+            return FALLBACK_RESPONSE
 
-    def get_response_with_rag(self, query: str) -> dict:
-        documents = self.find_documents(query, top_k=self.top_k)
-        response = self.create_response(query, documents)
+    def get_response_with_rag(self, query: str, top_k: int = 3, search_mode: str = "full") -> dict:
+        documents = self.find_documents(query, top_k=top_k, search_mode=search_mode)
+        context = self.build_context(documents)
+        response = self.generate_answer(query, context, search_mode=search_mode)
         return {
             "query": query,
             "response": response,
-            "documents": documents,
-            "search_mode": self.search_mode,
+            # 非同期版と同じく、実際にプロンプトに入れたドキュメントだけを返す
+            "documents": context.documents,
+            "search_mode": search_mode,
         }
@@ -0,0 +1,158 @@
+import os
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+
+from back.api.services.answer_cache import AnswerCache
+from back.api.services.async_rag_client import AsyncRagClient
+from back.api.services.embedding_cache import EmbeddingCache
+from back.api.services.local_search_backend import LocalSearchBackend
+from back.api.services.query_filters import QueryAnalyzer
+from back.api.services.rag_client import RagClientPoolConfig
+from back.api.services.rate_limiter import RateLimiters
+from back.api.services.reranker import LocalReranker, MMRDiversifier, Reranker
+from back.api.services.retrieval_cache import RetrievalCache
+from back.api.services.search_backend import SearchBackend
+from back.api.services.single_flight import SingleFlight
+from back.api.utils.logging import logger
+from fastapi import Request
+
+
+# (index, deployment, api_version) をキーとして AsyncRagClient を保持する
+RagClientKey = tuple[str, str, str]
+
+# RagChatRequest.model の既定値（ALLOWED_DEPLOYMENTS が未指定でも使えるようにする）
+DEFAULT_DEPLOYMENT = "gpt-4o"
+
+
+class UnknownDeploymentError(ValueError):
+    """許可されていないデプロイメントが指定された場合のエラー"""
+
+
+class RagClientRegistry:
+    """アプリのライフスパンの間、AsyncRagClient を使い回すためのレジストリ
+
+    SearchClient / AsyncAzureOpenAI は並行利用できるので、同じキーのクライアントは全リクエストで共有する。
+    """
+
+    def __init__(
+        self,
+        pool_config: Optional[RagClientPoolConfig] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        retrieval_cache: Optional[RetrievalCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        search_backend: Optional[SearchBackend] = None,
+        single_flight: Optional[SingleFlight] = None,
+        rate_limiters: Optional[RateLimiters] = None,
+        reranker: Optional[Reranker] = None,
+        diversifier: Optional[Reranker] = None,
+        query_analyzer: Optional[QueryAnalyzer] = None,
+        allowed_deployments: Optional[Iterable[str]] = None,
+    ):
+        # deployment はリクエストで指定されるので、許可したものだけクライアントを作る（レジストリが際限なく増えないように）
+        self.allowed_deployments = (
+            frozenset(allowed_deployments) if allowed_deployments is not None else self._allowed_deployments_from_env()
+        )
+        self.pool_config = pool_config or RagClientPoolConfig.from_env()
+        # キーに deployment と index を含むので、応答キャッシュは全クライアントで共有する
+        self.answer_cache = answer_cache if answer_cache is not None else AnswerCache.from_env()
+        self.retrieval_cache = retrieval_cache if retrieval_cache is not None else RetrievalCache.from_env()
+        self.embedding_cache = embedding_cache if embedding_cache is not None else EmbeddingCache.from_env()
+        # キーに deployment と index を含むので、実行中の処理への合流も全クライアントで共有する
+        self.single_flight = single_flight if single_flight is not None else SingleFlight.from_env()
+        # レート制限はデプロイメント・インデックスごとなので、同じものを使うクライアント間で共有する
+        self.rate_limiters = rate_limiters if rate_limiters is not None else RateLimiters.from_env()
+        # None の場合は並べ直さない（RERANK_ENABLED=true で LocalReranker を使う）
+        self.reranker = reranker if reranker is not None else LocalReranker.from_env()
+        # None の場合は MMR で選び直さない（MMR_ENABLED=true で MMRDiversifier を使う）
+        self.diversifier = diversifier if diversifier is not None else MMRDiversifier.from_env()
+        # クエリに含まれる地名での絞り込み・ブースト（地名の一覧が無ければ何もしない）
+        self.query_analyzer = query_analyzer if query_analyzer is not None else QueryAnalyzer.from_env()
+        # None の場合は各クライアントがインデックスごとに Azure AI Search のバックエンドを持つ
+        self.search_backend = search_backend if search_backend is not None else self._create_search_backend()
+        self._clients: dict[RagClientKey, AsyncRagClient] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def get_client(
+        self,
+        deployment_name: str,
+        search_index_name: Optional[str] = None,
+        api_version: Optional[str] = None,
+    ) -> AsyncRagClient:
+        index_name = search_index_name or os.getenv("SEARCH_INDEX_NAME") or os.getenv("INDEX_NAME") or ""
+        version = api_version or os.getenv("API_VERSION") or ""
+        if deployment_name not in self.allowed_deployments:
+            raise UnknownDeploymentError(f"deployment {deployment_name!r} は使用できません。")
+        key = (index_name, deployment_name, version)
+
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("RagClientRegistry は既にクローズされています。")
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create_client(*key)
+                self._clients[key] = client
+                logger.info("RagClient を作成しました index=%s deployment=%s", index_name, deployment_name)
+            return client
+
+    @staticmethod
+    def _allowed_deployments_from_env() -> frozenset[str]:
+        """ALLOWED_DEPLOYMENTS（カンマ区切り）を読む。未指定なら DEPLOYMENT_NAME と既定のモデルだけを許可する"""
+        value = os.getenv("ALLOWED_DEPLOYMENTS")
+        if value is not None:
+            return frozenset(name.strip() for name in value.split(",") if name.strip())
+        return frozenset(name for name in (os.getenv("DEPLOYMENT_NAME"), DEFAULT_DEPLOYMENT) if name)
+
+    @staticmethod
+    def _create_search_backend() -> Optional[SearchBackend]:
+        if os.getenv("SEARCH_BACKEND", "azure") != "local":
+            return None
+        index_dir = os.getenv("LOCAL_INDEX_DIR")
+        if not index_dir:
+            raise ValueError("SEARCH_BACKEND=local の場合は LOCAL_INDEX_DIR を指定してください。")
+        logger.info("ローカルの検索インデックスを読み込みます %s", index_dir)
+        return LocalSearchBackend.load(Path(index_dir))
+
+    def _create_client(self, search_index_name: str, deployment_name: str, api_version: str) -> AsyncRagClient:
+        return AsyncRagClient(
+            search_endpoint=os.getenv("SEARCH_ENDPOINT"),
+            search_api_key=os.getenv("SEARCH_API_KEY"),
+            search_index_name=search_index_name,
+            openai_endpoint=os.getenv("OPENAI_ENDPOINT"),
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            deployment_name=deployment_name,
+            api_version=api_version,
+            pool_config=self.pool_config,
+            answer_cache=self.answer_cache,
+            retrieval_cache=self.retrieval_cache,
+            embedding_cache=self.embedding_cache,
+            search_backend=self.search_backend,
+            single_flight=self.single_flight,
+            rate_limiters=self.rate_limiters,
+            reranker=self.reranker,
+            diversifier=self.diversifier,
+            query_analyzer=self.query_analyzer,
+        )
+
+    async def aclose(self) -> None:
+        with self._lock:
+            self._closed = True
+            clients = list(self._clients.values())
+            self._clients.clear()
+
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error("RagClient のクローズ中にエラーが発生しました %s", e)
+        if self.search_backend is not None:
+            await self.search_backend.aclose()
+
+
+def get_rag_client_registry(request: Request) -> RagClientRegistry:
+    return request.app.state.rag_client_registry
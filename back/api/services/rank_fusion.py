@@ -0,0 +1,45 @@
+from typing import Callable, Hashable, Optional, Sequence
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: Sequence[Sequence[Hashable]],
+    weights: Optional[Sequence[float]] = None,
+    k: int = 60,
+) -> list[tuple[Hashable, float]]:
+    """複数の順位リストを Reciprocal Rank Fusion で統合し、(ID, スコア) をスコアの降順で返す"""
+    weights = weights or [1.0] * len(ranked_lists)
+    scores: dict[Hashable, float] = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, item in enumerate(ranked):
+            scores[item] = scores.get(item, 0.0) + weight / (k + rank + 1)
+    return sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+
+
+def _result_key(result: dict) -> Hashable:
+    # chunk_id を取得していない場合は本文で同一視する（どちらも無ければ同一視しない）
+    return result.get("chunk_id") or result.get("chunk") or id(result)
+
+
+def fuse_search_results(
+    result_lists: Sequence[Sequence[dict]],
+    weights: Optional[Sequence[float]] = None,
+    k: int = 60,
+    key: Callable[[dict], Hashable] = _result_key,
+) -> list[dict]:
+    """複数の検索結果を RRF で統合し、@search.score を統合後のスコアに置き換えてスコアの降順で返す
+
+    同じチャンクが複数のリストにある場合は、先に渡したリストの結果（フィールド）を使う。
+    """
+    by_key: dict[Hashable, dict] = {}
+    ranked_lists = []
+    for results in result_lists:
+        ranked = []
+        for result in results:
+            result_key = key(result)
+            by_key.setdefault(result_key, result)
+            ranked.append(result_key)
+        ranked_lists.append(ranked)
+    return [
+        {**by_key[result_key], "@search.score": score}
+        for result_key, score in reciprocal_rank_fusion(ranked_lists, weights=weights, k=k)
+    ]
@@ -0,0 +1,313 @@
+import asyncio
+import json
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Mapping, Optional, TypeVar
+
+import openai
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from back.api.utils.metrics import RATE_LIMIT_RETRIES, RATE_LIMIT_WAIT, RATE_LIMIT_WAITING
+from back.api.utils.timing import span
+
+
+T = TypeVar("T")
+
+# (リトライの理由, レスポンスヘッダー)。リトライしない例外の場合は None
+RetryInfo = Optional[tuple[str, Mapping[str, str]]]
+
+
+class RateLimitExceededError(Exception):
+    """リトライしても 429 が続いた"""
+
+    def __init__(self, limiter: str, retry_after: Optional[float] = None):
+        super().__init__(f"{limiter} のレート制限を超えました")
+        self.limiter = limiter
+        self.retry_after = retry_after
+
+
+class _Bucket:
+    """1 分あたり per_minute を補充するトークンバケット"""
+
+    def __init__(self, per_minute: int, now: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # 1 回で容量を超える量は、満タンになるまで待てば通す
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def cap(self, remaining: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+    def adjust(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """デプロイメント（またはインデックス）ごとの RPM・TPM をクライアント側で守る
+
+    上限に達したリクエストは失敗させずに到着順に待たせる。サーバーが返す Retry-After の間は全リクエストを止め、
+    x-ratelimit-remaining-requests / x-ratelimit-remaining-tokens がこちらの見積もりより少なければそれに合わせる。
+    上限を指定しない場合もヘッダーによる調整と Retry-After には従う。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self._clock = clock
+        now = clock()
+        self._requests = _Bucket(requests_per_minute, now) if requests_per_minute else None
+        self._tokens = _Bucket(tokens_per_minute, now) if tokens_per_minute else None
+        self._paused_until = 0.0
+        self._waiting = 0
+        self._lock = asyncio.Lock()
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        wait = self._paused_until - now
+        if self._requests is not None:
+            wait = max(wait, self._requests.wait_time(1, now))
+        if self._tokens is not None:
+            wait = max(wait, self._tokens.wait_time(tokens, now))
+        return wait
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """送信できるまで待ち、待った秒数を返す"""
+        start = self._clock()
+        if self._waiting == 0 and self._wait_time(tokens, start) <= 0:
+            self._consume(tokens, start)
+            RATE_LIMIT_WAIT.observe(0.0, limiter=self.name)
+            return 0.0
+
+        self._waiting += 1
+        RATE_LIMIT_WAITING.set(self._waiting, limiter=self.name)
+        try:
+            with span("rate_limit_wait"):
+                # ロックを取った順に 1 件ずつ待つので、大きなリクエストが後続に追い越され続けることはない
+                async with self._lock:
+                    while (wait := self._wait_time(tokens, self._clock())) > 0:
+                        await asyncio.sleep(wait)
+                    self._consume(tokens, self._clock())
+        finally:
+            self._waiting -= 1
+            RATE_LIMIT_WAITING.set(self._waiting, limiter=self.name)
+        waited = self._clock() - start
+        RATE_LIMIT_WAIT.observe(waited, limiter=self.name)
+        return waited
+
+    def _consume(self, tokens: int, now: float) -> None:
+        if self._requests is not None:
+            self._requests.consume(1, now)
+        if self._tokens is not None:
+            self._tokens.consume(tokens, now)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """見積もりと実際のトークン数の差を戻す（実際の方が多ければ追加で差し引く）"""
+        if self._tokens is not None:
+            self._tokens.adjust(estimated_tokens - actual_tokens)
+
+    def refund(self, tokens: int) -> None:
+        """429 などで処理されなかったリクエストの分を戻す"""
+        self.settle(tokens, 0)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        now = self._clock()
+        remaining_requests = _parse_number(headers.get("x-ratelimit-remaining-requests"))
+        if remaining_requests is not None and self._requests is not None:
+            self._requests.cap(remaining_requests, now)
+        remaining_tokens = _parse_number(headers.get("x-ratelimit-remaining-tokens"))
+        if remaining_tokens is not None and self._tokens is not None:
+            self._tokens.cap(remaining_tokens, now)
+
+
+class RetryPolicy:
+    """429・一時的なエラーのリトライ回数と待ち時間
+
+    Retry-After がある場合はその秒数にジッターを足し、無い場合は指数バックオフの範囲で一様にばらつかせる。
+    """
+
+    def __init__(self, max_retries: int = 4, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        return cls(
+            max_retries=int(os.getenv("RATE_LIMIT_MAX_RETRIES", "4")),
+            base_delay=float(os.getenv("RATE_LIMIT_BASE_DELAY", "0.5")),
+            max_delay=float(os.getenv("RATE_LIMIT_MAX_DELAY", "30")),
+        )
+
+    def delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            # 同時に 429 を受けたリクエストが一斉に再送しないよう、少しずらす
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+async def call_with_retries(
+    limiter: RateLimiter,
+    policy: RetryPolicy,
+    fn: Callable[[], Awaitable[T]],
+    classify: Callable[[Exception], RetryInfo],
+    tokens: int = 0,
+) -> T:
+    """limiter の枠を取ってから fn を呼び、429・一時的なエラーならリトライする
+
+    429 がリトライの上限まで続いた場合は RateLimitExceededError、それ以外のエラーは元の例外を投げる。
+    """
+    for attempt in range(policy.max_retries + 1):
+        await limiter.acquire(tokens)
+        try:
+            return await fn()
+        except Exception as e:
+            info = classify(e)
+            if info is None:
+                raise
+            reason, headers = info
+            retry_after = parse_retry_after(headers)
+            # 処理されなかった試行の分は戻し、次の試行で改めて取る（残り枠のヘッダーがあればそちらに合わせる）
+            limiter.refund(tokens)
+            limiter.observe_headers(headers)
+            if attempt == policy.max_retries:
+                if reason == "rate_limited":
+                    raise RateLimitExceededError(limiter.name, retry_after) from e
+                raise
+            RATE_LIMIT_RETRIES.inc(limiter=limiter.name, reason=reason)
+            delay = policy.delay(attempt, retry_after)
+            if retry_after is not None:
+                # サーバーが指定した間は、このリミッターを使う他のリクエストも止める
+                limiter.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    for name, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001)):
+        value = _parse_number(headers.get(name))
+        if value is not None:
+            return max(0.0, value * scale)
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    seconds = _parse_number(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        # HTTP 日付の形式
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_number(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def classify_openai_error(error: Exception) -> RetryInfo:
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code == 429:
+            return "rate_limited", error.response.headers
+        if error.status_code in (408, 409) or error.status_code >= 500:
+            return "transient", error.response.headers
+        return None
+    if isinstance(error, openai.APIConnectionError):
+        return "transient", {}
+    return None
+
+
+def classify_azure_error(error: Exception) -> RetryInfo:
+    if isinstance(error, HttpResponseError):
+        headers = error.response.headers if error.response is not None else {}
+        if error.status_code == 429:
+            return "rate_limited", headers
+        if error.status_code is not None and (error.status_code in (408, 409) or error.status_code >= 500):
+            return "transient", headers
+        return None
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return "transient", {}
+    return None
+
+
+class RateLimiters:
+    """Azure OpenAI のデプロイメント・Azure AI Search のインデックスごとの RateLimiter
+
+    OPENAI_RATE_LIMITS に {"gpt-4o": {"rpm": 300, "tpm": 50000}} の形でデプロイメントごとの上限を指定できる。
+    指定の無いデプロイメントには OPENAI_RPM_LIMIT・OPENAI_TPM_LIMIT を使う（未指定なら上限なし）。
+    """
+
+    def __init__(
+        self,
+        openai_limits: Optional[dict[str, dict[str, int]]] = None,
+        openai_rpm: Optional[int] = None,
+        openai_tpm: Optional[int] = None,
+        search_rpm: Optional[int] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        self.openai_limits = openai_limits or {}
+        self.openai_rpm = openai_rpm
+        self.openai_tpm = openai_tpm
+        self.search_rpm = search_rpm
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._limiters: dict[str, RateLimiter] = {}
+
+    @classmethod
+    def from_env(cls) -> "RateLimiters":
+        limits = os.getenv("OPENAI_RATE_LIMITS")
+        return cls(
+            openai_limits=json.loads(limits) if limits else None,
+            openai_rpm=_optional_int(os.getenv("OPENAI_RPM_LIMIT")),
+            openai_tpm=_optional_int(os.getenv("OPENAI_TPM_LIMIT")),
+            search_rpm=_optional_int(os.getenv("SEARCH_RPM_LIMIT")),
+            retry_policy=RetryPolicy.from_env(),
+        )
+
+    def openai(self, deployment_name: str) -> RateLimiter:
+        limits = self.openai_limits.get(deployment_name, {})
+        return self._get(
+            f"openai:{deployment_name}",
+            requests_per_minute=limits.get("rpm", self.openai_rpm),
+            tokens_per_minute=limits.get("tpm", self.openai_tpm),
+        )
+
+    def search(self, index_name: str) -> RateLimiter:
+        return self._get(f"search:{index_name}", requests_per_minute=self.search_rpm)
+
+    def _get(self, name: str, **limits: Optional[int]) -> RateLimiter:
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            limiter = self._limiters[name] = RateLimiter(name, **limits)
+        return limiter
+
+
+def _optional_int(value: Optional[str]) -> Optional[int]:
+    return int(value) if value else None
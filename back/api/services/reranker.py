@@ -0,0 +1,199 @@
+import os
+from typing import Any, Optional, Protocol, Sequence
+
+import numpy as np
+from back.api.services.local_search_backend import bm25_scores
+
+
+class Reranker(Protocol):
+    """find_documents の後で候補を並べ直し、上位 top_k 件に絞る
+
+    find_documents は top_k の代わりに candidate_pool 件を検索し、needs_vectors が True の場合は
+    チャンクのベクトルを chunk_id で引いて渡す（埋め込みキャッシュに無いものだけ取得する）。
+    needs_query_vector が True の場合はクエリの埋め込みも渡す。
+    """
+
+    name: str
+    candidate_pool: int
+    needs_vectors: bool
+    needs_query_vector: bool
+
+    def options(self) -> dict[str, Any]:
+        """検索結果キャッシュのキーに含める設定"""
+        ...
+
+    def rerank(
+        self,
+        query: str,
+        documents: list[dict],
+        top_k: int,
+        query_vector: Optional[np.ndarray] = None,
+        vectors: Optional[Sequence[Optional[Sequence[float]]]] = None,
+    ) -> list[dict]:
+        """documents を並べ替えて上位 top_k 件を返す（vectors は documents と同じ順のチャンクのベクトル）"""
+
+
+def _min_max(scores: np.ndarray) -> np.ndarray:
+    low, high = float(scores.min()), float(scores.max())
+    if high - low < 1e-12:
+        return np.zeros_like(scores)
+    return (scores - low) / (high - low)
+
+
+class LocalReranker:
+    """候補チャンクだけで作った BM25 とクエリ・チャンク間のコサイン類似度の加重和で並べ直す
+
+    セマンティックランカーの代わりに、より大きな候補から数ミリ秒で上位を選ぶ。どちらのスコアも候補内で
+    0〜1 に正規化してから重みを掛け、ドキュメントの score を並べ直した後のスコアに置き換える。
+    ベクトルが取得できなかった場合は BM25 だけで並べる。
+    """
+
+    name = "rerank"
+
+    def __init__(self, candidate_pool: int = 50, keyword_weight: float = 0.5, vector_weight: float = 0.5):
+        self.candidate_pool = candidate_pool
+        self.keyword_weight = keyword_weight
+        self.vector_weight = vector_weight
+
+    @classmethod
+    def from_env(cls) -> Optional["LocalReranker"]:
+        if os.getenv("RERANK_ENABLED", "false").lower() != "true":
+            return None
+        return cls(
+            candidate_pool=int(os.getenv("RERANK_CANDIDATES", "50")),
+            keyword_weight=float(os.getenv("RERANK_KEYWORD_WEIGHT", "0.5")),
+            vector_weight=float(os.getenv("RERANK_VECTOR_WEIGHT", "0.5")),
+        )
+
+    @property
+    def needs_vectors(self) -> bool:
+        return self.vector_weight > 0
+
+    @property
+    def needs_query_vector(self) -> bool:
+        return self.needs_vectors
+
+    def options(self) -> dict[str, Any]:
+        return {"rerank": [self.candidate_pool, self.keyword_weight, self.vector_weight]}
+
+    def rerank(
+        self,
+        query: str,
+        documents: list[dict],
+        top_k: int,
+        query_vector: Optional[np.ndarray] = None,
+        vectors: Optional[Sequence[Optional[Sequence[float]]]] = None,
+    ) -> list[dict]:
+        if not documents:
+            return []
+
+        scores = self.keyword_weight * _min_max(bm25_scores(query, [doc["content"] for doc in documents]))
+        similarities = self._similarities(query_vector, vectors, len(documents))
+        if similarities is not None:
+            scores = scores + self.vector_weight * _min_max(similarities)
+
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [{**documents[i], "score": float(scores[i])} for i in order]
+
+    def _similarities(
+        self,
+        query_vector: Optional[np.ndarray],
+        vectors: Optional[Sequence[Optional[Sequence[float]]]],
+        count: int,
+    ) -> Optional[np.ndarray]:
+        if not self.needs_vectors or query_vector is None:
+            return None
+        matrix = _vector_matrix(vectors, count)
+        if matrix is None:
+            return None
+        query = np.asarray(query_vector, dtype=np.float32)
+        return matrix @ (query / max(float(np.linalg.norm(query)), 1e-12))
+
+
+def _vector_matrix(vectors: Optional[Sequence[Optional[Sequence[float]]]], count: int) -> Optional[np.ndarray]:
+    """ベクトルを行ごとに正規化した (count, 次元数) の行列。1 件でも欠けていれば None"""
+    if not vectors or len(vectors) != count or any(vector is None for vector in vectors):
+        return None
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def mmr_select(
+    relevance: np.ndarray,
+    vectors: np.ndarray,
+    k: int,
+    lambda_: float = 0.7,
+    duplicate_threshold: Optional[float] = None,
+) -> list[int]:
+    """Maximal Marginal Relevance で k 件を選び、選んだ順のインデックスを返す
+
+    vectors は行ごとに正規化済みであること。類似度行列は最初に 1 度だけ計算し、選ぶたびに各候補の
+    「選択済みとの最大類似度」をベクトル演算で更新する。duplicate_threshold 以上に似た候補は選ばない
+    （その結果 k 件に満たないことがある）。
+    """
+    count = relevance.shape[0]
+    k = min(k, count)
+    if k <= 0:
+        return []
+    similarity = vectors @ vectors.T
+    max_similarity = np.full(count, -np.inf, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    selected = [int(np.argmax(relevance))]
+    while True:
+        chosen = selected[-1]
+        available[chosen] = False
+        max_similarity = np.maximum(max_similarity, similarity[chosen])
+        if duplicate_threshold is not None:
+            available &= max_similarity < duplicate_threshold
+        if len(selected) == k or not available.any():
+            return selected
+        scores = lambda_ * relevance - (1 - lambda_) * max_similarity
+        selected.append(int(np.argmax(np.where(available, scores, -np.inf))))
+
+
+class MMRDiversifier:
+    """ほぼ同じ内容のチャンクが上位を占めないよう、MMR で候補から top_k 件を選び直す
+
+    関連度には検索（または前段の並べ直し）のスコアを候補内で 0〜1 に正規化したもの、冗長さにはチャンクの
+    ベクトル同士のコサイン類似度を使うので、クエリの埋め込みは不要。lambda_ が 1 に近いほど関連度を、
+    0 に近いほど多様さを重視する。ベクトルが取得できなかった場合は元の順のまま top_k 件に絞る。
+    選んだドキュメントの score は変えない。
+    """
+
+    name = "mmr"
+    needs_vectors = True
+    needs_query_vector = False
+
+    def __init__(self, lambda_: float = 0.7, candidate_pool: int = 20, duplicate_threshold: Optional[float] = None):
+        self.lambda_ = lambda_
+        self.candidate_pool = candidate_pool
+        self.duplicate_threshold = duplicate_threshold
+
+    @classmethod
+    def from_env(cls) -> Optional["MMRDiversifier"]:
+        if os.getenv("MMR_ENABLED", "false").lower() != "true":
+            return None
+        threshold = os.getenv("MMR_DUPLICATE_THRESHOLD")
+        return cls(
+            lambda_=float(os.getenv("MMR_LAMBDA", "0.7")),
+            candidate_pool=int(os.getenv("MMR_CANDIDATES", "20")),
+            duplicate_threshold=float(threshold) if threshold else None,
+        )
+
+    def options(self) -> dict[str, Any]:
+        return {"mmr": [self.lambda_, self.candidate_pool, self.duplicate_threshold]}
+
+    def rerank(
+        self,
+        query: str,
+        documents: list[dict],
+        top_k: int,
+        query_vector: Optional[np.ndarray] = None,
+        vectors: Optional[Sequence[Optional[Sequence[float]]]] = None,
+    ) -> list[dict]:
+        matrix = _vector_matrix(vectors, len(documents))
+        if matrix is None:
+            return documents[:top_k]
+        relevance = _min_max(np.array([doc.get("score") or 0.0 for doc in documents], dtype=np.float32))
+        selected = mmr_select(relevance, matrix, top_k or len(documents), self.lambda_, self.duplicate_threshold)
+        return [documents[i] for i in selected]
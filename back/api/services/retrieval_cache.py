@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+from typing import Any, Optional
+
+from back.api.services.answer_cache import normalize_query
+from back.api.utils.ttl_lru_cache import TTLLRUCache
+
+
+# (index, 全体の世代, インデックスの世代, 正規化済みクエリ, search_mode, top_k, その他の検索条件)
+RetrievalCacheKey = tuple[str, int, int, str, str, int, str]
+
+
+def _sizeof_documents(documents: list) -> int:
+    return len(json.dumps(documents, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class RetrievalCache:
+    """find_documents の検索結果をキャッシュする
+
+    インデックスごとの世代番号と全インデックス共通の世代番号をキーに含める。インデクサーの実行などでインデックスが
+    更新されたら invalidate() で世代を進めると、古い世代のエントリは参照されなくなり LRU で順次追い出される。
+    """
+
+    def __init__(self, max_entries: int = 4096, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self._cache: TTLLRUCache[list] = TTLLRUCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            ttl=ttl,
+            sizeof=_sizeof_documents,
+        )
+        self.stats = self._cache.stats
+        self._generations: dict[str, int] = {}
+        # invalidate() でインデックスを省略した場合に進める。まだ世代を持たないインデックスの検索結果も無効にできる
+        self._epoch = 0
+        self._index_versions: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["RetrievalCache"]:
+        if os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() != "true":
+            return None
+        max_bytes = os.getenv("RETRIEVAL_CACHE_MAX_BYTES")
+        return cls(
+            max_entries=int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "4096")),
+            max_bytes=int(max_bytes) if max_bytes else 128 * 1024 * 1024,
+            ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", "3600")),
+        )
+
+    def generation(self, index_name: str) -> int:
+        return self._generations.get(index_name, 0)
+
+    def generation_tag(self, index_name: str) -> str:
+        """全体の世代とインデックスの世代をまとめた文字列（invalidate() のたびに変わる）"""
+        return f"{self._epoch}.{self.generation(index_name)}"
+
+    def make_key(
+        self,
+        index_name: str,
+        query: str,
+        search_mode: str,
+        top_k: Optional[int],
+        options: Any = None,
+    ) -> RetrievalCacheKey:
+        return (
+            index_name,
+            self._epoch,
+            self.generation(index_name),
+            normalize_query(query),
+            str(search_mode),
+            top_k or 0,
+            json.dumps(options, sort_keys=True, default=str) if options else "",
+        )
+
+    def get(self, key: RetrievalCacheKey) -> Optional[list]:
+        documents = self._cache.get(key)
+        return list(documents) if documents is not None else None
+
+    def set(self, key: RetrievalCacheKey, documents: list) -> None:
+        # 世代が進んだ後に完了した検索結果は古い可能性があるので保存しない
+        if key[1] != self._epoch or key[2] != self.generation(key[0]):
+            return
+        self._cache.set(key, list(documents))
+
+    def invalidate(self, index_name: Optional[str] = None) -> None:
+        """指定したインデックス（省略時はすべて）のキャッシュを無効化する"""
+        with self._lock:
+            if index_name is None:
+                self._epoch += 1
+                self._cache.clear()
+                return
+            self._generations[index_name] = self.generation(index_name) + 1
+
+    def set_index_version(self, index_name: str, version: str) -> bool:
+        """インデックスのバージョンを通知する。前回と異なれば無効化して True を返す"""
+        with self._lock:
+            previous = self._index_versions.get(index_name)
+            self._index_versions[index_name] = version
+        if previous is not None and previous != version:
+            self.invalidate(index_name)
+            return True
+        return False
+
+    def stats_dict(self) -> dict[str, Any]:
+        return {
+            **self.stats.to_dict(),
+            "entries": len(self._cache),
+            "epoch": self._epoch,
+            "generations": dict(self._generations),
+        }
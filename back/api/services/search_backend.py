@@ -0,0 +1,242 @@
+from typing import TYPE_CHECKING, Any, Optional, Protocol, Sequence
+
+import aiohttp
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
+from back.api.services.query_filters import SCORING_PROFILE, SearchFilters
+
+
+if TYPE_CHECKING:
+    from back.api.services.rag_client import RagClientPoolConfig
+
+
+VECTOR_SEARCH_MODES = ("hybrid", "semantic", "vector")
+# fusion モードはキーワード検索とベクトル検索を並行に実行し、AsyncRagClient 側で統合する
+FUSION_SEARCH_MODE = "fusion"
+# fusion モードの内部で使う、キーワードだけ・ベクトルだけの検索
+KEYWORD_SEARCH_MODE = "keyword"
+VECTOR_SEARCH_MODE = "vector"
+
+# パイプラインで使うフィールドだけを取得し、1536 次元の text_vector はダウンロードしない
+DEFAULT_SELECT_FIELDS = ("chunk", "title", "locations", "parent_id", "chunk_id")
+CONTENT_FIELD = "chunk"
+CHUNK_ID_FIELD = "chunk_id"
+VECTOR_FIELD = "text_vector"
+
+
+class SearchError(Exception):
+    """検索バックエンドでのエラー（レート制限の超過は RateLimitExceededError）"""
+
+
+class SearchQuery:
+    """検索バックエンドに渡す検索条件"""
+
+    def __init__(
+        self,
+        text: str,
+        top_k: Optional[int],
+        search_mode: str,
+        vector: Optional[np.ndarray] = None,
+        select: Optional[Sequence[str]] = DEFAULT_SELECT_FIELDS,
+        highlight: bool = False,
+        filters: Optional[SearchFilters] = None,
+    ):
+        self.text = text
+        self.top_k = top_k
+        self.search_mode = search_mode
+        self.vector = vector
+        # None の場合は全フィールド（select="*"）
+        self.select = select
+        # True の場合は全文の代わりにハイライトされた抜粋を受け取る。抜粋が無い結果の全文は chunk_id で取り直す
+        self.highlight = highlight
+        # locations での絞り込みとタグによるブースト
+        self.filters = filters
+
+    @property
+    def needs_vector(self) -> bool:
+        return self.search_mode in VECTOR_SEARCH_MODES
+
+
+class SearchBackend(Protocol):
+    """find_documents の背後にある検索エンジン
+
+    結果は Azure AI Search と同じフィールド名（chunk, title, locations, @search.score など）の dict で返す。
+    """
+
+    async def search(self, query: SearchQuery) -> list[dict]:
+        """検索結果を関連度の高い順に返す"""
+
+    async def lookup(self, chunk_ids: Sequence[str], fields: Sequence[str]) -> list[dict]:
+        """chunk_id を指定して fields を取得する（見つからない chunk_id の結果は含めない）"""
+
+    def embed_query(self, text: str) -> Optional[np.ndarray]:
+        """インデックスが独自の埋め込みで作られている場合は、同じ埋め込みでクエリを埋め込む
+
+        None の場合は Azure OpenAI の埋め込み（EMBEDDING_DEPLOYMENT_NAME）と同じ空間とみなす。
+        """
+        ...
+
+    async def aclose(self) -> None:
+        """接続を閉じる"""
+
+
+def build_azure_search_kwargs(query: SearchQuery) -> dict[str, Any]:
+    # ベクトルクエリの設定（埋め込み済みならそのベクトルを送る）。並べ直し用に top が 50 を超える場合は近傍数も増やす
+    k_nearest_neighbors = max(50, query.top_k or 0)
+    vector_query: VectorizableTextQuery | VectorizedQuery
+    if query.vector is not None:
+        vector_query = VectorizedQuery(
+            vector=query.vector.tolist(), k_nearest_neighbors=k_nearest_neighbors, fields=VECTOR_FIELD
+        )
+    else:
+        vector_query = VectorizableTextQuery(
+            text=query.text, k_nearest_neighbors=k_nearest_neighbors, fields=VECTOR_FIELD
+        )
+
+    if query.search_mode == VECTOR_SEARCH_MODE:  # ベクトル検索のみ
+        return {
+            "search_text": None,
+            "vector_queries": [vector_query],
+            "top": query.top_k,
+            **_build_projection(query, "*"),
+            **_build_filters(query, scoring=False),
+        }
+
+    search_text = query.text if query.search_mode in ("semantic", "hybrid", KEYWORD_SEARCH_MODE) else "*"
+    projection = _build_projection(query, search_text)
+
+    # 検索モードに基づいて検索条件を組み立てる
+    filters = _build_filters(query)
+    if query.search_mode == "semantic":  # セマンティック検索+ハイブリット検索 + スコアリング
+        return {
+            "search_text": search_text,
+            "query_type": "semantic",
+            "semantic_configuration_name": "my-semantic-config",
+            "vector_queries": [vector_query],
+            "top": query.top_k,
+            **projection,
+            **filters,
+        }
+    elif query.search_mode == "hybrid":  # ハイブリット検索
+        return {
+            "search_text": search_text,
+            "vector_queries": [vector_query],
+            "top": query.top_k,
+            **projection,
+            **filters,
+        }
+    # デフォルトのフルテキスト検索（keyword モードでは search_text にクエリが入る）
+    return {
+        "search_text": search_text,
+        "top": query.top_k,
+        **projection,
+        **filters,
+    }
+
+
+def _build_filters(query: SearchQuery, scoring: bool = True) -> dict[str, Any]:
+    # スコアリングプロファイルは全文検索のスコアにだけ効くので、ベクトル検索のみの場合は絞り込みだけを送る
+    if not query.filters:
+        return {}
+    kwargs: dict[str, Any] = {}
+    odata_filter = query.filters.odata_filter()
+    if odata_filter is not None:
+        kwargs["filter"] = odata_filter
+    scoring_parameters = query.filters.scoring_parameters()
+    if scoring and scoring_parameters:
+        kwargs["scoring_profile"] = SCORING_PROFILE
+        kwargs["scoring_parameters"] = scoring_parameters
+    return kwargs
+
+
+def _build_projection(query: SearchQuery, search_text: str) -> dict[str, Any]:
+    # select はカンマ区切りで送られるので、文字列ではなくフィールド名のリストで渡す
+    if query.select is None:
+        return {"select": ["*"]}
+
+    fields = list(query.select)
+    # ハイライトは検索語がある場合にしか返らない。本文（chunk）は取得せず、ベクトル検索だけでヒットした・
+    # タイトルだけに一致したなど抜粋が無い結果の本文は build_lookup_kwargs で chunk_id を指定して取り直す
+    if query.highlight and search_text != "*" and CHUNK_ID_FIELD in fields:
+        return {
+            "select": [field for field in fields if field != CONTENT_FIELD],
+            "highlight_fields": CONTENT_FIELD,
+            "highlight_pre_tag": "",
+            "highlight_post_tag": "",
+        }
+    return {"select": fields}
+
+
+def missing_content_ids(results: list[dict]) -> list[str]:
+    """本文もハイライトも無い検索結果の chunk_id"""
+    return [result[CHUNK_ID_FIELD] for result in results if result.get(CHUNK_ID_FIELD) and not _has_content(result)]
+
+
+def _has_content(result: dict) -> bool:
+    return CONTENT_FIELD in result or bool((result.get("@search.highlights") or {}).get(CONTENT_FIELD))
+
+
+def build_lookup_kwargs(chunk_ids: Sequence[str], fields: Sequence[str]) -> dict[str, Any]:
+    # search.in の値はカンマ区切りの文字列リテラルなので、単一引用符は 2 つ重ねてエスケープする
+    values = ",".join(chunk_ids).replace("'", "''")
+    return {
+        "search_text": "*",
+        "filter": f"search.in({CHUNK_ID_FIELD}, '{values}', ',')",
+        "select": [CHUNK_ID_FIELD, *fields],
+        "top": len(chunk_ids),
+    }
+
+
+def merge_content(results: list[dict], lookup_results: list[dict]) -> None:
+    """build_lookup_kwargs で取り直した本文を検索結果に書き戻す"""
+    contents = {result[CHUNK_ID_FIELD]: result.get(CONTENT_FIELD) for result in lookup_results}
+    for result in results:
+        if CONTENT_FIELD not in result and result.get(CHUNK_ID_FIELD) in contents:
+            result[CONTENT_FIELD] = contents[result[CHUNK_ID_FIELD]]
+
+
+class AzureSearchBackend:
+    """azure.search.documents.aio を使う検索バックエンド"""
+
+    def __init__(self, endpoint: str, index_name: str, api_key: str, pool_config: "RagClientPoolConfig"):
+        self.index_name = index_name
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=pool_config.max_connections,
+                keepalive_timeout=pool_config.keepalive_expiry,
+            ),
+        )
+        self.search_client = SearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(api_key),
+            transport=AioHttpTransport(
+                session=self._session,
+                session_owner=False,
+                read_timeout=pool_config.timeout,
+            ),
+            # リトライは RateLimiter と合わせて AsyncRagClient で行う
+            retry_total=0,
+        )
+
+    async def search(self, query: SearchQuery) -> list[dict]:
+        search_results = await self.search_client.search(**build_azure_search_kwargs(query))
+        results = [dict(result) async for result in search_results]
+        missing_ids = missing_content_ids(results) if query.highlight else []
+        if missing_ids:
+            merge_content(results, await self.lookup(missing_ids, [CONTENT_FIELD]))
+        return results
+
+    async def lookup(self, chunk_ids: Sequence[str], fields: Sequence[str]) -> list[dict]:
+        search_results = await self.search_client.search(**build_lookup_kwargs(chunk_ids, fields))
+        return [dict(result) async for result in search_results]
+
+    def embed_query(self, text: str) -> Optional[np.ndarray]:
+        return None
+
+    async def aclose(self) -> None:
+        await self.search_client.close()
+        await self._session.close()
@@ -0,0 +1,63 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+from back.api.utils.metrics import COALESCED_REQUESTS
+
+
+V = TypeVar("V")
+
+
+class _Call(Generic[V]):
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task[V]"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(Generic[V]):
+    """同じキーで並行して呼ばれた処理を 1 回の実行にまとめ、全員に同じ結果（例外も含む）を返す
+
+    処理は最初の呼び出し元とは別のタスクで実行するので、一部の呼び出し元がキャンセルされても続行する。
+    待っている呼び出し元が全員いなくなった場合にだけ処理をキャンセルする。
+    タスクは最初の呼び出し元のコンテキストで動くため、span の計測もそのリクエストにだけ記録される。
+    """
+
+    def __init__(self, name: str = "rag"):
+        self.name = name
+        self._calls: dict[Hashable, _Call[V]] = {}
+
+    @classmethod
+    def from_env(cls) -> Optional["SingleFlight"]:
+        if os.getenv("COALESCE_REQUESTS", "true").lower() != "true":
+            return None
+        return cls()
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[V]]) -> V:
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            COALESCED_REQUESTS.inc(flight=self.name, result="leader")
+        else:
+            COALESCED_REQUESTS.inc(flight=self.name, result="coalesced")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # 後から来た呼び出し元がキャンセル中のタスクに合流しないよう、先に外す
+                self._forget(key, call)
+                call.task.cancel()
+                COALESCED_REQUESTS.inc(flight=self.name, result="cancelled")
+
+    def _forget(self, key: Hashable, call: _Call[V]) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
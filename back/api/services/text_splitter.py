@@ -0,0 +1,72 @@
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+from back.api.services.context_builder import TokenCounter
+
+
+# create_skillset.py の SplitSkill と同じ設定値
+MAXIMUM_PAGE_LENGTH = 2000
+PAGE_OVERLAP_LENGTH = 500
+
+SENTENCE_DELIMITERS = ("。", "．", ".", "!", "?", "！", "？", "\n")
+
+# ワーカープロセスごとに 1 つ（tiktoken のエンコーディングの読み込みを使い回す）
+_token_counter: Optional[TokenCounter] = None
+
+
+def split_pages(
+    text: str,
+    maximum_page_length: int = MAXIMUM_PAGE_LENGTH,
+    page_overlap_length: int = PAGE_OVERLAP_LENGTH,
+) -> list[str]:
+    """SplitSkill（text_split_mode="pages"）と同じ規則でテキストをページに分割する
+
+    各ページは maximum_page_length 文字以内で、可能ならページ後半の文の区切りで切る。
+    隣り合うページは page_overlap_length 文字だけ重複する。
+    """
+    text = text.strip()
+    if not text:
+        return []
+
+    pages = []
+    start = 0
+    while True:
+        end = start + maximum_page_length
+        if end >= len(text):
+            pages.append(text[start:])
+            return pages
+
+        # ページの後半に文の区切りがなければ文字数で切る
+        boundary = max(text.rfind(d, start + maximum_page_length // 2, end) for d in SENTENCE_DELIMITERS)
+        if boundary != -1:
+            end = boundary + 1
+        pages.append(text[start:end])
+        start = max(end - page_overlap_length, start + 1)
+
+
+def chunk_file(path: Path, source_dir: Path, token_model: Optional[str] = None) -> list[dict]:
+    """ファイルを SplitSkill と同じ規則（2000 文字・重複 500 文字）でチャンクに分割する
+
+    chunk_id・parent_id は build_local_index と同じく、source_dir からの相対パスから決める。
+    token_model を指定した場合は埋め込みのレート制限に使うトークン数を "_tokens" に入れる。
+    """
+    global _token_counter
+    relative = path.relative_to(source_dir).as_posix()
+    parent_id = hashlib.md5(relative.encode("utf-8")).hexdigest()
+    pages = split_pages(path.read_text(encoding="utf-8"), MAXIMUM_PAGE_LENGTH, PAGE_OVERLAP_LENGTH)
+    if token_model is not None and _token_counter is None:
+        _token_counter = TokenCounter()
+    chunks = []
+    for page_number, page in enumerate(pages):
+        chunk = {
+            "chunk_id": f"{parent_id}_pages_{page_number}",
+            "parent_id": parent_id,
+            "title": path.name,
+            "chunk": page,
+            "locations": [],
+        }
+        if token_model is not None:
+            chunk["_tokens"] = _token_counter.count(page, token_model)
+        chunks.append(chunk)
+    return chunks
@@ -0,0 +1,177 @@
+import math
+import threading
+from typing import Iterable, Iterator, Sequence, TypeVar
+
+
+# 秒単位。LLM の応答待ちまで入るよう 30 秒まで用意する
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: dict[str, object]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} のラベルは {self.label_names} です: {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type_name}"
+        yield from self._samples()
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set_total(self, value: float, **labels: object) -> None:
+        """別の場所で数えている累積値（キャッシュの統計など）をそのまま反映する"""
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        self.set_total(value, **labels)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに [各バケットの件数..., 合計値, 件数]
+        self._values: dict[LabelValues, list[float]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        label_names = self.label_names + ("le",)
+        for key, state in values:
+            for bound, bucket_count in zip(self.buckets, state):
+                labels = _format_labels(label_names, key + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {_format_value(bucket_count)}"
+            labels = _format_labels(label_names, key + ("+Inf",))
+            yield f"{self.name}_bucket{labels} {_format_value(state[-1])}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(state[-2])}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {_format_value(state[-1])}"
+
+
+_MetricT = TypeVar("_MetricT", bound=_Metric)
+
+
+class MetricsRegistry:
+    """メトリクスを Prometheus のテキスト形式で出力する"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _MetricT) -> _MetricT:
+        if metric.name in self._metrics:
+            raise ValueError(f"{metric.name} は登録済みです")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = [line for metric in self._metrics.values() for line in metric.collect()]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_DURATION = metrics.register(Histogram("rag_stage_duration_seconds", "リクエスト内の各段階の処理時間", ["stage"]))
+LLM_TOKENS = metrics.register(
+    Counter("rag_llm_tokens_total", "Azure OpenAI が報告したトークン数", ["deployment", "kind"])
+)
+CACHE_EVENTS = metrics.register(
+    Counter("rag_cache_events_total", "キャッシュのヒット・ミス・追い出しの累計", ["cache", "event"])
+)
+CACHE_ENTRIES = metrics.register(Gauge("rag_cache_entries", "キャッシュのエントリー数", ["cache"]))
+MESSAGE_QUEUE_DEPTH = metrics.register(Gauge("rag_message_writer_queue_depth", "書き込み待ちのメッセージ数"))
+MESSAGE_FLUSH_DURATION = metrics.register(
+    Histogram("rag_message_writer_flush_seconds", "メッセージの一括 INSERT にかかった時間")
+)
+MESSAGE_ROWS = metrics.register(
+    Counter("rag_message_writer_rows_total", "一括 INSERT で書き込んだ・破棄したメッセージ数", ["result"])
+)
+COALESCED_REQUESTS = metrics.register(
+    Counter(
+        "rag_coalesced_requests_total",
+        "同じ処理を実行中のリクエストへの合流（leader: 実行した, coalesced: 合流した, cancelled: 全員離脱で中止）",
+        ["flight", "result"],
+    )
+)
+RATE_LIMIT_WAIT = metrics.register(
+    Histogram("rag_rate_limit_wait_seconds", "レート制限の枠が空くまで待った時間", ["limiter"])
+)
+RATE_LIMIT_WAITING = metrics.register(
+    Gauge("rag_rate_limit_waiting", "レート制限の枠を待っているリクエスト数", ["limiter"])
+)
+RATE_LIMIT_RETRIES = metrics.register(
+    Counter("rag_rate_limit_retries_total", "429・一時的なエラーによるリトライ回数", ["limiter", "reason"])
+)
@@ -0,0 +1,13 @@
+import json
+from typing import Any
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    # リバースプロキシ（nginx など）によるバッファリングを無効化する
+    "X-Accel-Buffering": "no",
+}
+
+
+def format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
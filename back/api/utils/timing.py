@@ -0,0 +1,45 @@
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from back.api.utils.logging import logger
+from back.api.utils.metrics import STAGE_DURATION
+
+
+# 段階ごとのログのレベル。リクエストごとに何行も出るので既定は DEBUG（ハンドラーは INFO 以上を出力する）。
+# ログに出す場合は TIMING_LOG_LEVEL=INFO を指定する
+TIMING_LOG_LEVEL = logging.getLevelNamesMapping().get(os.getenv("TIMING_LOG_LEVEL", "DEBUG").upper(), logging.DEBUG)
+
+# リクエストごとの (段階名, 秒) のリスト。ServerTimingMiddleware がリクエストの開始時に用意する
+_spans_var: contextvars.ContextVar[Optional[list[tuple[str, float]]]] = contextvars.ContextVar(
+    "timing_spans", default=None
+)
+
+
+def start_request_timing() -> list[tuple[str, float]]:
+    spans: list[tuple[str, float]] = []
+    _spans_var.set(spans)
+    return spans
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """処理時間を計測し、ヒストグラムと現在のリクエストの Server-Timing に記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_DURATION.observe(duration, stage=name)
+        spans = _spans_var.get()
+        if spans is not None:
+            spans.append((name, duration))
+        # request_id はログのフィルターで付与される
+        logger.log(TIMING_LOG_LEVEL, "span %s %.2fms", name, duration * 1000)
+
+
+def format_server_timing(spans: list[tuple[str, float]]) -> str:
+    return ", ".join(f"{name};dur={duration * 1000:.2f}" for name, duration in spans)
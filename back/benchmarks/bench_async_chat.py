@@ -0,0 +1,94 @@
+"""/chat の 1 ワーカーあたりの並行スループットを、同期クライアントと非同期クライアントで比較する
+
+    python -m back.benchmarks.bench_async_chat --concurrency 1 8 32 --requests 64
+
+同期版は変更前と同じく async def のルートから RagClient をそのまま呼び出すため、
+LLM 呼び出しの間イベントループが止まる。
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+from back.benchmarks.fake_azure import BackgroundServer, configure_env, create_fake_azure_app
+from fastapi import FastAPI
+
+
+def _create_app() -> FastAPI:
+    from back.api.main import create_app
+    from back.api.schemas.chat_schema import RagChatRequest
+    from back.api.services.rag_client import RagClient
+
+    app = create_app()
+    blocking_clients: dict[str, RagClient] = {}
+
+    # 変更前の実装（async def の中で同期 SDK を呼ぶ）を再現する
+    @app.post("/bench/chat-blocking")
+    async def chat_blocking(request: RagChatRequest):
+        client = blocking_clients.get(request.model)
+        if client is None:
+            client = RagClient(
+                search_endpoint=os.getenv("SEARCH_ENDPOINT"),
+                search_api_key=os.getenv("SEARCH_API_KEY"),
+                search_index_name=os.getenv("SEARCH_INDEX_NAME"),
+                openai_endpoint=os.getenv("OPENAI_ENDPOINT"),
+                openai_api_key=os.getenv("OPENAI_API_KEY"),
+                deployment_name=request.model,
+                api_version=os.getenv("API_VERSION"),
+            )
+            blocking_clients[request.model] = client
+        return client.get_response_with_rag(request.query, top_k=request.top_k, search_mode=request.search_mode)
+
+    return app
+
+
+async def _drive(url: str, concurrency: int, total: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=concurrency)) as client:
+
+        async def one(i: int) -> None:
+            nonlocal errors
+            async with semaphore:
+                response = await client.post(url, json={"query": f"質問 {i}", "top_k": 5, "search_mode": "hybrid"})
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    return {"concurrency": concurrency, "requests": total, "seconds": elapsed, "rps": total / elapsed, "errors": errors}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--completion-latency", type=float, default=0.3)
+    args = parser.parse_args()
+    logging.getLogger("azure").setLevel(logging.WARNING)
+    logging.getLogger("api_logger").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    fake_app = create_fake_azure_app(search_latency=args.search_latency, completion_latency=args.completion_latency)
+    with BackgroundServer(fake_app) as fake:
+        configure_env(fake.url)
+        with BackgroundServer(_create_app()) as api:
+            print(f"{'path':<22}{'concurrency':>12}{'rps':>10}{'seconds':>10}{'errors':>8}")
+            for path in ["/bench/chat-blocking", "/chat"]:
+                for concurrency in args.concurrency:
+                    result = asyncio.run(_drive(api.url + path, concurrency, args.requests))
+                    print(
+                        f"{path:<22}{result['concurrency']:>12}{result['rps']:>10.1f}"
+                        f"{result['seconds']:>10.2f}{result['errors']:>8}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""/chat のエンドツーエンドのベンチマーク
+
+    python -m back.benchmarks.bench_chat --concurrency 1 4 16 64 --requests 200 --output bench.json
+    python -m back.benchmarks.bench_chat --output new.json --baseline bench.json
+
+フェイクの Azure AI Search と Azure OpenAI を別々のサーバーとして起動し、create_app() のアプリに負荷をかける。
+並行数ごとのスループットと p50/p95/p99 レイテンシに加えて、find_documents・コンテキストの組み立て・
+レスポンスのシリアライズのマイクロベンチマークを測り、結果を JSON で書き出す。
+--baseline を指定すると前回の結果と比較し、許容幅を超えて遅くなった項目があれば終了コード 1 を返す。
+
+レイテンシとペイロードサイズは "lognormal:0.05,0.5" のような分布で指定できる（fake_azure.Distribution を参照）。
+--openai-rpm / --openai-tpm / --throttle-rate を指定すると、フェイクの Azure OpenAI が 429 を返すようになり、
+レート制限の待ち時間とリトライの回数は /metrics の rag_rate_limit_* で確認できる。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from itertools import count
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+import httpx
+import numpy as np
+from back.api.schemas.chat_schema import SearchMode
+from back.benchmarks import fake_azure
+
+
+def summarize(latencies: list[float]) -> dict[str, float]:
+    """秒単位のレイテンシのリストをミリ秒の統計値にまとめる"""
+    if not latencies:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "mean_ms": 0.0, "max_ms": 0.0}
+    values = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "mean_ms": float(values.mean()),
+        "max_ms": float(values.max()),
+    }
+
+
+async def run_load(url: str, concurrency: int, total: int, search_mode: str, top_k: int) -> dict[str, Any]:
+    """concurrency 個のワーカーで合計 total 件のリクエストを送り続ける（クローズドループ）"""
+    latencies: list[float] = []
+    errors = 0
+    counter = count()
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=concurrency)) as client:
+
+        async def worker() -> None:
+            nonlocal errors
+            while (i := next(counter)) < total:
+                # クエリを毎回変えて、回答キャッシュにヒットしないようにする
+                body = {"query": f"質問 {i}", "top_k": top_k, "search_mode": search_mode}
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json=body)
+                    failed = response.status_code != 200 or "error" in response.json()
+                except httpx.HTTPError:
+                    failed = True
+                if failed:
+                    errors += 1
+                else:
+                    latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": len(latencies) / elapsed,
+        **summarize(latencies),
+    }
+
+
+async def _time_async(fn: Callable[[], Awaitable[Any]], iterations: int) -> dict[str, float]:
+    await fn()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        latencies.append(time.perf_counter() - start)
+    return {"iterations": iterations, **summarize(latencies)}
+
+
+def _time_sync(fn: Callable[[], Any], iterations: int) -> dict[str, float]:
+    fn()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return {"iterations": iterations, **summarize(latencies)}
+
+
+async def run_stage_benchmarks(iterations: int, search_mode: str, top_k: int) -> dict[str, dict[str, float]]:
+    """ネットワーク待ちを除いた各段階の処理時間を測る（フェイクサーバーのレイテンシは 0 で起動しておく）"""
+    from back.api.schemas.chat_schema import RagChatResponse
+    from back.api.services.rag_client_registry import RagClientRegistry
+
+    registry = RagClientRegistry()
+    client = registry.get_client(deployment_name="gpt-4o")
+    try:
+        query = "海面水温の変化について教えてください"
+        documents = await client.find_documents(query, top_k=top_k, search_mode=search_mode)
+        context = client.build_context(documents)
+        results = {
+            "query": query,
+            "response": "これはフェイクの応答です。" * 20,
+            "documents": context.documents,
+            "search_mode": search_mode,
+            "usage": {"context_tokens": context.tokens, "prompt_tokens": 0, "completion_tokens": 0},
+        }
+
+        def serialize() -> str:
+            # /chat と同じくモデルの検証を経てエンコードする
+            return RagChatResponse(**results).model_dump_json()
+
+        return {
+            "find_documents": await _time_async(
+                lambda: client.find_documents(query, top_k=top_k, search_mode=search_mode), iterations
+            ),
+            "build_context": _time_sync(lambda: client.build_context(documents), iterations),
+            "serialize_response": _time_sync(serialize, iterations),
+        }
+    finally:
+        await registry.aclose()
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """baseline より tolerance（比率）以上悪化した項目を返す"""
+    regressions = []
+    baseline_load = {row["concurrency"]: row for row in baseline.get("load", [])}
+    for row in current.get("load", []):
+        previous = baseline_load.get(row["concurrency"])
+        if previous is None:
+            continue
+        if row["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"load c={row['concurrency']} rps {previous['rps']:.1f} -> {row['rps']:.1f}")
+        for key in ("p95_ms", "p99_ms"):
+            if row[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"load c={row['concurrency']} {key} {previous[key]:.1f} -> {row[key]:.1f}")
+    for stage, stats in current.get("stages", {}).items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous is not None and stats["p50_ms"] > previous["p50_ms"] * (1 + tolerance):
+            regressions.append(f"stage {stage} p50_ms {previous['p50_ms']:.3f} -> {stats['p50_ms']:.3f}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=200, help="並行数ごとのリクエスト数")
+    parser.add_argument("--search-mode", default="hybrid", choices=[mode.value for mode in SearchMode])
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--search-latency", default="lognormal:0.05,0.3")
+    parser.add_argument("--completion-latency", default="lognormal:0.5,0.3")
+    parser.add_argument("--completion-tokens", default="uniform:20,200")
+    parser.add_argument("--chunk-size", default="uniform:500,2000", help="チャンクの文字数")
+    parser.add_argument("--documents-per-query", type=int, default=10)
+    parser.add_argument(
+        "--openai-rpm", type=int, help="フェイクの Azure OpenAI が 429 を返し始める 1 分あたりのリクエスト数"
+    )
+    parser.add_argument(
+        "--openai-tpm", type=int, help="フェイクの Azure OpenAI が 429 を返し始める 1 分あたりのトークン数"
+    )
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="枠に関係なく 429 を返す割合")
+    parser.add_argument("--stage-iterations", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="結果を書き出す JSON ファイル")
+    parser.add_argument("--baseline", type=Path, help="比較する前回の結果")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="悪化とみなす比率")
+    args = parser.parse_args()
+    for name in ("azure", "api_logger", "httpx"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    # 計測結果にキャッシュの効果が混ざらないようにする
+    os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+    os.environ.setdefault("RETRIEVAL_CACHE_ENABLED", "false")
+    # /chat は thread_id 無しで呼ぶので DB は使わない（Postgres が無い環境でも起動できるようにする）
+    os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+    search_app = fake_azure.create_fake_search_app(
+        latency=fake_azure.Distribution.parse(args.search_latency, seed=args.seed),
+        documents_per_query=args.documents_per_query,
+        chunk_size=fake_azure.Distribution.parse(args.chunk_size, seed=args.seed),
+    )
+    openai_quota = None
+    if args.openai_rpm or args.openai_tpm or args.throttle_rate:
+        openai_quota = fake_azure.FakeQuota(
+            args.openai_rpm, args.openai_tpm, throttle_rate=args.throttle_rate, seed=args.seed
+        )
+    openai_app = fake_azure.create_fake_openai_app(
+        completion_latency=fake_azure.Distribution.parse(args.completion_latency, seed=args.seed),
+        completion_tokens=fake_azure.Distribution.parse(args.completion_tokens, seed=args.seed),
+        quota=openai_quota,
+    )
+    results: dict[str, Any] = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        },
+        "load": [],
+    }
+
+    from back.api.main import create_app
+
+    with fake_azure.BackgroundServer(search_app) as search, fake_azure.BackgroundServer(openai_app) as openai:
+        fake_azure.configure_env(search.url, openai.url)
+        with fake_azure.BackgroundServer(create_app()) as api:
+            print(f"{'concurrency':>12}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+            for concurrency in args.concurrency:
+                row = asyncio.run(run_load(api.url + "/chat", concurrency, args.requests, args.search_mode, args.top_k))
+                results["load"].append(row)
+                print(
+                    f"{row['concurrency']:>12}{row['rps']:>10.1f}{row['p50_ms']:>10.1f}"
+                    f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['errors']:>8}"
+                )
+            if openai_quota is not None:
+                results["openai_quota"] = {"accepted": openai_quota.accepted, "throttled": openai_quota.throttled}
+                print(f"Azure OpenAI（フェイク）: 受付 {openai_quota.accepted} 件, 429 {openai_quota.throttled} 件")
+
+    zero_latency_search = fake_azure.create_fake_search_app(
+        latency=0,
+        documents_per_query=args.documents_per_query,
+        chunk_size=fake_azure.Distribution.parse(args.chunk_size, seed=args.seed),
+    )
+    with fake_azure.BackgroundServer(zero_latency_search) as search:
+        fake_azure.configure_env(search.url)
+        results["stages"] = asyncio.run(run_stage_benchmarks(args.stage_iterations, args.search_mode, args.top_k))
+    print(f"\n{'stage':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in results["stages"].items():
+        print(f"{stage:<20}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['p99_ms']:>10.3f}")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text(encoding="utf-8")), args.tolerance)
+        if regressions:
+            print("\n悪化した項目:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nベースラインからの悪化はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""fusion モード（キーワード検索とベクトル検索を並行に実行してアプリ側で RRF）と semantic モードの
+レイテンシ・再現率を比較する
+
+    python -m back.benchmarks.bench_fusion --queries 200 --top-k 5
+    python -m back.benchmarks.bench_fusion --search-latency lognormal:0.04,0.4 --semantic-latency 0.12
+    python -m back.benchmarks.bench_fusion --live queries.txt --top-k 5
+
+既定では、正解ラベル付きの合成コーパスを LocalSearchBackend（HashingEmbedder）に載せて recall@k を測る。
+ローカルにはセマンティックランカーが無いため、semantic モードは hybrid 検索 + --semantic-latency の待ち時間で
+代用する。検索 1 回ごとの待ち時間は --search-latency（fake_azure.Distribution の形式）から引く。
+
+--live には 1 行 1 クエリのファイルを渡す。環境変数の Azure AI Search に対して両モードを実行し、
+正解ラベルの代わりに semantic モードの上位 k 件との重なり（overlap@k）を表示する。
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+from back.api.services.async_rag_client import AsyncRagClient
+from back.api.services.local_search_backend import HashingEmbedder, LocalSearchBackend
+from back.api.services.search_backend import SearchBackend, SearchQuery
+from back.benchmarks.fake_azure import Distribution, DistributionSpec
+
+
+MODES = ("semantic", "fusion")
+
+
+class LatencySearchBackend:
+    """検索 1 回ごとにネットワーク越しの待ち時間を足す。semantic モードにはランカーの分も足す"""
+
+    def __init__(self, backend: SearchBackend, latency: DistributionSpec, semantic_latency: DistributionSpec):
+        self.backend = backend
+        self.latency = Distribution.parse(latency, seed=0)
+        self.semantic_latency = Distribution.parse(semantic_latency, seed=1)
+        self.calls = 0
+
+    async def search(self, query: SearchQuery) -> list[dict]:
+        self.calls += 1
+        delay = self.latency.sample()
+        if query.search_mode == "semantic":
+            delay += self.semantic_latency.sample()
+        await asyncio.sleep(delay)
+        return await self.backend.search(query)
+
+    async def lookup(self, chunk_ids: Sequence[str], fields: Sequence[str]) -> list[dict]:
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample())
+        return await self.backend.lookup(chunk_ids, fields)
+
+    def embed_query(self, text: str) -> Optional[np.ndarray]:
+        return self.backend.embed_query(text)
+
+    async def aclose(self) -> None:
+        await self.backend.aclose()
+
+
+def build_corpus(
+    topics: int, documents_per_topic: int, words_per_topic: int, seed: int = 0
+) -> tuple[list[dict], list[list[str]]]:
+    """トピックごとの語彙から文書を作り、(チャンク, トピックごとの語彙) を返す
+
+    文書には自トピックの語の一部と、全トピック共通の語・他トピックの語をノイズとして混ぜる。
+    """
+    rng = random.Random(seed)
+    vocabularies = [[f"t{topic}w{word}" for word in range(words_per_topic)] for topic in range(topics)]
+    common = [f"common{word}" for word in range(200)]
+    chunks = []
+    for topic, vocabulary in enumerate(vocabularies):
+        for i in range(documents_per_topic):
+            words = rng.sample(vocabulary, k=max(1, words_per_topic // 3))
+            words += rng.choices(common, k=40)
+            words += rng.choices(vocabularies[rng.randrange(topics)], k=5)
+            rng.shuffle(words)
+            chunks.append(
+                {
+                    "chunk_id": f"topic{topic}_pages_{i}",
+                    "parent_id": f"topic{topic}",
+                    "title": f"topic{topic}-{i}.txt",
+                    "chunk": " ".join(words),
+                    "locations": [],
+                }
+            )
+    return chunks, vocabularies
+
+
+def build_queries(vocabularies: list[list[str]], count: int, seed: int = 0) -> list[tuple[str, str]]:
+    """(クエリ, 正解の parent_id) のリスト"""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        topic = rng.randrange(len(vocabularies))
+        queries.append((" ".join(rng.sample(vocabularies[topic], k=3)), f"topic{topic}"))
+    return queries
+
+
+def _create_client(search_backend: Optional[SearchBackend] = None) -> AsyncRagClient:
+    if search_backend is None:
+        # --live では Azure AI Search の接続情報を環境変数から読む
+        return AsyncRagClient(None, None, None, None, None, None, None)
+    # find_documents だけを使うので Azure OpenAI には接続しない
+    return AsyncRagClient(
+        None,
+        None,
+        "bench-index",
+        "http://localhost",
+        "fake",
+        "bench-deployment",
+        "2024-06-01",
+        search_backend=search_backend,
+    )
+
+
+async def _run_mode(client: AsyncRagClient, queries: list[str], mode: str, top_k: int) -> tuple[list[float], list]:
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        documents = await client.find_documents(query, top_k=top_k, search_mode=mode)
+        latencies.append(time.perf_counter() - start)
+        results.append(documents)
+    return latencies, results
+
+
+def _percentile(values: list[float], q: float) -> float:
+    return float(np.percentile(values, q)) * 1000
+
+
+def _print_row(mode: str, latencies: list[float], quality: float) -> None:
+    print(
+        f"{mode:<10}{_percentile(latencies, 50):>10.1f}{_percentile(latencies, 95):>10.1f}"
+        f"{statistics.mean(latencies) * 1000:>10.1f}{quality:>10.3f}"
+    )
+
+
+async def _bench_offline(args: argparse.Namespace) -> None:
+    chunks, vocabularies = build_corpus(args.topics, args.documents_per_topic, args.words_per_topic)
+    embedder = HashingEmbedder(dimensions=args.dimensions)
+    local = LocalSearchBackend(chunks, embedder([chunk["chunk"] for chunk in chunks]), embedder=embedder)
+    backend = LatencySearchBackend(local, args.search_latency, args.semantic_latency)
+    client = _create_client(backend)
+    labeled = build_queries(vocabularies, args.queries)
+    relevant_per_query = min(args.top_k, args.documents_per_topic)
+
+    print(f"chunks={len(chunks)} queries={len(labeled)} top_k={args.top_k}")
+    print(f"{'mode':<10}{'p50 ms':>10}{'p95 ms':>10}{'mean ms':>10}{'recall':>10}")
+    try:
+        for mode in MODES:
+            latencies, results = await _run_mode(client, [query for query, _ in labeled], mode, args.top_k)
+            hits = [
+                sum(document["parent_id"] == parent_id for document in documents)
+                for documents, (_, parent_id) in zip(results, labeled)
+            ]
+            _print_row(mode, latencies, sum(hits) / (relevant_per_query * len(labeled)))
+    finally:
+        await client.aclose()
+
+
+async def _bench_live(args: argparse.Namespace) -> None:
+    queries = [line.strip() for line in Path(args.live).read_text(encoding="utf-8").splitlines() if line.strip()]
+    client = _create_client()
+    print(f"queries={len(queries)} top_k={args.top_k}（overlap は semantic の上位 k 件との重なり）")
+    print(f"{'mode':<10}{'p50 ms':>10}{'p95 ms':>10}{'mean ms':>10}{'overlap':>10}")
+    try:
+        reference = None
+        for mode in MODES:
+            latencies, results = await _run_mode(client, queries, mode, args.top_k)
+            ids = [{document["chunk_id"] for document in documents} for documents in results]
+            if reference is None:
+                reference = ids
+            overlap = [len(a & b) / max(1, len(b)) for a, b in zip(ids, reference)]
+            _print_row(mode, latencies, statistics.mean(overlap))
+    finally:
+        await client.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--documents-per-topic", type=int, default=20)
+    parser.add_argument("--words-per-topic", type=int, default=30)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--search-latency", default="lognormal:0.04,0.3")
+    parser.add_argument("--semantic-latency", default="lognormal:0.1,0.3")
+    parser.add_argument("--live", help="1 行 1 クエリのファイル。指定すると環境変数の Azure AI Search を使う")
+    args = parser.parse_args()
+    logging.getLogger("azure").setLevel(logging.WARNING)
+    logging.getLogger("api_logger").setLevel(logging.WARNING)
+
+    asyncio.run(_bench_live(args) if args.live else _bench_offline(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""取り込みパイプライン（back.rag_setup.ingest）のスループットをフェイクの Azure で測る
+
+    python -m back.benchmarks.bench_ingest --documents 500 --document-length 6000
+    python -m back.benchmarks.bench_ingest --embedding-latency lognormal:0.2,0.3 --upload-latency 0.3
+
+合成したテキストファイルのディレクトリを、埋め込みのバッチサイズ・並列数を変えた設定ごとに
+フェイクの Azure OpenAI・Azure AI Search へ取り込み、ファイル/秒・チャンク/秒を表示する。
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import tempfile
+from pathlib import Path
+
+from back.api.services import ingestion
+from back.api.services.rate_limiter import RateLimiters
+from back.benchmarks.fake_azure import BackgroundServer, configure_env, create_fake_azure_app
+
+
+# (名前, embed_batch_size, embed_concurrency, upload_batch_size, upload_concurrency)
+SETTINGS = (
+    ("serial", 16, 1, 100, 1),
+    ("batched", 128, 1, 250, 1),
+    ("concurrent", 128, 4, 250, 2),
+)
+
+
+def write_corpus(directory: Path, documents: int, length: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    words = ["東京", "大阪", "観光", "天気", "予報", "海", "山", "川", "ホテル", "料理", "交通", "季節"]
+    for i in range(documents):
+        text = "".join(rng.choice(words) + ("。" if rng.random() < 0.1 else "") for _ in range(length // 2))
+        (directory / f"doc{i:05d}.txt").write_text(text[:length], encoding="utf-8")
+
+
+async def _run(source_dir: Path, processes: int, setting: tuple) -> dict:
+    _, embed_batch_size, embed_concurrency, upload_batch_size, upload_concurrency = setting
+    rate_limiters = RateLimiters.from_env()
+    embedder = ingestion.AzureOpenAIEmbeddingClient.from_env(rate_limiters)
+    sink = ingestion.AzureSearchSink.from_env(rate_limiters)
+    pipeline = ingestion.IngestionPipeline(
+        embedder,
+        sink,
+        processes=processes,
+        embed_batch_size=embed_batch_size,
+        embed_concurrency=embed_concurrency,
+        upload_batch_size=upload_batch_size,
+        upload_concurrency=upload_concurrency,
+    )
+    try:
+        stats = await pipeline.run(ingestion.iter_source_files(source_dir), source_dir)
+    finally:
+        await embedder.aclose()
+        await sink.aclose()
+    return stats.as_dict()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--document-length", type=int, default=6000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--embedding-latency", default="lognormal:0.1,0.3")
+    parser.add_argument("--upload-latency", default="lognormal:0.1,0.3")
+    args = parser.parse_args()
+    logging.getLogger("azure").setLevel(logging.WARNING)
+    logging.getLogger("api_logger").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    app = create_fake_azure_app(
+        embedding_latency=args.embedding_latency,
+        embedding_dimensions=args.dimensions,
+        upload_latency=args.upload_latency,
+        seed=0,
+    )
+    with tempfile.TemporaryDirectory() as directory, BackgroundServer(app) as server:
+        configure_env(server.url)
+        source_dir = Path(directory)
+        write_corpus(source_dir, args.documents, args.document_length)
+        print(f"documents={args.documents} length={args.document_length} processes={args.processes}")
+        print(
+            f"{'setting':<12}{'chunks':>8}{'embed req':>10}{'upload req':>11}"
+            f"{'seconds':>9}{'docs/s':>9}{'chunks/s':>10}"
+        )
+        for setting in SETTINGS:
+            result = asyncio.run(_run(source_dir, args.processes, setting))
+            print(
+                f"{setting[0]:<12}{result['chunks']:>8}{result['embed_requests']:>10}{result['upload_requests']:>11}"
+                f"{result['seconds']:>9.2f}{result['documents_per_second']:>9.1f}{result['chunks_per_second']:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
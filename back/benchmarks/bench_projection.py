@@ -0,0 +1,102 @@
+"""検索結果のフィールド射影（select）によるペイロードサイズと取得時間の違いを比較する
+
+    python -m back.benchmarks.bench_projection --top-k 50 --iterations 20
+
+select="*" ではインデックスの text_vector（1536 次元）も返るため、使わないデータのダウンロードと
+JSON パースに時間がかかる。既定の射影とハイライト（全文の代わりに抜粋を受け取り、抜粋が無い結果だけ
+chunk_id で全文を取り直す）を合わせて比較する。ハイライトのサイズと時間は取り直しの分も含む。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import time
+from typing import Optional, Sequence
+
+import httpx
+from back.api.services import search_backend
+from back.api.services.rag_client import RagClientPoolConfig
+from back.benchmarks.fake_azure import BackgroundServer, create_fake_azure_app
+
+
+VARIANTS: list[tuple[str, Optional[Sequence[str]], bool]] = [
+    ("select=*", None, False),
+    ("default", search_backend.DEFAULT_SELECT_FIELDS, False),
+    ("highlights", search_backend.DEFAULT_SELECT_FIELDS, True),
+]
+
+
+def _request_body(kwargs: dict) -> dict:
+    body = {"search": kwargs["search_text"], "top": kwargs["top"], "select": ",".join(kwargs["select"])}
+    if "highlight_fields" in kwargs:
+        body["highlight"] = kwargs["highlight_fields"]
+    if "filter" in kwargs:
+        body["filter"] = kwargs["filter"]
+    if kwargs.get("vector_queries"):
+        # フェイクはベクトルクエリの有無だけを見るので、中身は送らない
+        body["vectorQueries"] = [{"kind": "text"}]
+    return body
+
+
+async def _measure_payload(url: str, query: search_backend.SearchQuery, iterations: int) -> dict:
+    # SDK を通さずに生のレスポンスを取得し、サイズと json.loads の時間だけを測る
+    async with httpx.AsyncClient() as client:
+        search_url = f"{url}/indexes('fake-index')/docs/search.post.search"
+        response = await client.post(search_url, json=_request_body(search_backend.build_azure_search_kwargs(query)))
+        payloads = [response.content]
+        missing_ids = search_backend.missing_content_ids(response.json()["value"]) if query.highlight else []
+        if missing_ids:
+            lookup = await client.post(
+                search_url,
+                json=_request_body(search_backend.build_lookup_kwargs(missing_ids, [search_backend.CONTENT_FIELD])),
+            )
+            payloads.append(lookup.content)
+    parse_times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        for payload in payloads:
+            json.loads(payload)
+        parse_times.append(time.perf_counter() - start)
+    return {"bytes": sum(map(len, payloads)), "parse_ms": statistics.median(parse_times) * 1000}
+
+
+async def _measure_search(url: str, query: search_backend.SearchQuery, iterations: int) -> float:
+    backend = search_backend.AzureSearchBackend(url, "fake-index", "fake", RagClientPoolConfig())
+    try:
+        await backend.search(query)
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await backend.search(query)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        await backend.aclose()
+    return statistics.median(latencies) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--search-mode", default="hybrid", choices=["full", "hybrid", "semantic"])
+    args = parser.parse_args()
+    logging.getLogger("azure").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    fake_app = create_fake_azure_app(search_latency=0, documents_per_query=args.top_k, chunk_size=args.chunk_size)
+    with BackgroundServer(fake_app) as fake:
+        print(f"{'variant':<12}{'bytes':>12}{'parse ms':>10}{'search ms':>11}")
+        for name, select, highlight in VARIANTS:
+            query = search_backend.SearchQuery(
+                "海面水温", args.top_k, args.search_mode, select=select, highlight=highlight
+            )
+            payload = asyncio.run(_measure_payload(fake.url, query, args.iterations))
+            search_ms = asyncio.run(_measure_search(fake.url, query, args.iterations))
+            print(f"{name:<12}{payload['bytes']:>12}{payload['parse_ms']:>10.2f}{search_ms:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
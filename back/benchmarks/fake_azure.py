@@ -0,0 +1,450 @@
+"""Azure AI Search / Azure OpenAI の代わりに応答するローカルのフェイクサーバー
+
+ベンチマーク用。レイテンシはサーバー側で asyncio.sleep するだけなので、1 プロセスで高い並行数を捌ける。
+レイテンシやペイロードサイズは固定値のほか Distribution で分布を指定できる。
+FakeQuota を渡すと、Azure と同じように枠を超えたリクエストに 429 と Retry-After を返す。
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from typing import Optional, Union
+
+import numpy as np
+import uvicorn
+from fastapi import APIRouter, FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+class Distribution:
+    """レイテンシ（秒）やサイズをサンプルする分布
+
+    "const:0.05", "uniform:0.02,0.08", "normal:0.05,0.01"（平均, 標準偏差）,
+    "lognormal:0.05,0.5"（中央値, σ）の形式の文字列から作れる。負の値は 0 に丸める。
+    """
+
+    KINDS = ("const", "uniform", "normal", "lognormal")
+
+    def __init__(self, kind: str, *params: float, seed: Optional[int] = None):
+        if kind not in self.KINDS:
+            raise ValueError(f"未対応の分布です: {kind}")
+        expected = 1 if kind == "const" else 2
+        if len(params) != expected:
+            raise ValueError(f"{kind} 分布のパラメーターは {expected} 個です: {params}")
+        self.kind = kind
+        self.params = params
+        self._random = random.Random(seed)
+
+    @classmethod
+    def parse(cls, spec: Union[str, float, "Distribution"], seed: Optional[int] = None) -> "Distribution":
+        if isinstance(spec, Distribution):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls("const", float(spec), seed=seed)
+        kind, _, params = spec.partition(":")
+        if not params:
+            # "0.05" のように数値だけの場合は固定値
+            return cls("const", float(kind), seed=seed)
+        return cls(kind, *(float(param) for param in params.split(",")), seed=seed)
+
+    def sample(self) -> float:
+        if self.kind == "const":
+            value = self.params[0]
+        elif self.kind == "uniform":
+            value = self._random.uniform(*self.params)
+        elif self.kind == "normal":
+            value = self._random.gauss(*self.params)
+        else:
+            median, sigma = self.params
+            value = median * float(np.exp(sigma * self._random.gauss(0.0, 1.0)))
+        return max(0.0, value)
+
+    def sample_int(self) -> int:
+        return int(round(self.sample()))
+
+    def __str__(self) -> str:
+        return f"{self.kind}:{','.join(str(param) for param in self.params)}"
+
+
+DistributionSpec = Union[str, float, Distribution]
+
+
+class FakeQuota:
+    """1 分あたりのリクエスト数・トークン数の枠（Azure OpenAI の RPM / TPM の真似）
+
+    枠が足りないリクエストには 429 と、枠が空くまでの Retry-After を返す。
+    throttle_rate の割合で、枠に関係なく 429 を返す（retry_after 秒後の再送を求める）。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        throttle_rate: float = 0.0,
+        retry_after: float = 0.2,
+        seed: Optional[int] = None,
+    ):
+        now = time.monotonic()
+        # 名前 -> [残り, 上限, 1 秒あたりの補充量, 最終更新時刻]
+        self._buckets = {
+            name: [float(limit), float(limit), limit / 60.0, now]
+            for name, limit in (("requests", requests_per_minute), ("tokens", tokens_per_minute))
+            if limit
+        }
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.throttled = 0
+        self.accepted = 0
+        self._random = random.Random(seed)
+
+    def _refill(self, now: float) -> None:
+        for bucket in self._buckets.values():
+            bucket[0] = min(bucket[1], bucket[0] + (now - bucket[3]) * bucket[2])
+            bucket[3] = now
+
+    def check(self, tokens: int = 0) -> Optional[float]:
+        """枠を消費して None を返す。枠が足りなければ再送までの秒数を返す"""
+        if self._random.random() < self.throttle_rate:
+            self.throttled += 1
+            return self.retry_after
+        now = time.monotonic()
+        self._refill(now)
+        amounts = {"requests": 1.0, "tokens": float(tokens)}
+        wait = 0.0
+        for name, (level, limit, rate, _) in self._buckets.items():
+            amount = min(amounts[name], limit)
+            if level < amount:
+                wait = max(wait, (amount - level) / rate)
+        if wait > 0:
+            self.throttled += 1
+            return wait
+        for name, bucket in self._buckets.items():
+            bucket[0] -= min(amounts[name], bucket[1])
+        self.accepted += 1
+        return None
+
+    def headers(self) -> dict[str, str]:
+        return {f"x-ratelimit-remaining-{name}": str(int(bucket[0])) for name, bucket in self._buckets.items()}
+
+    @staticmethod
+    def too_many_requests(retry_after: float) -> JSONResponse:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"code": "429", "message": "Rate limit is exceeded. Try again later."}},
+            headers={"retry-after-ms": str(int(retry_after * 1000)), "retry-after": str(math.ceil(retry_after))},
+        )
+
+
+_SEARCH_IN_CHUNK_ID = re.compile(r"search\.in\(chunk_id, '(.*)', ','\)")
+
+
+def create_fake_search_router(
+    latency: DistributionSpec = 0.05,
+    documents_per_query: int = 5,
+    chunk_size: DistributionSpec = 2000,
+    embedding_dimensions: int = 1536,
+    seed: Optional[int] = None,
+    quota: Optional[FakeQuota] = None,
+    upload_latency: DistributionSpec = 0.1,
+) -> APIRouter:
+    router = APIRouter()
+    latency = Distribution.parse(latency, seed=seed)
+    chunk_size = Distribution.parse(chunk_size, seed=seed)
+    upload_latency = Distribution.parse(upload_latency, seed=seed)
+
+    # SearchClient は検索で POST /indexes('{index}')/docs/search.post.search、
+    # 登録で POST /indexes('{index}')/docs/search.index を呼ぶ
+    @router.post("/indexes{rest:path}")
+    async def search(rest: str, request: Request):
+        body = await request.json()
+        if quota is not None and (retry_after := quota.check()) is not None:
+            return FakeQuota.too_many_requests(retry_after)
+        if rest.endswith("/docs/search.index"):
+            await asyncio.sleep(upload_latency.sample())
+            return {
+                "value": [
+                    {"key": document.get("chunk_id"), "status": True, "errorMessage": None, "statusCode": 201}
+                    for document in body.get("value", [])
+                ]
+            }
+        await asyncio.sleep(latency.sample())
+        top = body.get("top") or documents_per_query
+        select = body.get("select") or "*"
+        fields = None if select == "*" else set(select.split(","))
+        with_vector = fields is None or "text_vector" in fields
+        highlight_fields = set(filter(None, (body.get("highlight") or "").split(",")))
+        if lookup := _SEARCH_IN_CHUNK_ID.fullmatch(body.get("filter") or ""):
+            # chunk_id を指定した取り直し（search.in）では、指定されたチャンクだけを返す
+            ids = [int(match) for match in re.findall(r"fake_(\d+)_pages_", lookup.group(1))]
+        else:
+            ids = list(range(min(top, documents_per_query)))
+        # ハイブリッド検索では奇数番目をベクトル検索だけでヒットした結果とみなし、ハイライトを返さない
+        keyword_only = not body.get("vectorQueries")
+        return {
+            "value": [
+                _project_document(
+                    _fake_document(i, chunk_size.sample_int(), embedding_dimensions, with_vector=with_vector),
+                    fields,
+                    highlight_fields if keyword_only or i % 2 == 0 else set(),
+                )
+                for i in ids
+            ]
+        }
+
+    return router
+
+
+def create_fake_openai_router(
+    completion_latency: DistributionSpec = 0.5,
+    completion_tokens: DistributionSpec = 20,
+    embedding_latency: DistributionSpec = 0.02,
+    embedding_dimensions: int = 1536,
+    seed: Optional[int] = None,
+    quota: Optional[FakeQuota] = None,
+) -> APIRouter:
+    """quota はチャットと埋め込みで共有する（実際の Azure ではデプロイメントごと）"""
+    router = APIRouter()
+    completion_latency = Distribution.parse(completion_latency, seed=seed)
+    completion_tokens = Distribution.parse(completion_tokens, seed=seed)
+    embedding_latency = Distribution.parse(embedding_latency, seed=seed)
+
+    @router.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request, response: Response):
+        body = await request.json()
+        completion_id = f"chatcmpl-{uuid.uuid4()}"
+        tokens = max(1, completion_tokens.sample_int())
+        # プロンプトのトークン数は文字数からおおまかに見積もる
+        prompt_tokens = sum(len(message.get("content") or "") for message in body.get("messages", [])) // 4
+        if quota is not None:
+            # Azure と同じく、プロンプトと max_tokens の合計で TPM の枠を消費する
+            retry_after = quota.check(prompt_tokens + (body.get("max_tokens") or tokens))
+            if retry_after is not None:
+                return FakeQuota.too_many_requests(retry_after)
+        headers = quota.headers() if quota is not None else {}
+        if body.get("stream"):
+            return StreamingResponse(
+                _stream_completion(
+                    completion_id,
+                    deployment,
+                    completion_latency.sample(),
+                    tokens,
+                    # stream_options.include_usage を指定した場合は、最後に usage だけのチャンクを送る
+                    prompt_tokens if (body.get("stream_options") or {}).get("include_usage") else None,
+                ),
+                media_type="text/event-stream",
+                headers=headers,
+            )
+
+        await asyncio.sleep(completion_latency.sample())
+        response.headers.update(headers)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "".join(f"トークン{i} " for i in range(tokens))},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": tokens,
+                "total_tokens": prompt_tokens + tokens,
+            },
+        }
+
+    @router.post("/openai/deployments/{deployment}/embeddings")
+    async def embeddings(deployment: str, request: Request, response: Response):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        if quota is not None:
+            retry_after = quota.check(sum(len(text) for text in inputs) // 4)
+            if retry_after is not None:
+                return FakeQuota.too_many_requests(retry_after)
+            response.headers.update(quota.headers())
+        await asyncio.sleep(embedding_latency.sample())
+        encoding_format = body.get("encoding_format")
+        return {
+            "object": "list",
+            "model": deployment,
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": _encode_embedding(text, embedding_dimensions, encoding_format),
+                }
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    return router
+
+
+def create_fake_search_app(**kwargs) -> FastAPI:
+    app = FastAPI()
+    app.include_router(create_fake_search_router(**kwargs))
+    return app
+
+
+def create_fake_openai_app(**kwargs) -> FastAPI:
+    app = FastAPI()
+    app.include_router(create_fake_openai_router(**kwargs))
+    return app
+
+
+def create_fake_azure_app(
+    search_latency: DistributionSpec = 0.05,
+    completion_latency: DistributionSpec = 0.5,
+    documents_per_query: int = 5,
+    chunk_size: DistributionSpec = 2000,
+    embedding_latency: DistributionSpec = 0.02,
+    embedding_dimensions: int = 1536,
+    completion_tokens: DistributionSpec = 20,
+    seed: Optional[int] = None,
+    search_quota: Optional[FakeQuota] = None,
+    openai_quota: Optional[FakeQuota] = None,
+    upload_latency: DistributionSpec = 0.1,
+) -> FastAPI:
+    """Azure AI Search と Azure OpenAI の両方を 1 つのアプリで返す"""
+    app = FastAPI()
+    app.include_router(
+        create_fake_search_router(
+            latency=search_latency,
+            documents_per_query=documents_per_query,
+            chunk_size=chunk_size,
+            embedding_dimensions=embedding_dimensions,
+            seed=seed,
+            quota=search_quota,
+            upload_latency=upload_latency,
+        )
+    )
+    app.include_router(
+        create_fake_openai_router(
+            completion_latency=completion_latency,
+            completion_tokens=completion_tokens,
+            embedding_latency=embedding_latency,
+            embedding_dimensions=embedding_dimensions,
+            seed=seed,
+            quota=openai_quota,
+        )
+    )
+    return app
+
+
+def configure_env(search_url: str, openai_url: Optional[str] = None) -> None:
+    """RagClientRegistry がフェイクサーバーに接続するよう環境変数を設定する"""
+    os.environ.update(
+        {
+            "SEARCH_ENDPOINT": search_url,
+            "SEARCH_API_KEY": "fake",
+            "SEARCH_INDEX_NAME": "fake-index",
+            "OPENAI_ENDPOINT": openai_url or search_url,
+            "OPENAI_API_KEY": "fake",
+            "API_VERSION": "2024-06-01",
+        }
+    )
+
+
+def _fake_document(i: int, chunk_size: int, dimensions: int, with_vector: bool) -> dict:
+    document = {
+        "@search.score": 1.0 / (i + 1),
+        "chunk_id": f"fake_{i}_pages_{i}",
+        "parent_id": f"parent_{i // 2}",
+        "title": f"fake-{i}.pdf",
+        "chunk": "x" * chunk_size,
+        "locations": ["Pacific Ocean"],
+    }
+    if with_vector:
+        # 実際のインデックスと同じく、select="*" ではベクトルも返る
+        document["text_vector"] = fake_embedding(document["chunk_id"], dimensions).tolist()
+    return document
+
+
+def _project_document(document: dict, fields: set[str] | None, highlight_fields: set[str]) -> dict:
+    projected = {
+        key: value for key, value in document.items() if fields is None or key in fields or key.startswith("@search.")
+    }
+    if highlight_fields:
+        projected["@search.highlights"] = {
+            field: [document[field][:200], document[field][-200:]] for field in highlight_fields if field in document
+        }
+    return projected
+
+
+def _encode_embedding(text: str, dimensions: int, encoding_format: Optional[str]) -> Union[str, list[float]]:
+    # openai SDK は既定で base64（float32 のバイト列）を要求する
+    vector = fake_embedding(text, dimensions)
+    if encoding_format == "base64":
+        return base64.b64encode(vector.astype(np.float32).tobytes()).decode("ascii")
+    return vector.tolist()
+
+
+def fake_embedding(text: str, dimensions: int = 1536) -> np.ndarray:
+    # 同じテキストには常に同じ単位ベクトルを返す
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+async def _stream_completion(
+    completion_id: str,
+    deployment: str,
+    completion_latency: float,
+    tokens: int = 20,
+    prompt_tokens: Optional[int] = None,
+):
+    # 総レイテンシを保ったまま、トークンを等間隔で送る
+    chunk: dict = {"id": completion_id, "object": "chat.completion.chunk", "model": deployment}
+    for i in range(tokens):
+        await asyncio.sleep(completion_latency / tokens)
+        chunk = {
+            **chunk,
+            "created": int(time.time()),
+            "choices": [{"index": 0, "finish_reason": None, "delta": {"content": f"トークン{i} "}}],
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+    if prompt_tokens is not None:
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens}
+        yield f"data: {json.dumps({**chunk, 'choices': [], 'usage': usage}, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class BackgroundServer:
+    """uvicorn をバックグラウンドスレッドで起動する"""
+
+    def __init__(self, app: FastAPI, port: int | None = None):
+        self.port = port or get_free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", workers=1)
+        )
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self) -> "BackgroundServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._server.should_exit = True
+        self._thread.join()
@@ -0,0 +1,24 @@
+"""テキストファイルのディレクトリから LocalSearchBackend 用のインデックスを作成する
+
+リポジトリのルートで実行する:
+    python -m back.rag_setup.build_local_index <テキストのディレクトリ> <インデックスの出力先>
+
+作成したインデックスは SEARCH_BACKEND=local LOCAL_INDEX_DIR=<出力先> で API から利用できる。
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+from back.api.services.local_search_backend import HashingEmbedder, build_local_index
+
+
+parser = argparse.ArgumentParser(description="ローカル検索インデックスの作成")
+parser.add_argument("source_dir", type=Path)
+parser.add_argument("index_dir", type=Path)
+parser.add_argument("--dimensions", type=int, default=1536)
+args = parser.parse_args()
+
+start = time.perf_counter()
+chunk_count = build_local_index(args.source_dir, args.index_dir, embedder=HashingEmbedder(args.dimensions))
+print(f"{args.index_dir} に {chunk_count} チャンクのインデックスを作成しました（{time.perf_counter() - start:.1f} 秒）")
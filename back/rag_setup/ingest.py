@@ -0,0 +1,68 @@
+"""ローカルのテキストファイルを分割・埋め込みして Azure AI Search のインデックスに登録する
+
+リポジトリのルートで実行する:
+    python -m back.rag_setup.ingest <テキストのディレクトリ>
+
+インデクサー（create_skillset.py の SplitSkill）と同じ 2000 文字・重複 500 文字でチャンクに分割し、
+API と同じ環境変数（SEARCH_ENDPOINT・SEARCH_API_KEY・SEARCH_INDEX_NAME・OPENAI_ENDPOINT・OPENAI_API_KEY・
+API_VERSION・EMBEDDING_DEPLOYMENT_NAME）の接続先に登録する。レート制限は OPENAI_RATE_LIMITS などで指定する。
+"""
+
+import argparse
+import asyncio
+import logging
+from pathlib import Path
+
+from back.api.services import ingestion
+from back.api.services.rate_limiter import RateLimiters
+
+
+async def ingest(args: argparse.Namespace) -> None:
+    rate_limiters = RateLimiters.from_env()
+    embedder = ingestion.AzureOpenAIEmbeddingClient.from_env(rate_limiters)
+    sink = ingestion.AzureSearchSink.from_env(rate_limiters)
+    pipeline = ingestion.IngestionPipeline(
+        embedder,
+        sink,
+        processes=args.processes,
+        embed_batch_size=args.embed_batch_size,
+        embed_batch_tokens=args.embed_batch_tokens,
+        embed_concurrency=args.embed_concurrency,
+        upload_batch_size=args.upload_batch_size,
+        upload_concurrency=args.upload_concurrency,
+    )
+    try:
+        stats = await pipeline.run(ingestion.iter_source_files(args.source_dir, args.patterns), args.source_dir)
+    finally:
+        await embedder.aclose()
+        await sink.aclose()
+
+    result = stats.as_dict()
+    print(
+        f"{result['documents']} ファイル・{result['chunks']} チャンクを {result['seconds']} 秒で処理しました"
+        f"（{result['documents_per_second']} ファイル/秒、{result['chunks_per_second']} チャンク/秒）"
+    )
+    print(
+        f"登録 {result['uploaded']} チャンク、失敗 {result['failed']} チャンク・{result['failed_documents']} ファイル"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source_dir", type=Path)
+    parser.add_argument("--patterns", nargs="+", default=["*.txt", "*.md"])
+    parser.add_argument("--processes", type=int, default=None, help="分割に使うプロセス数（既定は CPU 数）")
+    parser.add_argument("--embed-batch-size", type=int, default=128)
+    parser.add_argument("--embed-batch-tokens", type=int, default=100_000)
+    parser.add_argument("--embed-concurrency", type=int, default=4)
+    parser.add_argument("--upload-batch-size", type=int, default=250)
+    parser.add_argument("--upload-concurrency", type=int, default=2)
+    args = parser.parse_args()
+    logging.getLogger("azure").setLevel(logging.WARNING)
+
+    asyncio.run(ingest(args))
+
+
+# プロセスプールのワーカーがこのモジュールを読み込んでも実行しないよう、main() の中で実行する
+if __name__ == "__main__":
+    main()